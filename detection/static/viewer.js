@@ -175,6 +175,74 @@ function add_svg_elements(svg, type_to_annotations) {
     }
 }
 
+function load_image_src(src, size, callback) {
+    // size is the [width, height] of the original image of a thumbnail, which
+    // is the coordinate system of its boxes
+    let img = document.createElement("img");
+    img.onload = function() {
+        if (size)
+            callback(src, size[0], size[1]);
+        else
+            callback(src, img.naturalWidth, img.naturalHeight);
+    }
+    img.src = src;
+}
+
+function load_image(url, callback) {
+    // a thumbnail (with max_side) tells the size of the original image in the
+    // X-Image-Size header
+    if (getUrlParameter(url, "max_side", "") === "") {
+        load_image_src(url, null, callback);
+        return;
+    }
+    fetch(url).then(function(response) {
+        if (!response.ok)
+            throw new Error(response.statusText);
+        let size = response.headers.get("X-Image-Size");
+        return response.blob().then(function(blob) {
+            load_image_src(URL.createObjectURL(blob), size ? size.split("x").map(Number) : null, callback);
+        });
+    }).catch(function() {
+        // e.g. a redirect to an image on another site, load it as it is
+        load_image_src(url, null, callback);
+    });
+}
+
+var batch_images = null;
+
+function load_batch_images(url) {
+    // fetch all the images of the grid in one response: the uint32 size of a
+    // json header, the header, and the images, each image of the header being
+    // either its offset, length, type and size, or only its url
+    return fetch(url).then(function(response) {
+        if (!response.ok)
+            throw new Error(response.statusText);
+        return response.arrayBuffer();
+    }).then(function(buffer) {
+        let header_size = new DataView(buffer).getUint32(0, true);
+        let header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, header_size)));
+        return header["images"].map(function(image) {
+            if ("url" in image)
+                return {"src": image["url"], "size": null};
+            let content = new Uint8Array(buffer, 4 + header_size + image["offset"], image["length"]);
+            let blob = new Blob([content], {type: image["type"]});
+            return {"src": URL.createObjectURL(blob), "size": image["size"] || null};
+        });
+    });
+}
+
+function load_grid_image(img_id, callback) {
+    // images of the grid are unpacked from one batch, loaded once and reused
+    // when the grid is laid out again, or loaded one by one if it fails
+    if (batch_images === null)
+        batch_images = batch_url ? load_batch_images(batch_url) : Promise.reject(new Error("no batch"));
+    batch_images.then(function(images) {
+        load_image_src(images[img_id]["src"], images[img_id]["size"], callback);
+    }, function() {
+        load_image(all_url[img_id], callback);
+    });
+}
+
 function add_svg_image_divs(all_url, all_key, all_type_to_annotations) {
     let image_cols = document.getElementById("grid").childElementCount;
     let j = 1;
@@ -190,13 +258,14 @@ function add_svg_image_divs(all_url, all_key, all_type_to_annotations) {
             }
         } (i);
 
-        let img = document.createElement("img");
-        img.onload = function(svg, preload_im, type_to_annotations) {
-            return function() {
+        load_grid_image(i, function(svg, type_to_annotations) {
+            return function(src, width, height) {
                 let svg_img = document.createElementNS("http://www.w3.org/2000/svg", "image");
                 svg_img.id = svg.getAttribute("id").replace("svg", "img");
-                svg_img.setAttributeNS("http://www.w3.org/1999/xlink", "href", preload_im.src);
-                svg.setAttribute("viewBox", "0 0 " + preload_im.naturalWidth + " " + preload_im.naturalHeight);
+                svg_img.setAttributeNS("http://www.w3.org/1999/xlink", "href", src);
+                svg_img.setAttribute("width", width);
+                svg_img.setAttribute("height", height);
+                svg.setAttribute("viewBox", "0 0 " + width + " " + height);
                 svg.appendChild(svg_img);
                 add_svg_elements(svg, type_to_annotations);
                 update_svg_objects(svg, 
@@ -206,8 +275,7 @@ function add_svg_image_divs(all_url, all_key, all_type_to_annotations) {
                     document.getElementById('show_pred').checked,
                     getUrlParameter(window.location.href, "label", ""));
             }
-        }(elem, img, all_type_to_annotations[i]);
-        img.src = all_url[i]
+        }(elem, all_type_to_annotations[i]));
 
         let id = "col" + j.toString();
 
@@ -413,7 +481,8 @@ function setViewerSize(preload_im)
 
 function openViewer(img_id)
 {
-    img_url = all_url[img_id];
+    // the viewer shows the original image instead of the thumbnail
+    img_url = removeUrlParameter(all_url[img_id], "max_side");
     type_to_annotations = all_type_to_annotations[img_id];
     let img = document.createElement("img");
     img.onload = function(preload_im) {
@@ -559,6 +628,8 @@ function setup_menu() {
     $("#subset_name")[0].innerHTML = subset;
     document.title = subset + " - [" + data + "] - TSV Viewer"
 
+    document.getElementById("label_query").value = getUrlParameter(window.location.href, "query", "");
+
     for (let opt of ["show_label", "show_all", "show_textinfo", "show_gt", "show_pred"])
         document.getElementById(opt).checked = localStorage.getItem(opt)
             ? JSON.parse(localStorage.getItem(opt))
@@ -575,6 +646,17 @@ function changeClass(cls) {
     location.reload();
 }
 
+function changeQuery(query) {
+    if (query.trim() === "")
+        url = removeUrlParameter(window.location.href, "query");
+    else
+        url = setUrlParameter(window.location.href, "query", query);
+    url = setUrlParameter(url, "start_id", "0");
+    closeViewer();
+    window.history.pushState("", document.title, url);
+    location.reload();
+}
+
 function setup_typeahead_class_search() {
     var substringMatcher = function (strs) {
         return function findMatches(q, cb) {
@@ -1,3 +1,185 @@
-from django.test import TestCase
+import os
+import os.path as op
+import json
+import shutil
+import struct
+import base64
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from . import views
+from utils.tsv_file import TSVFile
+from utils.tsv_dataset import TSVSubset
+from utils.metainfo_scheduler import build_metainfo
+from utils.synthetic_data import make_synthetic_dataset
+
+
+def get_content(response):
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+class ViewTestCase(SimpleTestCase):
+    """ Serve a data root of two datasets, with the images encoded in the tsv
+        and with the paths of image files, whose metainfo is built up front.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super(ViewTestCase, cls).setUpClass()
+        cls.data_root = tempfile.mkdtemp()
+        make_synthetic_dataset(op.join(cls.data_root, 'encoded'), num_rows=20, min_side=16, max_side=64,
+                               num_labels=5, num_images=4, prediction=True)
+        cls.tsv_file = op.join(cls.data_root, 'encoded', 'train.tsv')
+
+        files_dir = op.join(cls.data_root, 'files')
+        os.makedirs(files_dir)
+        tsv = TSVFile(cls.tsv_file)
+        cls.image_files = []
+        with open(op.join(files_dir, 'train.tsv'), 'w') as fp:
+            for i in range(tsv.num_rows()):
+                key, label, image = list(tsv.seek(i))
+                image_file = op.join(files_dir, '{}.jpg'.format(i))
+                with open(image_file, 'wb') as image_fp:
+                    image_fp.write(base64.b64decode(image))
+                fp.write('{}\t{}\t{}\n'.format(key, label, image_file))
+                cls.image_files.append(image_file)
+
+        for data, subset in [('encoded', 'train'), ('encoded', 'prediction.yaml'), ('files', 'train')]:
+            build_metainfo(TSVSubset.from_name(op.join(cls.data_root, data), subset))
+        cls.thumbnail_dir = op.join(cls.data_root, '.thumbnails')
+        cls.data_root_patch = mock.patch.object(views, 'get_data_root', return_value=cls.data_root)
+        cls.data_root_patch.start()
+        cls.thumbnail_settings = override_settings(THUMBNAIL_CACHE_DIR=cls.thumbnail_dir)
+        cls.thumbnail_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.thumbnail_settings.disable()
+        cls.data_root_patch.stop()
+        shutil.rmtree(cls.data_root)
+        super(ViewTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        views._thumbnail_cache = None
+
+    def get_image(self, data, idx, **kwargs):
+        return self.client.get('/image', {'data': data, 'subset': 'train', 'version': 0, 'imgidx': idx}, **kwargs)
+
+    def get_encoded_image(self, idx):
+        return base64.b64decode(TSVFile(self.tsv_file).seek(idx)[-1])
+
+
+class TestImageViews(ViewTestCase):
+    def test_image(self):
+        response = self.get_image('encoded', 3)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(get_content(response), self.get_encoded_image(3))
+        self.assertIn('max-age', response['Cache-Control'])
+
+    def test_etag_not_modified(self):
+        etag = self.get_image('encoded', 3)['ETag']
+        response = self.get_image('encoded', 3, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertNotEqual(self.get_image('encoded', 4)['ETag'], etag)
+        self.assertEqual(self.get_image('encoded', 4, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_thumbnail(self):
+        response = self.client.get('/image', {'data': 'encoded', 'subset': 'train', 'version': 0,
+                                              'imgidx': 3, 'max_side': 8})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('X-Image-Size', response)
+        self.assertTrue(op.isdir(self.thumbnail_dir))
+
+    def test_file_image(self):
+        response = self.get_image('files', 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        with open(self.image_files[5], 'rb') as fp:
+            self.assertEqual(get_content(response), fp.read())
+
+    def test_range(self):
+        with open(self.image_files[5], 'rb') as fp:
+            content = fp.read()
+        response = self.get_image('files', 5, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/{}'.format(len(content)))
+        self.assertEqual(get_content(response), content[10:20])
+
+        response = self.get_image('files', 5, HTTP_RANGE='bytes=-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(get_content(response), content[-5:])
+
+        response = self.get_image('files', 5, HTTP_RANGE='bytes={}-'.format(len(content)))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */{}'.format(len(content)))
+
+    def test_if_range(self):
+        with open(self.image_files[5], 'rb') as fp:
+            content = fp.read()
+        etag = self.get_image('files', 5)['ETag']
+        response = self.get_image('files', 5, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(get_content(response), content[:10])
+        # the file changed since the range was asked for, the whole file is sent
+        response = self.get_image('files', 5, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_content(response), content)
+
+    def test_batch(self):
+        indices = [7, 2, 7, 0]
+        response = self.client.get('/images', {'data': 'encoded', 'subset': 'train', 'version': 0,
+                                               'imgidx': ','.join(map(str, indices))})
+        self.assertEqual(response.status_code, 200)
+        content = response.content
+        header_size, = struct.unpack('<I', content[:4])
+        images = json.loads(content[4:4 + header_size].decode())['images']
+        body = content[4 + header_size:]
+        self.assertEqual(len(images), len(indices))
+        for idx, image in zip(indices, images):
+            self.assertEqual(image['type'], 'image/jpeg')
+            self.assertEqual(body[image['offset']:image['offset'] + image['length']], self.get_encoded_image(idx))
+        response = self.client.get('/images', {'data': 'encoded', 'subset': 'train', 'version': 0,
+                                               'imgidx': ','.join(map(str, indices))},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_batch_too_large(self):
+        response = self.client.get('/images', {'data': 'encoded', 'subset': 'train', 'version': 0,
+                                               'imgidx': ','.join(['0'] * (views.MAX_BATCH_IMAGES + 1))})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestPageViews(ViewTestCase):
+    def test_overview_not_modified(self):
+        response = self.client.get('/detection/overview', {'data': 'encoded'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get('/detection/overview', {'data': 'encoded'},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def view_images(self, **kwargs):
+        params = {'data': 'encoded', 'subset': 'prediction.yaml', 'version': 0, 'start_id': 0}
+        params.update(kwargs)
+        return self.client.get('/detection/viewimages', params)
+
+    def test_view_images(self):
+        with open(op.join(self.data_root, 'encoded', 'train.label.labelmap.txt'), 'r') as fp:
+            label = fp.readline().strip()
+        self.assertEqual(self.view_images().status_code, 200)
+        self.assertEqual(self.view_images(label=label).status_code, 200)
+        self.assertEqual(self.view_images(query='NOT "{}"'.format(label), min_conf=0.5).status_code, 200)
+        self.assertEqual(self.view_images(key='images/0000001', key_match='prefix').status_code, 200)
+
+    def test_view_images_bad_request(self):
+        self.assertEqual(self.view_images(query='(').status_code, 400)
+        self.assertEqual(self.view_images(query='no_such_label').status_code, 400)
+        self.assertEqual(self.view_images(key='x', key_match='regex').status_code, 400)
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
@@ -7,6 +8,9 @@ app_name = 'detection'
 urlpatterns = [
     path('detection/', views.list_data, name='listdata'),
     path('detection/overview', views.data_overview, name='overview'),
-    path('detection/viewimages', views.view_images, name='viewimages'),
-    path('image', views.show_image, name='showimage'),
+    path('detection/viewimages', views.view_images_async if settings.ASYNC_VIEWS else views.view_images,
+         name='viewimages'),
+    path('detection/indexstatus', views.index_status, name='indexstatus'),
+    path('image', views.show_image_async if settings.ASYNC_VIEWS else views.show_image, name='showimage'),
+    path('images', views.show_images_async if settings.ASYNC_VIEWS else views.show_images, name='showimages'),
 ]
\ No newline at end of file
@@ -1,80 +1,401 @@
 # -*- coding: utf-8 -*-
-from django.http import HttpResponseRedirect, HttpResponse, FileResponse
+from django.http import HttpResponseRedirect, HttpResponse, FileResponse, JsonResponse
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render
 from django.urls import reverse
 from django.core.cache import cache
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+import os
 import os.path as op
+import re
+import struct
+import hashlib
+import mimetypes
 import logging
 import json
 import copy
 import base64
+import numpy as np
 from utils.logger import init_logging
 from utils.file_io import list_all_data
 from utils.tsv_file import TSVFile
-from utils.tsv_dataset import TSVDataset, TSVSubset
-from utils.tsv_dataset import get_all_data_info
+from utils.tsv_dataset import TSVSubset
+from utils.tsv_dataset import get_all_subsets, get_subset_info
+from utils.metainfo_scheduler import get_scheduler
+from utils.label_query import run_label_query, intersect_sorted, LabelQueryError
+from utils.conf_index import get_conf_index_file
+from utils.reader_registry import get_tsv_file, get_inverted_index, get_conf_index, get_key_index
+from utils.key_index import get_key_index_file
+from utils.thumbnail import ThumbnailCache, get_thumbnail
+from utils.image_io import get_image_source, read_image_source, IMAGE_COLUMN
+from utils.async_reader import get_async_reader
 
 
 init_logging()
 
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+# base64 images larger than this are decoded and sent chunk by chunk
+STREAM_MIN_SIZE = 4 << 20
+MAX_BATCH_IMAGES = 256
+# the lookups of the key index selected by the key_match parameter of view_images
+KEY_MATCHES = ('exact', 'prefix', 'contains')
+
 
 def get_data_root():
     return op.join(op.dirname(op.dirname(op.realpath(__file__))), 'data')
 
 
+_thumbnail_cache = None
+
+
+def get_thumbnail_cache():
+    global _thumbnail_cache
+    if _thumbnail_cache is None:
+        _thumbnail_cache = ThumbnailCache(settings.THUMBNAIL_CACHE_DIR, settings.THUMBNAIL_CACHE_BYTES)
+    return _thumbnail_cache
+
+
+def get_file_validators(files, *keys):
+    """ Return a strong ETag derived from the paths, sizes and modification
+        times of files and from keys, and the latest modification time.
+    """
+    h = hashlib.sha1()
+    last_modified = 0
+    for f in files:
+        st = os.stat(f)
+        h.update('{}:{}:{}\n'.format(op.abspath(f), st.st_mtime_ns, st.st_size).encode())
+        last_modified = max(last_modified, int(st.st_mtime))
+    h.update(json.dumps(keys).encode())
+    return '"{}"'.format(h.hexdigest()), last_modified
+
+
+def set_cache_headers(response, etag, last_modified, **cache_control):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, **cache_control)
+    return response
+
+
+def get_not_modified_response(request, etag, last_modified, **cache_control):
+    """ Return a 304 (or 412) response if the conditional headers of the
+        request match the validators, or None.
+    """
+    response = set_cache_headers(HttpResponse(), etag, last_modified, **cache_control)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+    return None if response.status_code == 200 else response
+
+
+def read_file_chunks(fp, size, chunk_size=1 << 20):
+    try:
+        while size > 0:
+            chunk = fp.read(min(chunk_size, size))
+            if not chunk:
+                break
+            size -= len(chunk)
+            yield chunk
+    finally:
+        fp.close()
+
+
+def decode_base64_chunks(encoded, chunk_size=1 << 20):
+    """ Decode a base64 buffer piece by piece, chunk_size being a multiple of 4.
+    """
+    for start in range(0, len(encoded), chunk_size):
+        yield base64.b64decode(encoded[start:start + chunk_size])
+
+
+def get_base64_response(encoded):
+    """ Return a response of a base64 encoded jpeg. A large one is streamed
+        from the memory-mapped tsv, so that it is never held as a whole.
+    """
+    if len(encoded) < STREAM_MIN_SIZE or len(encoded) % 4 != 0:
+        return HttpResponse(base64.b64decode(encoded), content_type="image/jpeg")
+    response = StreamingHttpResponse(decode_base64_chunks(encoded), content_type="image/jpeg")
+    num_padding = bytes(encoded[-2:]).count(b'=')
+    response['Content-Length'] = str(len(encoded) // 4 * 3 - num_padding)
+    return response
+
+
+def get_file_response(request, path, etag, last_modified):
+    """ Return a file, or the single byte range of it asked by a Range header.
+    """
+    size = op.getsize(path)
+    m = RANGE_PATTERN.match(request.META.get('HTTP_RANGE', '').strip())
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if m is None or m.group(1) == m.group(2) == '' or \
+            (m.group(1) and m.group(2) and int(m.group(1)) > int(m.group(2))) or \
+            (if_range and if_range not in (etag, http_date(last_modified))):
+        response = FileResponse(open(path, 'rb'))
+        response['Accept-Ranges'] = 'bytes'
+        return response
+    if m.group(1) == '':
+        # a suffix range of the last bytes
+        start, end = max(0, size - int(m.group(2))), size - 1
+    else:
+        start = int(m.group(1))
+        end = min(size - 1, int(m.group(2))) if m.group(2) else size - 1
+    if start >= size:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+    fp = open(path, 'rb')
+    fp.seek(start)
+    response = StreamingHttpResponse(read_file_chunks(fp, end - start + 1), status=206,
+        content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    response['Content-Length'] = str(end - start + 1)
+    response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
 def list_data(request):
     names = list_all_data(get_data_root())
     context = {'names': names}
     return render(request, 'detection/list_data.html', context)
 
 
+def render_building_index(request, data, subset_status, subset=None, version=None):
+    """ Render a page showing the progress of the metainfo builds, which
+        reloads itself when they are done.
+    """
+    status_url = reverse('detection:indexstatus') + '?data={}'.format(data)
+    if subset is not None:
+        status_url += '&subset={}&version={}'.format(subset, version)
+    context = {'data': data,
+               'subsets': [(s.name, s.version, st['state'], int(100 * st['progress']))
+                           for s, st in subset_status],
+               'status_url': status_url}
+    return render(request, 'detection/building_index.html', context)
+
+
+def index_status(request):
+    data = request.GET.get('data')
+    subset = request.GET.get('subset')
+    data_dir = op.join(get_data_root(), data)
+    if subset is None:
+        subsets = get_all_subsets(data_dir)
+    else:
+        version = int(request.GET.get('version', 0))
+        subsets = [TSVSubset.from_name(data_dir, subset, version=version)]
+    scheduler = get_scheduler()
+    status = []
+    for s in subsets:
+        st = scheduler.status(s)
+        st.update({'name': s.name, 'version': s.version})
+        status.append(st)
+    return JsonResponse({'done': all(st['state'] == 'done' for st in status), 'subsets': status})
+
+
 def data_overview(request):
     data = request.GET.get('data')
-    name_subsets_labels = get_all_data_info(op.join(get_data_root(), data))
+    data_dir = op.join(get_data_root(), data)
+    # build missing metainfo in the background instead of blocking the request
+    scheduler = get_scheduler()
+    subset_status = [(s, scheduler.ensure(s)) for s in get_all_subsets(data_dir)]
+    pending = [(s, st) for s, st in subset_status if st['state'] != 'done']
+    if len(pending) > 0:
+        return render_building_index(request, data, pending)
+    # the page only changes with the metainfo files, revalidate it with them
+    metainfo_files = [data_dir]
+    for s, _ in subset_status:
+        metainfo_files.extend([s.tsv_file, s.stats_file] + ([s.conf_stats_file] if s.conf_stats_file else []))
+    etag, last_modified = get_file_validators(metainfo_files)
+    response = get_not_modified_response(request, etag, last_modified, no_cache=True)
+    if response is not None:
+        return response
+    # the page is rendered from the label statistics saved with the metainfo
+    name_subsets_labels = [(data, [get_subset_info(s) for s, _ in subset_status])]
     context = {'name_subsets_versions_labelcounts': name_subsets_labels}
-    return render(request, 'detection/data_overview.html', context)
+    response = render(request, 'detection/data_overview.html', context)
+    return set_cache_headers(response, etag, last_modified, no_cache=True)
 
 
-def show_image(request):
+def parse_image_params(request):
     data = request.GET.get('data')
     subset = request.GET.get('subset')
     version = int(request.GET.get('version'))
     idx = int(request.GET.get('imgidx'))
-    tsv = cache.get(data+subset+str(version))
-    if not tsv:
+    max_side = request.GET.get('max_side', request.GET.get('size'))
+    return data, subset, version, idx, max_side
+
+
+def get_subset_tsv_file(data, subset, version):
+    """ Return the tsv file of a subset, or None while its metainfo is built.
+    """
+    # only the tsv path is cached, the open tsv is shared from the reader registry
+    tsv_file = cache.get(data+subset+str(version))
+    if not tsv_file:
         logging.info('Cache miss. Load data to cache: {}/{}'.format(data, subset))
         s = TSVSubset.from_name(op.join(get_data_root(), data), subset, version=version)
-        TSVFile.ensure_metainfo(s.tsv_file, label_file=s.label_file, prediction_file=s.prediction_file,
-            labelmap_file=s.labelmap_file, hw_file=s.hw_file)
-        tsv = TSVFile(s.tsv_file)
-        cache.set(data+subset+str(version), tsv)
-
-    row = tsv.seek(idx)
-    if row[-1].startswith('http'):
-        return HttpResponseRedirect(row[-1])
-    if op.isfile(row[-1]):
-        return FileResponse(open(row[-1], 'rb'))
-    jpgbytestring = base64.b64decode(row[-1])
-    return HttpResponse(jpgbytestring, content_type="image/jpeg")
-
-def retrieve_images(label_file, inverted, prediction_file, label, start_id, min_conf=-float('inf'), max_conf=float('inf')):
-    label_tsv = cache.get(op.abspath(label_file))
-    if not label_tsv:
-        label_tsv = TSVFile(label_file)
-        cache.set(op.abspath(label_file), label_tsv)
+        # the metainfo is only built by the scheduler, under the lock of the build
+        if get_scheduler().ensure(s)['state'] != 'done':
+            return None
+        tsv_file = s.tsv_file
+        cache.set(data+subset+str(version), tsv_file)
+    return tsv_file
+
+
+def get_building_response():
+    """ Return a response asking to retry an image of a subset whose metainfo is being built.
+    """
+    response = HttpResponse('Building index', status=503, content_type='text/plain')
+    response['Retry-After'] = '5'
+    return response
+
+
+def get_image_validators(data, subset, version, idx, max_side):
+    """ Return the tsv file of a subset and the validators of one of its
+        images, or None for all of them while its metainfo is built.
+    """
+    tsv_file = get_subset_tsv_file(data, subset, version)
+    if tsv_file is None:
+        return None, None, None
+    # the validators only depend on the tsv and the offset of the row, so a
+    # conditional request is answered without reading the row
+    etag, last_modified = get_file_validators([tsv_file], get_tsv_file(tsv_file).get_offset(idx), max_side)
+    return tsv_file, etag, last_modified
+
+
+def get_image_cache_control():
+    return {'private': True, 'max_age': settings.IMAGE_CACHE_MAX_AGE}
+
+
+def get_image_response(request, col_image, max_side, etag, last_modified):
+    kind, source = get_image_source(col_image)
+    response = None
+    if kind == 'url':
+        response = HttpResponseRedirect(source)
+    elif max_side:
+        thumbnail = get_thumbnail(get_thumbnail_cache(), *read_image_source(kind, source), int(max_side))
+        if thumbnail is not None:
+            response = HttpResponse(thumbnail[0], content_type="image/jpeg")
+            response['X-Image-Size'] = '{}x{}'.format(*thumbnail[1])
+    if response is None:
+        if kind == 'file':
+            response = get_file_response(request, source, etag, last_modified)
+        else:
+            response = get_base64_response(source)
+    return set_cache_headers(response, etag, last_modified, **get_image_cache_control())
+
 
+def show_image(request):
+    data, subset, version, idx, max_side = parse_image_params(request)
+    tsv_file, etag, last_modified = get_image_validators(data, subset, version, idx, max_side)
+    if tsv_file is None:
+        return get_building_response()
+    response = get_not_modified_response(request, etag, last_modified, **get_image_cache_control())
+    if response is not None:
+        return response
+    col_image = get_tsv_file(tsv_file).seek(idx).get_bytes(IMAGE_COLUMN)
+    return get_image_response(request, col_image, max_side, etag, last_modified)
+
+
+async def show_image_async(request):
+    """ The async version of show_image. The blocking work runs on the bounded
+        pool of the async reader, and the row is read together with the
+        concurrent requests for the same tsv.
+    """
+    reader = get_async_reader()
+    data, subset, version, idx, max_side = parse_image_params(request)
+    tsv_file, etag, last_modified = await reader.run(get_image_validators, data, subset, version, idx, max_side)
+    if tsv_file is None:
+        return get_building_response()
+    response = get_not_modified_response(request, etag, last_modified, **get_image_cache_control())
+    if response is not None:
+        return response
+    col_image = (await reader.read_row(tsv_file, idx, columns=[IMAGE_COLUMN], as_bytes=True))[0]
+    return await reader.run(get_image_response, request, col_image, max_side, etag, last_modified)
+
+def read_batch_image(col_image, max_side):
+    """ Return the header entry and the content of an image of a batch.
+    """
+    kind, source = get_image_source(col_image)
+    if kind == 'url':
+        return {'url': source}, b''
+    if max_side:
+        thumbnail = get_thumbnail(get_thumbnail_cache(), *read_image_source(kind, source), int(max_side))
+        if thumbnail is not None:
+            return {'type': 'image/jpeg', 'size': list(thumbnail[1])}, thumbnail[0]
+    if kind == 'file':
+        return {'type': mimetypes.guess_type(source)[0] or 'application/octet-stream'}, \
+            read_image_source(kind, source)[0]
+    return {'type': 'image/jpeg'}, base64.b64decode(source)
+
+
+def show_images(request):
+    """ Return the images of a comma-separated list of imgidx in one response:
+        the uint32 size of a json header, the header, and the images one after
+        another. The header lists for each image its offset after the header,
+        its length, its content type and the original size of a thumbnail, or
+        only its url if it is not stored in the tsv.
+    """
+    data = request.GET.get('data')
+    subset = request.GET.get('subset')
+    version = int(request.GET.get('version'))
+    indices = [int(x) for x in request.GET.get('imgidx').split(',')]
+    max_side = request.GET.get('max_side', request.GET.get('size'))
+    if len(indices) > MAX_BATCH_IMAGES:
+        return HttpResponseBadRequest('at most {} images per batch'.format(MAX_BATCH_IMAGES))
+
+    tsv_file = get_subset_tsv_file(data, subset, version)
+    if tsv_file is None:
+        return get_building_response()
+    tsv = get_tsv_file(tsv_file)
+    etag, last_modified = get_file_validators([tsv_file], [tsv.get_offset(i) for i in indices], max_side)
+    response = get_not_modified_response(request, etag, last_modified, **get_image_cache_control())
+    if response is not None:
+        return response
+
+    # the rows are read in one pass in file order, nearby rows in a single read
+    images, contents, offset = [], [], 0
+    for col_image, in tsv.seek_many(indices, columns=[IMAGE_COLUMN], as_bytes=True):
+        image, content = read_batch_image(col_image, max_side)
+        image.update({'offset': offset, 'length': len(content)})
+        images.append(image)
+        contents.append(content)
+        offset += len(content)
+    header = json.dumps({'images': images}).encode()
+    response = HttpResponse(b''.join([struct.pack('<I', len(header)), header] + contents),
+                            content_type='application/octet-stream')
+    return set_cache_headers(response, etag, last_modified, **get_image_cache_control())
+
+
+async def show_images_async(request):
+    """ The async version of show_images, run on the bounded pool of the async reader.
+    """
+    return await get_async_reader().run(show_images, request)
+
+
+def retrieve_images(label_file, inverted, prediction_file, label, start_id, min_conf=-float('inf'), max_conf=float('inf'),
+                    batch_size=50, query_rows=None, conf_index=None, key_rows=None):
+    label_tsv = get_tsv_file(label_file)
     prediction_tsv = None
     if prediction_file is not None:
-        prediction_tsv = cache.get(op.abspath(prediction_file))
-        if not prediction_tsv:
-            prediction_tsv = TSVFile(prediction_file)
-            cache.set(op.abspath(prediction_file), prediction_tsv)
+        prediction_tsv = get_tsv_file(prediction_file)
 
-    if label is None:
+    if query_rows is not None:
+        idx = query_rows
+    elif label is None:
         idx = list(range(label_tsv.num_rows()))
     else:
         assert label in inverted
         idx = inverted[label]
+    if conf_index is not None:
+        # keep the rows with a predicted box in the confidence range, found in
+        # the confidence index instead of parsing the predictions of every row
+        conf_rows = conf_index.rows_in_range(label if query_rows is None else None, min_conf, max_conf)
+        if query_rows is None and label is None:
+            idx = conf_rows
+        else:
+            idx = intersect_sorted(np.asarray(idx, dtype=np.int64), conf_rows)
+    if key_rows is not None:
+        # the rows with a matching key, found in the key index
+        if query_rows is None and label is None and conf_index is None:
+            idx = key_rows
+        else:
+            idx = intersect_sorted(np.asarray(idx, dtype=np.int64), key_rows)
     if len(idx) == 0:
         return
 
@@ -91,60 +412,88 @@ def retrieve_images(label_file, inverted, prediction_file, label, start_id, min_
                 r.get('conf', 1) <= max_conf]
         return rects
 
-    for i in idx[start_id:]:
-        row_label = label_tsv.seek(i)
-        key = row_label[0]
-        gt = TSVFile.parse_annotation(row_label[1])
-        gt['objects'] = filter_rects(gt['objects'], min_conf, max_conf)
-        pred = {'objects': []}
-        if prediction_tsv:
-            row_label = prediction_tsv.seek(i)
-            pred = TSVFile.parse_annotation(row_label[1])
-            pred['objects'] = filter_rects(pred['objects'], min_conf, max_conf)
-
-        yield (key, i, gt, pred)
-
-
-def view_image_js(request, data, subset, version, label, start_id, imKey=None, min_conf=None, max_image_shown=50):
+    # read the rows batch by batch, each with a few sequential reads
+    for batch_start in range(start_id, len(idx), batch_size):
+        batch = idx[batch_start:batch_start + batch_size]
+        rows_label = label_tsv.seek_many(batch, columns=[0, 1])
+        rows_pred = prediction_tsv.seek_many(batch, columns=[1]) if prediction_tsv else None
+        for j, i in enumerate(batch):
+            key = rows_label[j][0]
+            gt = TSVFile.parse_annotation(rows_label[j][1])
+            gt['objects'] = filter_rects(gt['objects'], min_conf, max_conf)
+            pred = {'objects': []}
+            if prediction_tsv:
+                pred = TSVFile.parse_annotation(rows_pred[j][0])
+                pred['objects'] = filter_rects(pred['objects'], min_conf, max_conf)
+
+            yield (key, i, gt, pred)
+
+
+def view_image_js(request, data, subset, version, label, start_id, imKey=None, min_conf=None, max_image_shown=50,
+                  query=None, max_side=None, key_match='contains'):
     '''
     use js to render the box in the client side
     '''
     s = TSVSubset.from_name(op.join(get_data_root(), data), subset, version=version)
-    TSVFile.ensure_metainfo(s.tsv_file, label_file=s.label_file, prediction_file=s.prediction_file,
-        labelmap_file=s.labelmap_file, hw_file=s.hw_file)
-
-    inverted = cache.get('inverted_' + s.tsv_file + s.label_file)
-    if not inverted:
-        logging.info('loading inverted index')
-        inverted = TSVDataset.load_inverted_index(s.inverted_file, 
-            min_inverted_list_length=s.min_inverted_list_length,
-            max_inverted_rows=s.max_inverted_rows)
-        cache.set('inverted_' + s.tsv_file + s.label_file, inverted)
-
-    images = retrieve_images(s.label_file, inverted, s.prediction_file, label, start_id, min_conf=min_conf)
-
-    label_count = [('any', TSVFile(s.tsv_file).num_rows())]
-    for k, v in sorted(inverted.items(), key=lambda x: x[0]):
-        label_count.append((k, len(v)))
-
-    all_type_to_annotations, all_url, all_key = [], [], []
+    status = get_scheduler().ensure(s)
+    if status['state'] != 'done':
+        return render_building_index(request, data, [(s, status)], subset=subset, version=version)
+
+    inverted = get_inverted_index(s.inverted_file,
+        min_inverted_list_length=s.min_inverted_list_length,
+        max_inverted_rows=s.max_inverted_rows)
+
+    conf_index = None
+    if min_conf is not None and s.prediction_file is not None:
+        conf_index = get_conf_index(get_conf_index_file(s.prediction_file))
+
+    key_rows = None
+    if imKey is not None:
+        if key_match not in KEY_MATCHES:
+            return HttpResponseBadRequest('invalid key_match: {}'.format(key_match))
+        key_index = get_key_index(get_key_index_file(s.label_file))
+        key_rows = getattr(key_index, key_match)(imKey)
+
+    # the query is run before the rows are read, so that only its own errors are a bad request
+    query_rows = None
+    if query is not None:
+        try:
+            query_rows = run_label_query(query, inverted, get_tsv_file(s.label_file).num_rows())
+        except LabelQueryError as e:
+            return HttpResponseBadRequest(str(e))
+
+    images = retrieve_images(s.label_file, inverted, s.prediction_file, label, start_id,
+                             min_conf=-float('inf') if min_conf is None else min_conf,
+                             query_rows=query_rows, conf_index=conf_index, key_rows=key_rows)
+
+    tsv = get_tsv_file(s.tsv_file)
+    label_count = [('any', tsv.num_rows())]
+    label_count.extend(sorted(inverted.label_counts(), key=lambda x: x[0]))
+
+    all_type_to_annotations, all_url, all_key, all_idx = [], [], [], []
     for key, idx, gt, pred in images:
-        if imKey is None or imKey in key:
-            all_key.append(key)
-            all_url.append(reverse('detection:showimage') + \
-                '?data={}&subset={}&version={}&imgidx={}&key={}'.format(data, subset, version, idx, key))
-            all_type_to_annotations.append({'gt': gt, 'pred': pred})
+        all_key.append(key)
+        all_idx.append(idx)
+        all_url.append(reverse('detection:showimage') + \
+            '?data={}&subset={}&version={}&imgidx={}&key={}'.format(data, subset, version, idx, key) + \
+            ('&max_side={}'.format(max_side) if max_side else ''))
+        all_type_to_annotations.append({'gt': gt, 'pred': pred})
         if len(all_key) >= max_image_shown:
             break
 
     def nav_link(start_id):
         kwargs = copy.deepcopy(request.GET)
         kwargs['start_id'] = str(start_id)
-        return reverse('detection:viewimages') + '?' + \
-            '&'.join(['{}={}'.format(k, kwargs[k]) for k in kwargs])
+        return reverse('detection:viewimages') + '?' + kwargs.urlencode()
+
+    # the grid loads all of its images at once
+    batch_url = reverse('detection:showimages') + '?data={}&subset={}&version={}&imgidx={}'.format(
+        data, subset, version, ','.join(str(i) for i in all_idx)) + \
+        ('&max_side={}'.format(max_side) if max_side else '')
 
     context = {'all_type_to_annotations': json.dumps(all_type_to_annotations),
                'all_url': json.dumps(all_url),
+               'batch_url': batch_url if len(all_idx) > 0 else '',
                'all_key': json.dumps(all_key),
                'previous_link': nav_link(max(0, start_id - max_image_shown)),
                'next_link': nav_link(start_id + len(all_type_to_annotations)),
@@ -153,7 +502,7 @@ def view_image_js(request, data, subset, version, label, start_id, imKey=None, m
                }
 
     # precache to speedup show_image
-    cache.set(data+subset+str(version), TSVFile(s.tsv_file))
+    cache.set(data+subset+str(version), s.tsv_file)
     return render(request, 'detection/images_js2.html', context)
 
 
@@ -172,11 +521,24 @@ def view_images(request):
         type(version) is unicode else version
 
     min_conf = request.GET.get('min_conf')
-    min_conf = -1 if min_conf is None else float(min_conf)
+    min_conf = None if min_conf is None else float(min_conf)
 
     label = request.GET.get('label')
+    query = request.GET.get('query')
+    if query is not None and query.strip() == '':
+        query = None
     start_id = request.GET.get('start_id')
     start_id = int(float(start_id))
-    start_id = start_id if key is None else 0
+    # the key filter selects the rows with the key index, so it is paged like a label
+    key_match = request.GET.get('key_match', 'contains')
+
+    max_side = int(request.GET.get('max_side', settings.GRID_MAX_SIDE))
+
+    return view_image_js(request, data, subset, version, label, start_id, key, min_conf, query=query,
+                         max_side=max_side, key_match=key_match)
+
 
-    return view_image_js(request, data, subset, version, label, start_id, key, min_conf)
+async def view_images_async(request):
+    """ The async version of view_images, run on the bounded pool of the async reader.
+    """
+    return await get_async_reader().run(view_images, request)
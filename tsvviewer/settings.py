@@ -119,3 +119,26 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Thumbnails of the image grid, resized to GRID_MAX_SIDE pixels (0 for the
+# original images) and cached in THUMBNAIL_CACHE_DIR up to THUMBNAIL_CACHE_BYTES
+
+GRID_MAX_SIDE = 512
+
+THUMBNAIL_CACHE_DIR = os.path.join(BASE_DIR, 'data', '.thumbnails')
+
+THUMBNAIL_CACHE_BYTES = 8 << 30
+
+
+# Browsers keep the images for IMAGE_CACHE_MAX_AGE seconds before revalidating
+# them, so a rewritten tsv may show its old images until then
+
+IMAGE_CACHE_MAX_AGE = 30 * 24 * 3600
+
+
+# Serve the images and the image grid with async views, for an ASGI server
+# (e.g. uvicorn tsvviewer.asgi:application), where they read the tsv files on
+# a bounded pool of threads instead of holding one thread per request
+
+ASYNC_VIEWS = os.environ.get('TSVVIEWER_ASYNC_VIEWS', '0') == '1'
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import os.path as op
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.reader_registry import get_tsv_file
+
+
+class AsyncRowReader(object):
+    """ Read tsv rows for async views on a bounded pool of threads.
+        Concurrent requests for the same tsv and columns are queued, and one
+        job reads all the queued rows with a single seek_many, so a page of
+        image requests becomes a few sequential reads. At most max_pending
+        requests are queued or being read, later ones wait for a slot.
+        The reader only uses thread-safe futures, so it can be shared by the
+        event loops of several threads.
+    """
+    def __init__(self, max_workers=4, max_pending=256):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._num_pending = 0
+        self._waiters = deque()
+
+    def __acquire(self):
+        slot = Future()
+        with self._lock:
+            if self._num_pending < self.max_pending:
+                self._num_pending += 1
+                slot.set_result(None)
+            else:
+                self._waiters.append(slot)
+        return slot
+
+    def __release(self):
+        with self._lock:
+            # hand the slot over to the oldest waiting request
+            while len(self._waiters) > 0:
+                slot = self._waiters.popleft()
+                if slot.set_running_or_notify_cancel():
+                    slot.set_result(None)
+                    return
+            self._num_pending -= 1
+
+    def __read_queued(self, key):
+        with self._lock:
+            requests = self._queues.pop(key)
+        tsv_file, columns, as_bytes = key
+        indices = [idx for idx, _ in requests]
+        try:
+            rows = get_tsv_file(tsv_file).seek_many(indices, columns=columns, as_bytes=as_bytes)
+        except Exception as e:
+            # fail the requests one by one, so that a bad index only fails its request
+            logging.debug('coalesced read of {} failed: {}'.format(tsv_file, e))
+            for idx, future in requests:
+                try:
+                    future.set_result(get_tsv_file(tsv_file).seek_many(
+                        [idx], columns=columns, as_bytes=as_bytes)[0])
+                except Exception as e:
+                    future.set_exception(e)
+            return
+        for (_, future), row in zip(requests, rows):
+            future.set_result(row)
+
+    def submit(self, tsv_file, idx, columns=None, as_bytes=False):
+        """ Queue the read of a row and return a concurrent future of it.
+        """
+        key = (tsv_file, None if columns is None else tuple(columns), as_bytes)
+        future = Future()
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = []
+                self._executor.submit(self.__read_queued, key)
+            queue.append((idx, future))
+        return future
+
+    async def read_row(self, tsv_file, idx, columns=None, as_bytes=False):
+        """ Read a row like TSVFile.seek_many, together with the concurrent reads of the same tsv.
+        """
+        slot = self.__acquire()
+        try:
+            await asyncio.wrap_future(slot)
+        except asyncio.CancelledError:
+            # the slot may have been handed over just before the cancellation
+            if not slot.cancelled():
+                self.__release()
+            raise
+        try:
+            return await asyncio.wrap_future(self.submit(tsv_file, idx, columns=columns, as_bytes=as_bytes))
+        finally:
+            self.__release()
+
+    async def run(self, func, *args, **kwargs):
+        """ Run a blocking function on the pool of the reader.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+
+
+_reader = None
+_reader_lock = threading.Lock()
+
+
+def get_async_reader():
+    global _reader
+    with _reader_lock:
+        if _reader is None:
+            _reader = AsyncRowReader()
+        return _reader
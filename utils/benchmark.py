@@ -0,0 +1,272 @@
+import os
+import os.path as op
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import multiprocessing
+import numpy as np
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.file_io import generate_lineidx, load_lineidx
+from utils.tsv_file import TSVFile
+from utils.tsv_dataset import TSVSubset, TSVDataset
+
+
+# The benchmarks time the readers of a subset of a dataset with a warm page
+# cache. Each result is a summary of the times of repeated runs, and the
+# results of a run are saved as json with the configuration of the run, so that
+# two runs can be compared with --compare.
+
+
+def summarize(times, num_items=1):
+    """ Return a summary of a list of times in seconds, of num_items each.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    return {
+        'runs': len(times),
+        'items': len(times) * num_items,
+        'total_s': float(times.sum()),
+        'mean_ms': 1000 * float(times.mean()),
+        'median_ms': 1000 * float(np.median(times)),
+        'p95_ms': 1000 * float(np.percentile(times, 95)),
+        'max_ms': 1000 * float(times.max()),
+        'items_per_s': len(times) * num_items / max(float(times.sum()), 1e-9),
+    }
+
+
+def time_runs(fn, args_list, num_items=1):
+    """ Call fn on each args of args_list and return the summary of the times.
+    """
+    times = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return summarize(times, num_items=num_items)
+
+
+def bench_seek(tsv_file, num_seeks, batch_size, rng):
+    """ Time random and sequential seeks of rows, reading their image column.
+    """
+    tsv = TSVFile(tsv_file)
+    num_rows = tsv.num_rows()
+
+    def seek(i):
+        return len(tsv.seek(i).get_bytes(-1))
+
+    def seek_many(indices):
+        return sum(len(r[1]) for r in tsv.seek_many(indices, columns=[0, -1], as_bytes=True))
+
+    random_rows = rng.randint(num_rows, size=num_seeks)
+    first = rng.randint(max(1, num_rows - num_seeks))
+    batches = [(rng.randint(num_rows, size=batch_size),) for _ in range(max(1, num_seeks // batch_size))]
+    return {
+        'seek_random': time_runs(seek, [(int(i),) for i in random_rows]),
+        'seek_sequential': time_runs(seek, [(i % num_rows,) for i in range(first, first + num_seeks)]),
+        'seek_many_random': time_runs(seek_many, batches, num_items=batch_size),
+    }
+
+
+def bench_index(tsv_file, work_dir, repeat):
+    """ Time the generation of the lineidx of a tsv in work_dir, and the load of its lineidx.
+    """
+    lineidx_file = op.join(work_dir, 'bench.lineidx.bin')
+    results = {'generate_lineidx': time_runs(
+        lambda: generate_lineidx(tsv_file, lineidx_file, replace_existing=True), [()] * repeat)}
+
+    def load():
+        return len(load_lineidx(lineidx_file))
+
+    def open_tsv():
+        return TSVFile(tsv_file).num_rows()
+
+    results['load_lineidx'] = time_runs(load, [()] * repeat)
+    results['open_tsv'] = time_runs(open_tsv, [()] * repeat)
+    return results
+
+
+def bench_metainfo(subset, work_dir, num_workers=None):
+    """ Time the build of the metainfo of a subset, for links to its tsv and
+        prediction files in work_dir, so that the dataset is left untouched.
+    """
+    tsv_file = op.join(work_dir, 'bench.tsv')
+    os.symlink(op.abspath(subset.tsv_file), tsv_file)
+    prediction_file = None
+    if subset.prediction_file is not None:
+        prediction_file = op.join(work_dir, 'bench.prediction.tsv')
+        os.symlink(op.abspath(subset.prediction_file), prediction_file)
+    results = {
+        'ensure_metainfo': time_runs(lambda: TSVFile.ensure_metainfo(
+            tsv_file, prediction_file=prediction_file, num_workers=num_workers), [()]),
+        'is_metainfo_ready': time_runs(lambda: TSVFile.is_metainfo_ready(
+            tsv_file, prediction_file=prediction_file), [()] * 100),
+    }
+    return results
+
+
+def bench_inverted(subset, repeat):
+    """ Time the load of the inverted index of a subset and the lookup of the rows of all its labels.
+    """
+    def load():
+        return TSVDataset.load_inverted_index(subset.inverted_file).label_counts()
+
+    def lookup(inverted):
+        return sum(len(inverted[l]) for l in inverted.keys())
+
+    inverted = TSVDataset.load_inverted_index(subset.inverted_file)
+    return {
+        'load_inverted_index': time_runs(load, [()] * repeat),
+        'inverted_lookup_all': time_runs(lookup, [(inverted,)] * repeat, num_items=len(inverted)),
+    }
+
+
+def bench_requests(data_dir, subset, num_requests, rng):
+    """ Time the requests of the images and of the image grid of a subset
+        through the Django test client, with the thumbnails cached in a
+        temporary folder.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tsvviewer.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.test import Client
+
+    thumbnail_dir = tempfile.mkdtemp(prefix='tsvviewer-bench-thumbnails-')
+    settings.THUMBNAIL_CACHE_DIR = thumbnail_dir
+    client = Client()
+    s = TSVSubset.from_name(data_dir, subset)
+    num_rows = TSVFile(s.tsv_file).num_rows()
+    labels = [l for l, _ in TSVDataset.load_inverted_index(s.inverted_file).label_counts()]
+    base = 'data={}&subset={}&version=0'.format(op.basename(op.normpath(data_dir)), subset)
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, '{} returned {}'.format(url, response.status_code)
+        if response.streaming:
+            b''.join(response.streaming_content)
+
+    image_urls = [('/image?{}&imgidx={}'.format(base, i),) for i in rng.randint(num_rows, size=num_requests)]
+    grid_urls = [('/detection/viewimages?{}&start_id=0{}'.format(
+        base, '&label={}'.format(rng.choice(labels)) if labels and i % 2 else ''),)
+        for i in range(num_requests)]
+    # the grid loads its thumbnails in one request, the first pass makes them
+    # and the second one reads them from the cache
+    batch_urls = [('/images?{}&max_side={}&imgidx={}'.format(base, settings.GRID_MAX_SIDE, ','.join(
+        str(i) for i in rng.randint(num_rows, size=50))),) for _ in range(num_requests)]
+    try:
+        get(grid_urls[0][0])
+        return {
+            'request_show_image': time_runs(get, image_urls),
+            'request_view_images': time_runs(get, grid_urls),
+            'request_show_images_cold': time_runs(get, batch_urls, num_items=50),
+            'request_show_images_warm': time_runs(get, batch_urls, num_items=50),
+        }
+    finally:
+        shutil.rmtree(thumbnail_dir, ignore_errors=True)
+
+
+def run_benchmarks(data_dir, subset_name='train', num_seeks=1000, batch_size=50, repeat=10,
+                   num_requests=50, num_workers=None, seed=0, skip=()):
+    """ Run the benchmarks of a subset of a dataset and return the results
+        with the configuration of the run. The names of the groups of
+        benchmarks in skip, among index, seek, metainfo, inverted and
+        requests, are skipped.
+    """
+    subset = TSVSubset.from_name(data_dir, subset_name)
+    subset.write_composite_files()
+    TSVFile.ensure_metainfo(subset.tsv_file, label_file=subset.label_file,
+                            prediction_file=subset.prediction_file, labelmap_file=subset.labelmap_file,
+                            hw_file=subset.hw_file, num_workers=num_workers)
+    rng = np.random.RandomState(seed)
+    config = {
+        'data_dir': op.abspath(data_dir),
+        'subset': subset_name,
+        'num_rows': TSVFile(subset.tsv_file).num_rows(),
+        'tsv_size': op.getsize(subset.tsv_file),
+        'num_seeks': num_seeks, 'batch_size': batch_size, 'repeat': repeat,
+        'num_requests': num_requests, 'seed': seed,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+    }
+
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='tsvviewer-bench-')
+    try:
+        if 'index' not in skip:
+            results.update(bench_index(subset.tsv_file, work_dir, repeat))
+        if 'seek' not in skip:
+            results.update(bench_seek(subset.tsv_file, num_seeks, batch_size, rng))
+        if 'metainfo' not in skip:
+            results.update(bench_metainfo(subset, work_dir, num_workers=num_workers))
+        if 'inverted' not in skip:
+            results.update(bench_inverted(subset, repeat))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if 'requests' not in skip:
+        # the viewer reads the datasets of the data folder of the repository
+        data_root = op.join(op.dirname(op.dirname(op.realpath(__file__))), 'data')
+        data = op.basename(op.normpath(data_dir))
+        if op.isdir(op.join(data_root, data)) and op.samefile(op.join(data_root, data), data_dir):
+            results.update(bench_requests(data_dir, subset_name, num_requests, rng))
+        else:
+            logging.warning('skipping the requests, {} is not in {}'.format(data_dir, data_root))
+    return {'config': config, 'results': results}
+
+
+def compare_results(old, new, stat='median_ms'):
+    """ Return the lines of a table of a stat of two runs and their ratio.
+    """
+    lines = ['{:<28} {:>12} {:>12} {:>8}'.format('benchmark', 'old', 'new', 'new/old')]
+    for name in sorted(set(old['results']) | set(new['results'])):
+        a = old['results'].get(name, {}).get(stat)
+        b = new['results'].get(name, {}).get(stat)
+        ratio = '{:.2f}'.format(b / a) if a and b is not None else '-'
+        lines.append('{:<28} {:>12} {:>12} {:>8}'.format(
+            name, '-' if a is None else '{:.3f}'.format(a), '-' if b is None else '{:.3f}'.format(b), ratio))
+    return lines
+
+
+if __name__ == "__main__":
+    import logger
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the readers of a subset of a dataset')
+    parser.add_argument('data_dir', action="store")
+    parser.add_argument('--subset', default='train', help='a single tsv subset name or a yaml file name')
+    parser.add_argument('--output', default=None, help='save the results as json')
+    parser.add_argument('--compare', default=None, help='the json results of a previous run to compare with')
+    parser.add_argument('--num_seeks', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--num_requests', type=int, default=50)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip', nargs='*', default=[],
+                        choices=['index', 'seek', 'metainfo', 'inverted', 'requests'])
+    args = parser.parse_args()
+
+    logger.init_logging()
+    run = run_benchmarks(args.data_dir, subset_name=args.subset, num_seeks=args.num_seeks,
+                         batch_size=args.batch_size, repeat=args.repeat, num_requests=args.num_requests,
+                         num_workers=args.num_workers, seed=args.seed, skip=args.skip)
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(run, fp, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as fp:
+            lines = compare_results(json.load(fp), run)
+    else:
+        lines = ['{:<28} {:>12} {:>12}'.format('benchmark', 'median_ms', 'items/s')]
+        lines += ['{:<28} {:>12.3f} {:>12.1f}'.format(name, r['median_ms'], r['items_per_s'])
+                  for name, r in sorted(run['results'].items())]
+    print('\n'.join(lines))
@@ -0,0 +1,239 @@
+import os
+import zlib
+import gzip
+import struct
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+# A BGZF file is a series of gzip members, each holding at most 64KB of data
+# and its compressed size in a 'BC' extra field, so that it can be read
+# without decompressing the members before it. A position in the data is a
+# virtual offset: the offset of its block in the file shifted by 16 bits, or'ed
+# with the offset in the decompressed block. The file ends with an empty block.
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# the size of the data of a block, small enough for any offset in a block to fit in 16 bits
+BGZF_BLOCK_SIZE = 0xff00
+MAX_BLOCK_SIZE = 1 << 16
+
+
+def is_bgzf_file(path):
+    with open(path, 'rb') as fp:
+        header = fp.read(BGZF_HEADER.size)
+    return len(header) == BGZF_HEADER.size and header[:4] == BGZF_MAGIC and header[12:14] == b'BC'
+
+
+def open_tsv(path, mode='rb'):
+    """ Open a tsv for sequential reading, decompressing it if it is a BGZF file.
+    """
+    if is_bgzf_file(path):
+        return gzip.open(path, mode if 'b' in mode else mode.replace('r', 'rt'))
+    return open(path, mode)
+
+
+def make_virtual_offset(block_offset, in_block):
+    return (block_offset << 16) | in_block
+
+
+def split_virtual_offset(offset):
+    return offset >> 16, offset & 0xffff
+
+
+class BGZFWriter(object):
+    """ Write a BGZF file, compressing the data one block at a time.
+    """
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        self._fp = open(path, 'wb')
+        self._block_offset = 0
+        self._buffer = bytearray()
+
+    def tell(self):
+        """ Return the virtual offset of the next byte written.
+        """
+        return make_virtual_offset(self._block_offset, len(self._buffer))
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self.__write_block(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+
+    def __write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        block_size = BGZF_HEADER.size + len(cdata) + 8
+        header = BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1)
+        self._fp.write(header + cdata + struct.pack('<II', zlib.crc32(data), len(data)))
+        self._block_offset += block_size
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            self.__write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self._fp.write(BGZF_EOF)
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BGZFReader(object):
+    """ Random access to the data of a BGZF file by virtual offsets.
+        The last cache_blocks decompressed blocks are kept in an LRU cache, so
+        that reading rows close to each other decompresses each block once.
+        The reader can be shared by threads.
+    """
+    def __init__(self, path, cache_blocks=64):
+        self.path = path
+        self.cache_blocks = cache_blocks
+        self._fp = open(path, 'rb')
+        self.size = os.fstat(self._fp.fileno()).st_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._fp.close()
+
+    def __pread(self, size, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(self._fp.fileno(), size, offset)
+        with self._lock:
+            self._fp.seek(offset)
+            return self._fp.read(size)
+
+    def read_block(self, block_offset):
+        """ Return the decompressed data of the block at block_offset and the
+            offset of the next block, or empty data at the end of the file.
+        """
+        with self._lock:
+            entry = self._cache.get(block_offset)
+            if entry is not None:
+                self._cache.move_to_end(block_offset)
+                return entry
+        if block_offset >= self.size:
+            return b'', block_offset
+        raw = self.__pread(MAX_BLOCK_SIZE, block_offset)
+        if len(raw) < BGZF_HEADER.size or raw[:4] != BGZF_MAGIC or raw[12:14] != b'BC':
+            raise ValueError('{} has no BGZF block at {}'.format(self.path, block_offset))
+        block_size = BGZF_HEADER.unpack(raw[:BGZF_HEADER.size])[-1] + 1
+        data = zlib.decompress(raw[BGZF_HEADER.size:block_size - 8], -15)
+        entry = (data, block_offset + block_size)
+        with self._lock:
+            self._cache[block_offset] = entry
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return entry
+
+    def read(self, start, end=None):
+        """ Return the data between the virtual offsets start and end, or up
+            to the end of the file if end is None.
+        """
+        block_offset, pos = split_virtual_offset(start)
+        end_block, end_pos = split_virtual_offset(end) if end is not None else (self.size, 0)
+        parts = []
+        while block_offset < self.size and (block_offset < end_block or
+                                            (block_offset == end_block and end_pos > 0)):
+            data, next_offset = self.read_block(block_offset)
+            parts.append(data[pos:end_pos] if block_offset == end_block else data[pos:])
+            block_offset, pos = next_offset, 0
+        return b''.join(parts)
+
+    def next_block(self, block_offset):
+        """ Return the offset of the block after the one at block_offset, from its header.
+        """
+        header = self.__pread(BGZF_HEADER.size, block_offset)
+        if len(header) < BGZF_HEADER.size or header[:4] != BGZF_MAGIC:
+            raise ValueError('{} has no BGZF block at {}'.format(self.path, block_offset))
+        return block_offset + BGZF_HEADER.unpack(header)[-1] + 1
+
+    def align_to_blocks(self, offsets):
+        """ Return the offset of the first block at or after each of the sorted offsets.
+        """
+        result, block_offset = [], 0
+        for offset in offsets:
+            while block_offset < min(offset, self.size):
+                block_offset = self.next_block(block_offset)
+            result.append(min(block_offset, self.size))
+        return result
+
+    def __is_end(self, block_offset):
+        # whether only empty blocks are left from block_offset
+        while block_offset < self.size:
+            data, block_offset = self.read_block(block_offset)
+            if len(data) > 0:
+                return False
+        return True
+
+    def find_row_starts(self, start, end):
+        """ Return the virtual offsets of the rows following a newline in the
+            blocks starting in [start, end), and the first row if start is 0.
+            A row following the last byte of a block starts at the end of
+            this block, so that each row belongs to one block.
+        """
+        offsets = [np.zeros(1, dtype='<u8')] if start == 0 and not self.__is_end(0) else []
+        block_offset = start
+        while block_offset < min(end, self.size):
+            data, next_offset = self.read_block(block_offset)
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n')) + 1
+            if len(newlines) > 0 and newlines[-1] == len(data) and self.__is_end(next_offset):
+                # no row after the newline at the end of the file
+                newlines = newlines[:-1]
+            offsets.append((newlines.astype('<u8') | np.uint64(block_offset << 16)).astype('<u8'))
+            block_offset = next_offset
+        if len(offsets) == 0:
+            return np.zeros(0, dtype='<u8')
+        return np.concatenate(offsets)
+
+    def iter_rows(self, start, end):
+        """ Yield the (virtual offset, line) of the rows found by find_row_starts(start, end).
+        """
+        starts = self.find_row_starts(start, end).tolist()
+        for i, row_start in enumerate(starts):
+            if i + 1 < len(starts):
+                yield row_start, self.read(row_start, starts[i + 1])
+                continue
+            # the last row ends at the next newline, which may be in a later block
+            block_offset, pos = split_virtual_offset(row_start)
+            parts = []
+            while block_offset < self.size:
+                data, block_offset = self.read_block(block_offset)
+                newline = data.find(b'\n', pos)
+                if newline >= 0:
+                    parts.append(data[pos:newline + 1])
+                    break
+                parts.append(data[pos:])
+                pos = 0
+            yield row_start, b''.join(parts)
+
+
+def compress_tsv(tsv_file, bgzf_file, level=6, chunk_size=16 << 20):
+    with open(tsv_file, 'rb') as fp, BGZFWriter(bgzf_file + '.tmp', level=level) as writer:
+        while True:
+            data = fp.read(chunk_size)
+            if not data:
+                break
+            writer.write(data)
+    os.replace(bgzf_file + '.tmp', bgzf_file)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compress a tsv to a seekable BGZF file')
+    parser.add_argument('tsv', action="store")
+    parser.add_argument('output', action="store")
+    parser.add_argument('--level', type=int, default=6)
+    args = parser.parse_args()
+
+    compress_tsv(args.tsv, args.output, level=args.level)
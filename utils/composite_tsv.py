@@ -0,0 +1,97 @@
+import os
+import os.path as op
+import glob
+import errno
+
+
+# A composite tsv is a text file presenting many shard tsv files as one tsv.
+# Its first line is a magic line, followed by the path of one shard per line,
+# relative to the folder of the composite file unless absolute. The rows of the
+# composite tsv are the rows of the shards in this order.
+COMPOSITE_MAGIC = b'#composite-tsv'
+
+
+def get_composite_file(yaml_file, key):
+    return op.splitext(yaml_file)[0] + '.{}.composite.tsv'.format(key)
+
+
+def is_composite_file(path):
+    try:
+        with open(path, 'rb') as fp:
+            return fp.readline(len(COMPOSITE_MAGIC) + 2).rstrip(b'\r\n') == COMPOSITE_MAGIC
+    except OSError:
+        return False
+
+
+def read_composite_file(path):
+    """ Return the paths of the shards of a composite tsv.
+    """
+    root = op.dirname(path)
+    with open(path, 'r') as fp:
+        lines = [l.rstrip('\r\n') for l in fp]
+    if len(lines) == 0 or lines[0].encode() != COMPOSITE_MAGIC:
+        raise ValueError("{} is not a composite tsv".format(path))
+    return [op.join(root, l) for l in lines[1:] if l.strip()]
+
+
+def get_composite_content(path, shards):
+    root = op.dirname(path) or '.'
+    return '\n'.join([COMPOSITE_MAGIC.decode()] + [op.relpath(s, root) for s in shards]) + '\n'
+
+
+def is_composite_file_outdated(path, shards):
+    """ Check whether a composite tsv is missing or lists other shards.
+    """
+    try:
+        with open(path, 'r') as fp:
+            return fp.read() != get_composite_content(path, shards)
+    except OSError:
+        return True
+
+
+def write_composite_file(path, shards):
+    """ Save the shards of a composite tsv, unless the file already lists them,
+        so that the modification time only changes with the shards.
+    """
+    if not is_composite_file_outdated(path, shards):
+        return
+    with open(path + '.tmp', 'w') as fp:
+        fp.write(get_composite_content(path, shards))
+    os.replace(path + '.tmp', path)
+
+
+def get_shard_files(path):
+    """ Return the shards of a composite tsv, or the tsv itself.
+    """
+    return read_composite_file(path) if is_composite_file(path) else [path]
+
+
+def get_tsv_mtime(path):
+    """ Return the latest modification time of a tsv and of its shards.
+    """
+    mtime = op.getmtime(path)
+    if is_composite_file(path):
+        mtime = max([mtime] + [op.getmtime(s) for s in read_composite_file(path)])
+    return mtime
+
+
+def find_shard_files(patterns, root):
+    """ Return the files matching a glob pattern or a list of them, relative to
+        root unless absolute, in sorted order within each pattern. The label
+        files extracted from the matches and composite files are skipped, so
+        that a pattern keeps its matches once the metainfo is built.
+    """
+    if not isinstance(patterns, (list, tuple)):
+        patterns = [patterns]
+    shards = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(op.join(root, pattern)))
+        if len(matches) == 0:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), op.join(root, pattern))
+        derived = set(op.splitext(m)[0] + '.label.tsv' for m in matches)
+        shards.extend(m for m in matches if m not in derived and not is_composite_file(m))
+    return shards
+
+
+def is_shard_pattern(fname):
+    return isinstance(fname, (list, tuple)) or (fname is not None and glob.has_magic(fname))
@@ -0,0 +1,138 @@
+import os
+import os.path as op
+import json
+import mmap
+import struct
+import numpy as np
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.mapped_index import MappedIndex
+
+
+# A binary confidence index of a prediction file has a fixed size header (magic,
+# number of labels, size of the label dictionary, number of rows of the indexed
+# prediction file, which is 0 in older files), followed by the
+# label names as a json list padded to 8 bytes (null standing for any label),
+# the number of rows (uint64) and the start of the entries (uint64) of each
+# label, and five arrays of one entry per (label, row): the row ids (uint32),
+# the max and min box confidences in the row (float32), the max confidences
+# sorted in ascending order (float32) and the positions of these sorted
+# confidences in the entries of the label (uint32).
+CONF_MAGIC = b'TSVCONF1'
+CONF_HEADER = struct.Struct('<8sQQQ')
+
+
+def get_conf_index_file(prediction_file):
+    return op.splitext(prediction_file)[0] + '.conf.bin'
+
+
+def write_conf_index(conf_file, label_confs, num_rows=0):
+    """ Write a dict of label (None for any label) to a tuple of arrays
+        (row ids, max confidences, min confidences) of the num_rows rows of a
+        prediction file as a binary confidence index.
+    """
+    items = sorted(label_confs.items(), key=lambda x: (x[0] is not None, x[0]))
+    names = json.dumps([x[0] for x in items]).encode()
+    names += b'\0' * (-len(names) % 8)
+    counts = np.asarray([len(x[1][0]) for x in items], dtype='<u8')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype('<u8')
+
+    sections = [[], [], [], [], []]
+    for _, (rows, max_conf, min_conf) in items:
+        order = np.argsort(max_conf, kind='stable')
+        sections[0].append(np.asarray(rows, dtype='<u4'))
+        sections[1].append(np.asarray(max_conf, dtype='<f4'))
+        sections[2].append(np.asarray(min_conf, dtype='<f4'))
+        sections[3].append(np.asarray(max_conf, dtype='<f4')[order])
+        sections[4].append(order.astype('<u4'))
+
+    with open(conf_file + '.tmp', 'wb') as fp:
+        fp.write(CONF_HEADER.pack(CONF_MAGIC, len(items), len(names), num_rows))
+        fp.write(names)
+        fp.write(counts.tobytes())
+        fp.write(starts.tobytes())
+        for section in sections:
+            for arr in section:
+                fp.write(arr.tobytes())
+    os.replace(conf_file + '.tmp', conf_file)
+
+
+class ConfIndex(MappedIndex):
+    """ A memory-mapped confidence index of a prediction file.
+        It finds the rows with a predicted box of a label (or of any label for
+        None) above a confidence with a binary search into the sorted max
+        confidences, without reading the predictions.
+    """
+    def __init__(self, conf_file):
+        self.conf_file = conf_file
+        self._mm = None
+        self.__ensure_loaded()
+
+    def __ensure_loaded(self):
+        if self._mm is not None:
+            return
+        with open(self.conf_file, 'rb') as fp:
+            header = fp.read(CONF_HEADER.size)
+            if len(header) != CONF_HEADER.size or header[:len(CONF_MAGIC)] != CONF_MAGIC:
+                raise ValueError("{} is not a binary confidence index".format(self.conf_file))
+            _, num_labels, names_size, num_rows = CONF_HEADER.unpack(header)
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = CONF_HEADER.size
+        names = json.loads(self._mm[offset:offset + names_size].rstrip(b'\0').decode())
+        offset += names_size
+        self._counts = np.frombuffer(self._mm, dtype='<u8', count=num_labels, offset=offset)
+        offset += 8 * num_labels
+        self._starts = np.frombuffer(self._mm, dtype='<u8', count=num_labels, offset=offset)
+        offset += 8 * num_labels
+        total = int(self._counts.sum())
+        arrays = []
+        for dtype in ['<u4', '<f4', '<f4', '<f4', '<u4']:
+            arrays.append(np.frombuffer(self._mm, dtype=dtype, count=total, offset=offset))
+            offset += 4 * total
+        self._rows, self._max_conf, self._min_conf, self._sorted_conf, self._order = arrays
+        self._label_to_pos = {label: i for i, label in enumerate(names)}
+        self._num_rows = num_rows
+
+    def __contains__(self, label):
+        self.__ensure_loaded()
+        return label in self._label_to_pos
+
+    def __segment(self, label):
+        i = self._label_to_pos[label]
+        start = int(self._starts[i])
+        return slice(start, start + int(self._counts[i]))
+
+    def num_rows(self):
+        """ Return the number of rows of the indexed prediction file, or 0 if unknown.
+        """
+        self.__ensure_loaded()
+        return self._num_rows
+
+    def items(self):
+        """ Yield the (label, (row ids, max confidences, min confidences)) of each label.
+        """
+        self.__ensure_loaded()
+        for label in self._label_to_pos:
+            seg = self.__segment(label)
+            yield label, (self._rows[seg], self._max_conf[seg], self._min_conf[seg])
+
+    def __num_below(self, seg, min_conf):
+        # compare in float32 as stored, so that e.g. 0.9 is not above itself
+        return int(np.searchsorted(self._sorted_conf[seg], np.float32(min_conf), side='left'))
+
+    def rows_in_range(self, label, min_conf, max_conf=float('inf')):
+        """ Return the sorted rows with a box of label whose confidence may be
+            in [min_conf, max_conf], i.e. whose max confidence is at least
+            min_conf and whose min confidence is at most max_conf.
+        """
+        self.__ensure_loaded()
+        if label not in self._label_to_pos:
+            return np.zeros(0, dtype=np.int64)
+        seg = self.__segment(label)
+        positions = self._order[seg][self.__num_below(seg, min_conf):]
+        if max_conf < float('inf'):
+            positions = positions[self._min_conf[seg][positions] <= np.float32(max_conf)]
+        return np.sort(self._rows[seg][positions].astype(np.int64))
@@ -3,9 +3,29 @@ import os.path as op
 import logging
 import yaml
 import errno
+import zlib
+import struct
+import multiprocessing
+import numpy as np
 from tqdm import tqdm
 from collections import OrderedDict
 
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.bgzf import is_bgzf_file, BGZFReader
+
+
+# A binary lineidx file starts with a fixed size header (magic, number of rows,
+# size in bytes of the indexed tsv, checksum of the tail of the indexed tsv)
+# followed by one little-endian uint64 offset per row, so that it can be
+# memory-mapped as a numpy array. The checksum is the crc32 of the last
+# TAIL_SIZE indexed bytes with bit 32 set, older files have 0 instead.
+LINEIDX_MAGIC = b'TSVLIDX1'
+LINEIDX_HEADER = struct.Struct('<8sQQQ')
+TAIL_SIZE = 65536
+
 
 def list_all_data(data_dir):
     return sorted([d for d in os.listdir(data_dir) if not d.startswith('.')])
@@ -26,27 +46,264 @@ def write_to_file(contxt, file_name):
         fp.write(contxt)
 
 
-def generate_lineidx(filein, idxout=None, replace_existing=False):
+def get_lineidx_file(tsv_file):
+    return op.splitext(tsv_file)[0] + '.lineidx.bin'
+
+
+def get_legacy_lineidx_file(tsv_file):
+    return op.splitext(tsv_file)[0] + '.lineidx'
+
+
+class LineidxWriter(object):
+    """ Write row offsets to a binary lineidx file.
+        Offsets are buffered and written to a temporary file, which is renamed
+        to the final file with the header filled in when closed.
+    """
+    def __init__(self, idxout, buffer_size=65536):
+        self.idxout = idxout
+        self.num_rows = 0
+        self._buffer = []
+        self._buffer_size = buffer_size
+        self._fp = open(idxout + '.tmp', 'wb')
+        self._fp.write(b'\0' * LINEIDX_HEADER.size)
+
+    def append(self, offset):
+        self._buffer.append(offset)
+        if len(self._buffer) >= self._buffer_size:
+            self.__flush()
+
+    def extend(self, offsets):
+        self.__flush()
+        self.__write(np.asarray(offsets, dtype='<u8'))
+
+    def __flush(self):
+        if self._buffer:
+            self.__write(np.asarray(self._buffer, dtype='<u8'))
+            self._buffer = []
+
+    def __write(self, arr):
+        self._fp.write(arr.tobytes())
+        self.num_rows += len(arr)
+
+    def close(self, data_size, checksum=0):
+        self.__flush()
+        self._fp.seek(0)
+        self._fp.write(LINEIDX_HEADER.pack(LINEIDX_MAGIC, self.num_rows, data_size, checksum))
+        self._fp.close()
+        os.replace(self.idxout + '.tmp', self.idxout)
+
+    def discard(self):
+        self._fp.close()
+        os.remove(self.idxout + '.tmp')
+
+
+def read_lineidx_header(idx_file):
+    """ Return (num_rows, data_size) stored in a binary lineidx file.
+    """
+    with open(idx_file, 'rb') as fp:
+        header = fp.read(LINEIDX_HEADER.size)
+    if len(header) != LINEIDX_HEADER.size or header[:len(LINEIDX_MAGIC)] != LINEIDX_MAGIC:
+        raise ValueError("{} is not a binary lineidx file".format(idx_file))
+    _, num_rows, data_size, _ = LINEIDX_HEADER.unpack(header)
+    return num_rows, data_size
+
+
+def get_tail_checksum(filein, data_size):
+    """ Return the checksum of the last TAIL_SIZE bytes of the first data_size bytes of a file.
+        Raise a ValueError if the file is shorter, e.g. truncated while it is indexed.
+    """
+    start = max(0, data_size - TAIL_SIZE)
+    with open(filein, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(data_size - start)
+    if len(data) < data_size - start:
+        raise ValueError("{} is shorter than {} bytes".format(filein, data_size))
+    return (1 << 32) | zlib.crc32(data)
+
+
+def get_appended_size(filein, idx_file):
+    """ Return the size of the tsv indexed by a binary lineidx if the tsv was
+        only appended to since, i.e. its indexed bytes end with a newline and
+        their tail is unchanged, or None if it was otherwise modified.
+    """
+    with open(idx_file, 'rb') as fp:
+        header = fp.read(LINEIDX_HEADER.size)
+    if len(header) != LINEIDX_HEADER.size or header[:len(LINEIDX_MAGIC)] != LINEIDX_MAGIC:
+        return None
+    _, _, data_size, checksum = LINEIDX_HEADER.unpack(header)
+    if checksum >> 32 != 1 or data_size > op.getsize(filein) or is_bgzf_file(filein):
+        return None
+    if data_size > 0:
+        # a last row without a newline may have been continued by the append
+        with open(filein, 'rb') as fp:
+            fp.seek(data_size - 1)
+            if fp.read(1) != b'\n':
+                return None
+    try:
+        if get_tail_checksum(filein, data_size) != checksum:
+            return None
+    except ValueError:
+        # truncated since its size was checked
+        return None
+    return data_size
+
+
+def append_lineidx(idx_file, offsets, data_size, checksum):
+    """ Append row offsets to a binary lineidx file in place. The header is
+        written last, so that a reader mapping the file sees the old or the
+        new rows.
+    """
+    num_rows, _ = read_lineidx_header(idx_file)
+    offsets = np.asarray(offsets, dtype='<u8')
+    with open(idx_file, 'r+b') as fp:
+        fp.seek(LINEIDX_HEADER.size + 8 * num_rows)
+        fp.write(offsets.tobytes())
+        fp.truncate()
+        fp.flush()
+        fp.seek(0)
+        fp.write(LINEIDX_HEADER.pack(LINEIDX_MAGIC, num_rows + len(offsets), data_size, checksum))
+
+
+def load_lineidx(idx_file):
+    """ Memory-map a binary lineidx file as a read-only uint64 array.
+    """
+    num_rows, _ = read_lineidx_header(idx_file)
+    if num_rows == 0:
+        return np.zeros(0, dtype='<u8')
+    return np.memmap(idx_file, dtype='<u8', mode='r',
+                     offset=LINEIDX_HEADER.size, shape=(num_rows,))
+
+
+def load_legacy_lineidx(legacy_idx_file):
+    with open(legacy_idx_file, 'r') as fp:
+        return np.array(fp.read().split(), dtype='<u8')
+
+
+def convert_lineidx(legacy_idx_file, idxout, data_size):
+    """ Convert a legacy text lineidx file (one offset per line) to the binary format.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("converting legacy lineidx file {} to {}".format(legacy_idx_file, idxout))
+    writer = LineidxWriter(idxout)
+    with open(legacy_idx_file, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                writer.append(int(line))
+    writer.close(data_size)
+
+
+def find_row_starts(filein, start, end, read_size=16 << 20):
+    """ Return the offsets of the rows starting in the byte range [start, end).
+        A row starts at offset 0 and right after every newline.
+    """
+    offsets = [np.zeros(1, dtype='<u8')] if start == 0 else []
+    with open(filein, 'rb') as fp:
+        # a row starts at pos if the byte before it is a newline
+        pos = max(start - 1, 0)
+        fp.seek(pos)
+        while pos < end - 1:
+            buf = fp.read(min(read_size, end - 1 - pos))
+            if not buf:
+                break
+            newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == ord('\n'))
+            offsets.append((newlines + (pos + 1)).astype('<u8'))
+            pos += len(buf)
+    if len(offsets) == 0:
+        return np.zeros(0, dtype='<u8')
+    return np.concatenate(offsets)
+
+
+def _find_row_starts_in_range(args):
+    return find_row_starts(*args)
+
+
+def _find_bgzf_row_starts_in_range(args):
+    filein, start, end = args
+    reader = BGZFReader(filein)
+    try:
+        return reader.find_row_starts(start, end)
+    finally:
+        reader.close()
+
+
+def generate_lineidx(filein, idxout=None, replace_existing=False, chunk_size=64 << 20, num_workers=None):
+    """ Generate the binary lineidx file of a tsv.
+        The file is split into byte ranges of chunk_size, whose newlines are
+        searched in parallel by a pool of num_workers processes (all cpus by
+        default) and merged in order. The offsets of a BGZF compressed tsv are
+        virtual offsets, and its ranges are split at block boundaries.
+    """
     if not idxout:
-        idxout = op.splitext(filein)[0] + '.lineidx'
+        idxout = get_lineidx_file(filein)
     logger = logging.getLogger(__name__)
     if op.isfile(idxout) and not replace_existing:
         logger.info("{} file exist and return".format(idxout))
         return
     if op.isfile(idxout) and replace_existing:
         logger.info("overwrite lineidx file: {}".format(idxout))
-    with open(filein,'r') as fpin, open(idxout,'w') as fpout:
-        fsize = os.fstat(fpin.fileno()).st_size
-        def gen_rows():
-            fpos = 0
-            while fpos!=fsize:
-                yield str(fpos)
-                fpin.readline()
-                fpos = fpin.tell()
-        with tqdm(total=fsize) as t:
-            for row in gen_rows():
-                t.update(int(row) - t.n)
-                fpout.write(row+"\n")
+    fsize = op.getsize(filein)
+    writer = LineidxWriter(idxout)
+    for offsets in _iter_row_starts(filein, 0, fsize, chunk_size, num_workers):
+        writer.extend(offsets)
+    try:
+        checksum = get_tail_checksum(filein, fsize)
+    except ValueError:
+        writer.discard()
+        raise
+    writer.close(fsize, checksum)
+
+
+def update_lineidx(filein, idxout=None, chunk_size=64 << 20, num_workers=None):
+    """ Append the rows appended to a tsv since its binary lineidx was
+        generated to the lineidx, searching only the new bytes, and return the
+        number of rows before the append. Return None without changing the
+        lineidx if the tsv was otherwise modified.
+    """
+    if not idxout:
+        idxout = get_lineidx_file(filein)
+    if not op.isfile(idxout):
+        return None
+    start = get_appended_size(filein, idxout)
+    if start is None:
+        return None
+    num_rows, _ = read_lineidx_header(idxout)
+    fsize = op.getsize(filein)
+    logging.getLogger(__name__).info("appending {} bytes to lineidx file: {}".format(fsize - start, idxout))
+    offsets = list(_iter_row_starts(filein, start, fsize, chunk_size, num_workers))
+    try:
+        checksum = get_tail_checksum(filein, fsize)
+    except ValueError:
+        # truncated while the new rows were searched, the lineidx is left to a full rebuild
+        return None
+    append_lineidx(idxout, np.concatenate(offsets) if offsets else [], fsize, checksum)
+    return num_rows
+
+
+def _iter_row_starts(filein, start, fsize, chunk_size, num_workers):
+    # yield the offsets of the rows starting in [start, fsize), searched in
+    # byte ranges of chunk_size by a pool of num_workers processes, in order
+    bgzf = is_bgzf_file(filein)
+    starts = list(range(start, fsize, chunk_size))
+    if bgzf:
+        reader = BGZFReader(filein)
+        starts = sorted(set(x for x in reader.align_to_blocks(starts) if x < fsize))
+        reader.close()
+    ranges = [(filein, s, e) for s, e in zip(starts, starts[1:] + [fsize])]
+    find_in_range = _find_bgzf_row_starts_in_range if bgzf else _find_row_starts_in_range
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, len(ranges))
+
+    with tqdm(total=fsize - start, unit='B', unit_scale=True) as t:
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                for (_, s, e), offsets in zip(ranges, pool.imap(find_in_range, ranges)):
+                    yield offsets
+                    t.update(e - s)
+        else:
+            for r in ranges:
+                yield find_in_range(r)
+                t.update(r[2] - r[1])
 
 
 def load_labelmap_file(labelmap_file):
@@ -0,0 +1,44 @@
+import os
+import os.path as op
+import struct
+import numpy as np
+
+
+# A binary hw index of an image tsv has a fixed size header (magic, number of
+# rows, size in bytes of the indexed tsv, reserved) followed by the height and
+# width of the image of each row as little-endian int32 pairs, with -1 for an
+# image whose size is unknown, e.g. a url.
+HW_MAGIC = b'TSVHW001'
+HW_HEADER = struct.Struct('<8sQQQ')
+
+
+def get_hw_index_file(tsv_file):
+    return op.splitext(tsv_file)[0] + '.hw.bin'
+
+
+def is_hw_index_file(hw_file):
+    with open(hw_file, 'rb') as fp:
+        return fp.read(len(HW_MAGIC)) == HW_MAGIC
+
+
+def write_hw_index(hw_file, hw, data_size):
+    """ Write an (n, 2) array of image heights and widths as a binary hw index.
+    """
+    hw = np.asarray(hw, dtype='<i4').reshape(-1, 2)
+    with open(hw_file + '.tmp', 'wb') as fp:
+        fp.write(HW_HEADER.pack(HW_MAGIC, len(hw), data_size, 0))
+        fp.write(hw.tobytes())
+    os.replace(hw_file + '.tmp', hw_file)
+
+
+def load_hw_index(hw_file):
+    """ Memory-map a binary hw index as a read-only (n, 2) int32 array of heights and widths.
+    """
+    with open(hw_file, 'rb') as fp:
+        header = fp.read(HW_HEADER.size)
+    if len(header) != HW_HEADER.size or header[:len(HW_MAGIC)] != HW_MAGIC:
+        raise ValueError("{} is not a binary hw index".format(hw_file))
+    _, num_rows, _, _ = HW_HEADER.unpack(header)
+    if num_rows == 0:
+        return np.zeros((0, 2), dtype='<i4')
+    return np.memmap(hw_file, dtype='<i4', mode='r', offset=HW_HEADER.size, shape=(num_rows, 2))
@@ -1,13 +1,157 @@
 import numpy as np
+import os.path as op
 import base64
+import struct
 import cv2
 
 
-def img_from_base64(imagestring):
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR,
+                 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# start of frame markers of jpeg, which hold the size of the image
+JPEG_SOF_MARKERS = frozenset([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                              0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# an image column shorter than this may be the path of an image file
+MAX_PATH_LENGTH = 4096
+# the image is the last column of each row, to support the old format with multiple columns
+IMAGE_COLUMN = -1
+
+
+def get_image_source(col_image):
+    """ Return where the image of an image column (bytes or memoryview) is:
+        ('url', url), ('file', path) or ('base64', col_image) for an image
+        encoded in the column. col_image may be a prefix of the column of at
+        least MAX_PATH_LENGTH bytes.
+    """
+    if col_image[:4] == b'http':
+        return 'url', bytes(col_image).decode()
+    if len(col_image) < MAX_PATH_LENGTH:
+        path = bytes(col_image).decode(errors='replace')
+        if op.isfile(path):
+            return 'file', path
+    return 'base64', col_image
+
+
+def read_image_source(kind, source):
+    """ Return the encoded content of an image from get_image_source and
+        whether it is base64 encoded, or None if the image is a url.
+    """
+    if kind == 'url':
+        return None
+    if kind == 'file':
+        with open(source, 'rb') as fp:
+            return fp.read(), False
+    return source, True
+
+
+def read_image_column(col_image):
+    return read_image_source(*get_image_source(col_image))
+
+
+def img_from_base64(imagestring, reduce_factor=1):
     try:
         jpgbytestring = base64.b64decode(imagestring)
-        nparr = np.frombuffer(jpgbytestring, np.uint8)
-        r = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        return r
+        return img_from_bytes(jpgbytestring, reduce_factor=reduce_factor)
     except ValueError:
         return None
+
+
+def img_from_bytes(bytestring, reduce_factor=1):
+    """ Decode an image, at 1/2, 1/4 or 1/8 of its size with reduce_factor,
+        which jpeg decodes in the DCT domain without the full resolution.
+    """
+    nparr = np.frombuffer(bytestring, np.uint8)
+    r = cv2.imdecode(nparr, REDUCED_FLAGS[reduce_factor])
+    return r
+
+
+def get_reduce_factor(size, max_side):
+    """ Return the largest factor to decode an image of size (width, height)
+        so that its longer side is still at least max_side.
+    """
+    for factor in [8, 4, 2]:
+        if max(size) >= max_side * factor:
+            return factor
+    return 1
+
+
+def _get_exif_orientation(exif):
+    # exif is the content of an APP1 segment: Exif\0\0 and a tiff header
+    if exif[:6] != b'Exif\x00\x00' or len(exif) < 14:
+        return 1
+    tiff = exif[6:]
+    fmt = '<' if tiff[:2] == b'II' else '>'
+    ifd = struct.unpack(fmt + 'I', tiff[4:8])[0]
+    if ifd + 2 > len(tiff):
+        return 1
+    num_entries = struct.unpack(fmt + 'H', tiff[ifd:ifd + 2])[0]
+    for i in range(num_entries):
+        entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        if len(entry) < 12:
+            break
+        tag, _, _, value = struct.unpack(fmt + 'HHIH', entry[:10])
+        if tag == 0x0112:
+            return value
+    return 1
+
+
+def _get_jpeg_size(data):
+    pos, orientation = 2, 1
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a segment
+            pos += 2
+            continue
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if marker == 0xE1 and orientation == 1:
+            if pos + 2 + length > len(data):
+                return None
+            orientation = _get_exif_orientation(bytes(data[pos + 4:pos + 2 + length]))
+        elif marker in JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            # cv2 rotates the images with an exif orientation of 5 to 8 by 90 degrees
+            return (height, width) if orientation >= 5 else (width, height)
+        elif marker == 0xDA:
+            # start of scan without a frame
+            return None
+        pos += 2 + length
+    return None
+
+
+def img_size_from_bytes(bytestring):
+    """ Return the (width, height) of a jpeg or png image from its header,
+        without decoding it, or None if the header is not complete or is not
+        one of those formats. bytestring may only be the first bytes of the image.
+    """
+    if bytestring[:2] == b'\xff\xd8':
+        return _get_jpeg_size(bytestring)
+    if bytestring[:8] == PNG_SIGNATURE and len(bytestring) >= 24 and bytestring[12:16] == b'IHDR':
+        return struct.unpack('>II', bytestring[16:24])
+    return None
+
+
+def img_size_from_base64(imagestring, prefix_size=4096):
+    """ Return the (width, height) of a base64 encoded jpeg or png image,
+        decoding only as long a prefix of it as its header needs, or None.
+    """
+    while True:
+        try:
+            prefix = base64.b64decode(imagestring[:prefix_size])
+        except ValueError:
+            return None
+        size = img_size_from_bytes(prefix)
+        if size is not None or prefix_size >= len(imagestring):
+            return size
+        prefix_size *= 4
@@ -0,0 +1,144 @@
+import os
+import os.path as op
+import json
+import mmap
+import struct
+import logging
+import numpy as np
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.mapped_index import MappedIndex
+
+
+# A binary inverted file has a fixed size header (magic, number of labels, size
+# of the label dictionary, reserved), followed by the label names as a json list
+# padded to 8 bytes, the posting counts (uint64), the start of each posting list
+# (uint64, in number of entries) and the delta-encoded posting lists (uint32).
+# Labels are sorted by the length of their posting list in descending order.
+INVERTED_MAGIC = b'TSVINV01'
+INVERTED_HEADER = struct.Struct('<8sQQQ')
+
+
+def get_inverted_file(label_file):
+    return op.splitext(label_file)[0] + '.inverted.bin'
+
+
+def get_legacy_inverted_file(label_file):
+    return op.splitext(label_file)[0] + '.inverted.tsv'
+
+
+def write_inverted_index(inverted_file, inverted):
+    """ Write a dict of label to sorted row ids as a binary inverted file.
+    """
+    # sort inverted list by the length of each list, and lists of the same
+    # length by label, so that the order does not depend on the scan order
+    items = sorted(inverted.items(), key=lambda x: (-len(x[1]), x[0]))
+    names = json.dumps([x[0] for x in items]).encode()
+    names += b'\0' * (-len(names) % 8)
+    counts = np.asarray([len(x[1]) for x in items], dtype='<u8')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype('<u8')
+
+    with open(inverted_file + '.tmp', 'wb') as fp:
+        fp.write(INVERTED_HEADER.pack(INVERTED_MAGIC, len(items), len(names), 0))
+        fp.write(names)
+        fp.write(counts.tobytes())
+        fp.write(starts.tobytes())
+        for _, rows in items:
+            rows = np.asarray(rows, dtype=np.int64)
+            fp.write(np.diff(rows, prepend=0).astype('<u4').tobytes())
+    os.replace(inverted_file + '.tmp', inverted_file)
+
+
+def convert_inverted_index(legacy_inverted_file, inverted_file):
+    """ Convert a legacy text inverted file (label, space-separated row ids) to the binary format.
+    """
+    logging.info('converting legacy inverted file {} to {}'.format(legacy_inverted_file, inverted_file))
+    inverted = {}
+    with open(legacy_inverted_file, 'r') as fp:
+        for line in fp:
+            cols = [x.strip() for x in line.split('\t')]
+            inverted[cols[0]] = np.array(cols[1].split(), dtype=np.int64)
+    write_inverted_index(inverted_file, inverted)
+
+
+class InvertedIndex(MappedIndex):
+    """ A read-only, dict-like view of a binary inverted file.
+        The file is memory-mapped, the posting list of a label is only decoded
+        when it is accessed, and the counts are read without decoding any list.
+        Labels with fewer than min_inverted_list_length rows are skipped, and at
+        most max_inverted_rows labels are kept if it is not negative.
+    """
+    def __init__(self, inverted_file, min_inverted_list_length=0, max_inverted_rows=-1):
+        self.inverted_file = inverted_file
+        self.min_inverted_list_length = min_inverted_list_length
+        self.max_inverted_rows = max_inverted_rows
+        self._mm = None
+        self.__ensure_loaded()
+
+    def __ensure_loaded(self):
+        if self._mm is not None:
+            return
+        with open(self.inverted_file, 'rb') as fp:
+            header = fp.read(INVERTED_HEADER.size)
+            if len(header) != INVERTED_HEADER.size or header[:len(INVERTED_MAGIC)] != INVERTED_MAGIC:
+                raise ValueError("{} is not a binary inverted file".format(self.inverted_file))
+            _, num_labels, names_size, _ = INVERTED_HEADER.unpack(header)
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = INVERTED_HEADER.size
+        names = json.loads(self._mm[offset:offset + names_size].rstrip(b'\0').decode())
+        offset += names_size
+        self._counts = np.frombuffer(self._mm, dtype='<u8', count=num_labels, offset=offset)
+        offset += 8 * num_labels
+        self._starts = np.frombuffer(self._mm, dtype='<u8', count=num_labels, offset=offset)
+        offset += 8 * num_labels
+        self._postings = np.frombuffer(self._mm, dtype='<u4', offset=offset)
+
+        self._labels = []
+        for i, (label, count) in enumerate(zip(names, self._counts.tolist())):
+            if count < self.min_inverted_list_length:
+                continue
+            self._labels.append((label, i))
+            if self.max_inverted_rows >= 0 and len(self._labels) >= self.max_inverted_rows:
+                break
+        self._label_to_pos = dict(self._labels)
+
+    def __len__(self):
+        self.__ensure_loaded()
+        return len(self._labels)
+
+    def __contains__(self, label):
+        self.__ensure_loaded()
+        return label in self._label_to_pos
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, label):
+        """ Return the sorted row ids of a label as an int64 array.
+        """
+        self.__ensure_loaded()
+        i = self._label_to_pos[label]
+        start = int(self._starts[i])
+        deltas = self._postings[start:start + int(self._counts[i])]
+        return np.cumsum(deltas, dtype=np.int64)
+
+    def keys(self):
+        self.__ensure_loaded()
+        return [label for label, _ in self._labels]
+
+    def items(self):
+        for label in self.keys():
+            yield label, self[label]
+
+    def count(self, label):
+        self.__ensure_loaded()
+        return int(self._counts[self._label_to_pos[label]])
+
+    def label_counts(self):
+        """ Return a list of (label, number of rows) without decoding any posting list.
+        """
+        self.__ensure_loaded()
+        return [(label, int(self._counts[i])) for label, i in self._labels]
@@ -0,0 +1,215 @@
+import os
+import os.path as op
+import mmap
+import struct
+import numpy as np
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.mapped_index import MappedIndex
+
+
+# A binary key index of a tsv has a fixed size header (magic, number of rows,
+# size of the keys, number of trigrams), followed by the start of each key in
+# sorted order (uint64, one more than the number of rows), the start of the
+# posting list of each trigram (uint64, one more than the number of trigrams),
+# the utf-8 keys in sorted order concatenated and padded to 8 bytes, the row
+# of each sorted key (uint32), the sorted position of the key of each row
+# (uint32), the sorted trigrams of the keys as 24-bit integers (uint32) and the
+# posting lists of the rows whose key contains each trigram (uint32).
+KEY_MAGIC = b'TSVKEY01'
+KEY_HEADER = struct.Struct('<8sQQQ')
+GRAM_SIZE = 3
+
+
+def get_key_index_file(tsv_file):
+    return op.splitext(tsv_file)[0] + '.keys.bin'
+
+
+def get_key_grams(blob, starts, lengths, first_row):
+    """ Return the sorted unique (trigram, row) pairs of keys concatenated in
+        blob, as two uint32 arrays sorted by trigram and then row.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    num_grams = np.maximum(lengths - GRAM_SIZE + 1, 0)
+    if num_grams.sum() == 0:
+        return np.zeros(0, dtype='<u4'), np.zeros(0, dtype='<u4')
+    data = np.frombuffer(blob, dtype=np.uint8).astype(np.int64)
+    rows = np.repeat(np.arange(len(lengths), dtype=np.int64), num_grams)
+    # the position of each trigram in blob
+    first = np.repeat(np.asarray(starts, dtype=np.int64) - np.cumsum(num_grams) + num_grams, num_grams)
+    pos = first + np.arange(len(rows), dtype=np.int64)
+    codes = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+    pairs = np.sort((codes << 32) | (rows + first_row))
+    pairs = pairs[np.concatenate([[True], pairs[1:] != pairs[:-1]])]
+    return (pairs >> 32).astype('<u4'), (pairs & 0xFFFFFFFF).astype('<u4')
+
+
+def write_key_index(key_file, keys, chunk_size=1 << 20):
+    """ Write the keys (bytes) of the rows of a tsv, in row order, as a binary key index.
+    """
+    num_rows = len(keys)
+    order = np.argsort(np.asarray(keys, dtype=bytes), kind='stable') if num_rows > 0 else np.zeros(0, dtype=np.int64)
+    sorted_keys = [keys[i] for i in order]
+    lengths = np.asarray([len(k) for k in sorted_keys], dtype=np.int64)
+    key_starts = np.concatenate([[0], np.cumsum(lengths)]).astype('<u8')
+    blob = b''.join(sorted_keys)
+    positions = np.empty(num_rows, dtype='<u4')
+    positions[order] = np.arange(num_rows, dtype='<u4')
+
+    # collect the trigrams of the keys a chunk of rows at a time, each chunk
+    # sorted by trigram and row, so a stable sort by trigram keeps rows sorted
+    codes, rows = [], []
+    for start in range(0, num_rows, chunk_size):
+        chunk = keys[start:start + chunk_size]
+        chunk_lengths = [len(k) for k in chunk]
+        chunk_starts = np.concatenate([[0], np.cumsum(chunk_lengths)[:-1]])
+        c, r = get_key_grams(b''.join(chunk), chunk_starts, chunk_lengths, start)
+        codes.append(c)
+        rows.append(r)
+    codes = np.concatenate(codes) if codes else np.zeros(0, dtype='<u4')
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype='<u4')
+    gram_order = np.argsort(codes, kind='stable')
+    codes, postings = codes[gram_order], rows[gram_order]
+    # the codes are sorted, so each trigram starts where the code changes
+    firsts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]])) if len(codes) > 0 \
+        else np.zeros(0, dtype=np.int64)
+    grams = codes[firsts]
+    gram_starts = np.concatenate([firsts, [len(codes)]]).astype('<u8')
+
+    with open(key_file + '.tmp', 'wb') as fp:
+        fp.write(KEY_HEADER.pack(KEY_MAGIC, num_rows, len(blob), len(grams)))
+        fp.write(key_starts.tobytes())
+        fp.write(gram_starts.tobytes())
+        fp.write(blob + b'\0' * (-len(blob) % 8))
+        fp.write(order.astype('<u4').tobytes())
+        fp.write(positions.tobytes())
+        fp.write(grams.astype('<u4').tobytes())
+        fp.write(postings.astype('<u4').tobytes())
+    os.replace(key_file + '.tmp', key_file)
+
+
+class KeyIndex(MappedIndex):
+    """ A memory-mapped index of the image keys of a tsv.
+        Exact and prefix lookups are binary searches into the sorted keys, and
+        a substring lookup intersects the posting lists of the trigrams of the
+        substring, so that no row of the tsv is read. Lookups return the sorted
+        rows of the matching keys as an int64 array.
+    """
+    def __init__(self, key_file):
+        self.key_file = key_file
+        self._mm = None
+        self.__ensure_loaded()
+
+    def __ensure_loaded(self):
+        if self._mm is not None:
+            return
+        with open(self.key_file, 'rb') as fp:
+            header = fp.read(KEY_HEADER.size)
+            if len(header) != KEY_HEADER.size or header[:len(KEY_MAGIC)] != KEY_MAGIC:
+                raise ValueError("{} is not a binary key index".format(self.key_file))
+            _, num_rows, blob_size, num_grams = KEY_HEADER.unpack(header)
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = KEY_HEADER.size
+        self._key_starts = np.frombuffer(self._mm, dtype='<u8', count=num_rows + 1, offset=offset)
+        offset += 8 * (num_rows + 1)
+        self._gram_starts = np.frombuffer(self._mm, dtype='<u8', count=num_grams + 1, offset=offset)
+        offset += 8 * (num_grams + 1)
+        self._blob_offset = offset
+        offset += blob_size + (-blob_size % 8)
+        self._rows = np.frombuffer(self._mm, dtype='<u4', count=num_rows, offset=offset)
+        offset += 4 * num_rows
+        self._positions = np.frombuffer(self._mm, dtype='<u4', count=num_rows, offset=offset)
+        offset += 4 * num_rows
+        self._grams = np.frombuffer(self._mm, dtype='<u4', count=num_grams, offset=offset)
+        offset += 4 * num_grams
+        self._postings = np.frombuffer(self._mm, dtype='<u4', count=int(self._gram_starts[-1]), offset=offset)
+        self._num_rows = num_rows
+
+    def __len__(self):
+        self.__ensure_loaded()
+        return self._num_rows
+
+    def __sorted_key(self, i):
+        return self._mm[self._blob_offset + int(self._key_starts[i]):self._blob_offset + int(self._key_starts[i + 1])]
+
+    def __bisect(self, value, upper, length=None):
+        # the first sorted position whose key (cut to length) is above value,
+        # or not below value if upper is False
+        lo, hi = 0, self._num_rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = self.__sorted_key(mid)
+            if length is not None:
+                key = key[:length]
+            if key < value or (upper and key == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __rows_between(self, lo, hi):
+        return np.sort(self._rows[lo:hi].astype(np.int64))
+
+    def get_key(self, row):
+        self.__ensure_loaded()
+        return self.__sorted_key(int(self._positions[row])).decode('utf-8')
+
+    def exact(self, key):
+        """ Return the rows whose key is key.
+        """
+        self.__ensure_loaded()
+        key = key.encode('utf-8')
+        return self.__rows_between(self.__bisect(key, False), self.__bisect(key, True))
+
+    def prefix(self, prefix):
+        """ Return the rows whose key starts with prefix.
+        """
+        self.__ensure_loaded()
+        prefix = prefix.encode('utf-8')
+        return self.__rows_between(self.__bisect(prefix, False, len(prefix)),
+                                   self.__bisect(prefix, True, len(prefix)))
+
+    def __gram_rows(self, i):
+        return self._postings[int(self._gram_starts[i]):int(self._gram_starts[i + 1])]
+
+    def contains(self, sub):
+        """ Return the rows whose key contains sub.
+        """
+        self.__ensure_loaded()
+        sub = sub.encode('utf-8')
+        if len(sub) == 0:
+            return np.arange(self._num_rows, dtype=np.int64)
+        grams = self._grams.astype(np.int64)
+        if len(sub) < GRAM_SIZE:
+            # a trigram containing sub is found in its keys, only the keys
+            # shorter than a trigram are checked one by one
+            value = int.from_bytes(sub, 'big')
+            shift = 8 * (GRAM_SIZE - len(sub))
+            mask = (1 << (8 * len(sub))) - 1
+            match = np.zeros(len(grams), dtype=bool)
+            for s in range(0, shift + 1, 8):
+                match |= ((grams >> s) & mask) == value
+            rows = [self.__gram_rows(i) for i in np.flatnonzero(match)]
+            lengths = np.diff(self._key_starts.astype(np.int64))
+            short = np.flatnonzero(lengths < GRAM_SIZE)
+            rows.append(np.asarray([self._rows[i] for i in short if sub in self.__sorted_key(i)], dtype='<u4'))
+            return np.unique(np.concatenate(rows).astype(np.int64))
+
+        codes = set(int.from_bytes(sub[i:i + GRAM_SIZE], 'big') for i in range(len(sub) - GRAM_SIZE + 1))
+        pos = np.searchsorted(self._grams, np.asarray(sorted(codes), dtype='<u4'))
+        if np.any(pos >= len(grams)) or np.any(self._grams[np.minimum(pos, len(grams) - 1)] != sorted(codes)):
+            return np.zeros(0, dtype=np.int64)
+        # intersect the posting lists from the shortest one
+        lists = sorted((self.__gram_rows(i) for i in pos), key=len)
+        rows = lists[0]
+        for other in lists[1:]:
+            rows = rows[np.isin(rows, other, assume_unique=True)]
+        rows = rows.astype(np.int64)
+        if len(sub) > GRAM_SIZE:
+            # the trigrams of sub may be in a key without sub itself
+            rows = np.asarray([r for r in rows.tolist()
+                               if sub in self.__sorted_key(int(self._positions[r]))], dtype=np.int64)
+        return rows
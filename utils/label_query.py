@@ -0,0 +1,156 @@
+import re
+import numpy as np
+
+
+# a query combines labels with AND, OR and NOT (both unary and as a binary
+# difference, "a NOT b" being "a AND NOT b") and parentheses. AND and NOT bind
+# tighter than OR. Labels with spaces or keywords can be double-quoted.
+_TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+_KEYWORDS = ('AND', 'OR', 'NOT')
+
+
+class LabelQueryError(ValueError):
+    """ An invalid label query, or a query of a label which is not in the index.
+    """
+    pass
+
+
+def tokenize_label_query(query):
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        m = _TOKEN_PATTERN.match(query, pos)
+        if m is None:
+            raise LabelQueryError('invalid label query at: {}'.format(query[pos:]))
+        lparen, rparen, quoted, word = m.groups()
+        if lparen or rparen:
+            tokens.append(('op', lparen or rparen))
+        elif quoted is not None:
+            tokens.append(('label', quoted))
+        elif word.upper() in _KEYWORDS:
+            tokens.append(('op', word.upper()))
+        else:
+            tokens.append(('label', word))
+        pos = m.end()
+    return tokens
+
+
+def parse_label_query(query):
+    """ Parse a label query into a tree of ('label', name), ('not', node),
+        ('and', [nodes]) and ('or', [nodes]).
+    """
+    tokens = tokenize_label_query(query)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else (None, None)
+
+    def take():
+        pos[0] += 1
+        return tokens[pos[0] - 1]
+
+    def parse_or():
+        nodes = [parse_and()]
+        while peek() == ('op', 'OR'):
+            take()
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and():
+        nodes = [parse_not()]
+        while peek()[0] == 'label' or peek()[1] in ('AND', 'NOT', '('):
+            if peek() == ('op', 'AND'):
+                take()
+            # "a NOT b" and "a b" are handled as "a AND NOT b" and "a AND b"
+            nodes.append(parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not():
+        if peek() == ('op', 'NOT'):
+            take()
+            return ('not', parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        kind, value = take() if pos[0] < len(tokens) else (None, None)
+        if kind == 'label':
+            return ('label', value)
+        if (kind, value) == ('op', '('):
+            node = parse_or()
+            if peek() != ('op', ')'):
+                raise LabelQueryError('missing ")" in label query: {}'.format(query))
+            take()
+            return node
+        raise LabelQueryError('unexpected {} in label query: {}'.format(
+            value if value is not None else 'end', query))
+
+    if len(tokens) == 0:
+        raise LabelQueryError('empty label query')
+    node = parse_or()
+    if pos[0] != len(tokens):
+        raise LabelQueryError('unexpected {} in label query: {}'.format(tokens[pos[0]][1], query))
+    return node
+
+
+def intersect_sorted(a, b):
+    """ Intersect two sorted arrays of unique row ids.
+        Gallop with binary searches of the shorter array into the longer one
+        when their lengths are very different.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) == 0:
+        return a
+    if len(a) * 16 < len(b):
+        pos = np.minimum(np.searchsorted(b, a), len(b) - 1)
+        return a[b[pos] == a]
+    return np.intersect1d(a, b, assume_unique=True)
+
+
+def difference_sorted(a, b):
+    """ Return the row ids of the sorted array a which are not in the sorted array b.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return a
+    pos = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[pos] != a]
+
+
+def union_sorted(a, b):
+    return np.union1d(a, b)
+
+
+def evaluate_label_query(node, inverted, num_rows):
+    """ Return the sorted row ids matching a parsed query over an inverted index.
+        num_rows is the number of rows of the subset, the universe of unary NOT.
+    """
+    kind = node[0]
+    if kind == 'label':
+        if node[1] not in inverted:
+            raise LabelQueryError('unknown label in query: {}'.format(node[1]))
+        return np.asarray(inverted[node[1]], dtype=np.int64)
+    if kind == 'or':
+        result = evaluate_label_query(node[1][0], inverted, num_rows)
+        for x in node[1][1:]:
+            result = union_sorted(result, evaluate_label_query(x, inverted, num_rows))
+        return result
+    if kind == 'not':
+        return difference_sorted(np.arange(num_rows, dtype=np.int64),
+                                 evaluate_label_query(node[1], inverted, num_rows))
+    # and: intersect the positive operands from the shortest one, then remove the negated ones
+    positives = [evaluate_label_query(x, inverted, num_rows) for x in node[1] if x[0] != 'not']
+    negatives = [evaluate_label_query(x[1], inverted, num_rows) for x in node[1] if x[0] == 'not']
+    if len(positives) == 0:
+        positives = [np.arange(num_rows, dtype=np.int64)]
+    positives = sorted(positives, key=len)
+    result = positives[0]
+    for x in positives[1:]:
+        result = intersect_sorted(result, x)
+    for x in negatives:
+        result = difference_sorted(result, x)
+    return result
+
+
+def run_label_query(query, inverted, num_rows):
+    return evaluate_label_query(parse_label_query(query), inverted, num_rows)
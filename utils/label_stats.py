@@ -0,0 +1,94 @@
+import os
+import os.path as op
+import json
+import numpy as np
+
+
+# The statistics of a label file are saved as json next to it: the number of
+# rows, the (label, number of rows, number of boxes) of each label sorted by
+# the number of rows in descending order, and a histogram of the box sizes
+# (square root of the box area in pixels). The statistics of a prediction file
+# are saved next to its confidence index: its number of rows and boxes and a
+# histogram of the box confidences. Both are gathered while the label and the
+# prediction files are parsed for their indexes, and can be added up.
+BOX_SIZE_BINS = [0, 16, 32, 64, 96, 128, 256, 512, 1024, 1 << 20]
+CONF_BINS = [i / 10 for i in range(11)]
+
+
+def get_label_stats_file(label_file):
+    return op.splitext(label_file)[0] + '.stats.json'
+
+
+def get_conf_stats_file(prediction_file):
+    return op.splitext(prediction_file)[0] + '.conf.stats.json'
+
+
+def get_box_sizes(objects):
+    """ Return the square root of the area of the boxes with a rect in a list of objects.
+    """
+    rects = [o['rect'] for o in objects if len(o.get('rect', [])) == 4]
+    if len(rects) == 0:
+        return np.zeros(0)
+    rects = np.asarray(rects, dtype=np.float64)
+    areas = np.clip(rects[:, 2] - rects[:, 0], 0, None) * np.clip(rects[:, 3] - rects[:, 1], 0, None)
+    return np.sqrt(areas)
+
+
+def get_histogram_counts(values, bins):
+    counts, _ = np.histogram(np.clip(np.asarray(values, dtype=np.float64), bins[0], bins[-1]), bins=bins)
+    return counts.tolist()
+
+
+def make_label_stats(num_rows, label_counts, box_counts, box_size_counts):
+    """ Gather the statistics of num_rows rows of a label file from the
+        (label, number of rows) of its inverted index, the number of boxes of
+        each label and the counts of the box size histogram.
+    """
+    return {
+        'num_rows': num_rows,
+        'num_boxes': int(sum(box_counts.values())),
+        'labels': [(l, c, int(box_counts.get(l, 0))) for l, c in label_counts],
+        'box_size': {'bins': BOX_SIZE_BINS, 'counts': [int(c) for c in box_size_counts]},
+    }
+
+
+def merge_label_stats(stats_list, label_counts):
+    """ Add up the statistics of consecutive parts of a label file, given the
+        (label, number of rows) of the whole file.
+    """
+    box_counts = {}
+    box_size_counts = np.zeros(len(BOX_SIZE_BINS) - 1, dtype=np.int64)
+    for stats in stats_list:
+        for l, _, b in stats['labels']:
+            box_counts[l] = box_counts.get(l, 0) + b
+        box_size_counts += np.asarray(stats['box_size']['counts'], dtype=np.int64)
+    return make_label_stats(sum(s['num_rows'] for s in stats_list), label_counts, box_counts,
+                            box_size_counts.tolist())
+
+
+def make_conf_stats(num_rows, confs, base=None):
+    """ Gather the statistics of the box confidences of num_rows rows of a
+        prediction file. If base is given, confs are those of the rows
+        appended since the statistics base were gathered, and are added to it.
+    """
+    counts = get_histogram_counts(confs, CONF_BINS)
+    num_predictions = len(confs)
+    if base is not None:
+        counts = [x + y for x, y in zip(base['conf']['counts'], counts)]
+        num_predictions += base['num_predictions']
+    return {
+        'num_prediction_rows': num_rows,
+        'num_predictions': num_predictions,
+        'conf': {'bins': CONF_BINS, 'counts': counts},
+    }
+
+
+def write_label_stats(stats_file, stats):
+    with open(stats_file + '.tmp', 'w') as fp:
+        json.dump(stats, fp)
+    os.replace(stats_file + '.tmp', stats_file)
+
+
+def load_label_stats(stats_file):
+    with open(stats_file, 'r') as fp:
+        return json.load(fp)
@@ -0,0 +1,11 @@
+class MappedIndex(object):
+    """ The base class of the read-only indexes backed by a memory-mapped file.
+        The public attributes are the file name and the options the index was
+        opened with, the private ones are the map and the numpy arrays viewing
+        it, which cannot be pickled, e.g. by the cache. Only the public ones
+        are pickled, and the file is mapped again on the first access.
+    """
+    def __getstate__(self):
+        state = {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+        state['_mm'] = None
+        return state
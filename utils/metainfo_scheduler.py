@@ -0,0 +1,118 @@
+import os.path as op
+import fcntl
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.tsv_file import TSVFile
+from utils.logger import init_logging
+
+
+def get_lock_file(tsv_file):
+    return op.splitext(tsv_file)[0] + '.metainfo.lock'
+
+
+def build_metainfo(subset):
+    """ Build the metainfo of a subset while holding an exclusive lock on its
+        lock file, so that only one process builds it at a time. A process
+        waiting for the lock finds the metainfo ready once it gets it.
+        The composite tsv files of the subset are saved first, if they are
+        missing or list other shards.
+    """
+    with open(get_lock_file(subset.tsv_file), 'a') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            subset.write_composite_files()
+            TSVFile.ensure_metainfo(subset.tsv_file, label_file=subset.label_file,
+                prediction_file=subset.prediction_file, labelmap_file=subset.labelmap_file,
+                hw_file=subset.hw_file)
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+class MetainfoScheduler(object):
+    """ Build the metainfo of tsv subsets in the background.
+        Each build runs in a process of a pool started with spawn, so that the
+        process pools of ensure_metainfo are forked from its single thread,
+        and not from the threaded web server, whose locks held by its other
+        threads would be copied into the children.
+        Jobs are deduplicated within a process by a table of submitted jobs,
+        and across processes by the lock taken in build_metainfo.
+    """
+    def __init__(self, max_workers=2):
+        self._max_workers = max_workers
+        self._executor = self.__create_executor()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def __create_executor(self):
+        return ProcessPoolExecutor(max_workers=self._max_workers, initializer=init_logging,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def __submit(self, subset):
+        try:
+            return self._executor.submit(build_metainfo, subset)
+        except BrokenProcessPool:
+            # a build process died, e.g. killed when out of memory, start new ones
+            self._executor = self.__create_executor()
+            return self._executor.submit(build_metainfo, subset)
+
+    @staticmethod
+    def __job_key(subset):
+        return (op.abspath(subset.tsv_file), op.abspath(subset.label_file))
+
+    @staticmethod
+    def is_ready(subset):
+        if subset.is_composite_outdated():
+            return False
+        return TSVFile.is_metainfo_ready(subset.tsv_file, label_file=subset.label_file,
+            prediction_file=subset.prediction_file, labelmap_file=subset.labelmap_file,
+            hw_file=subset.hw_file)
+
+    def status(self, subset, submit=False):
+        """ Return a dict with the state ('done', 'queued', 'building', 'failed'
+            or 'missing') of the metainfo of a subset and the progress of its
+            build, submitting a build job first if submit is True.
+        """
+        if self.is_ready(subset):
+            return {'state': 'done', 'progress': 1.0}
+        key = self.__job_key(subset)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.done():
+                # report a finished job once, a later request submits a new one
+                del self._jobs[key]
+                if job.exception() is not None:
+                    logging.error('failed to build metainfo of {}: {}'.format(subset.tsv_file, job.exception()))
+                    return {'state': 'failed', 'progress': 0.0, 'error': str(job.exception())}
+                job = None
+            if job is None and submit:
+                logging.info('scheduling metainfo build: {}'.format(subset.tsv_file))
+                job = self.__submit(subset)
+                self._jobs[key] = job
+        if job is None:
+            return {'state': 'missing', 'progress': 0.0}
+        progress = TSVFile.get_metainfo_progress(subset.tsv_file, label_file=subset.label_file)
+        return {'state': 'building' if job.running() else 'queued',
+                'progress': 0.0 if progress is None else progress}
+
+    def ensure(self, subset):
+        return self.status(subset, submit=True)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = MetainfoScheduler()
+        return _scheduler
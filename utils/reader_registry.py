@@ -0,0 +1,111 @@
+import os.path as op
+import logging
+import threading
+from collections import OrderedDict
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.file_io import get_lineidx_file
+from utils.tsv_file import TSVFile
+from utils.inverted_index import InvertedIndex
+from utils.conf_index import ConfIndex
+from utils.key_index import KeyIndex
+
+
+class ReaderRegistry(object):
+    """ A process-level LRU registry of open tsv files and indexes.
+        Readers are kept open across requests instead of being pickled into
+        the cache, and are re-opened when one of their files changes. The index
+        files are memory-mapped read-only, so all processes share the same
+        pages. At most max_open readers (each holding one or two file
+        descriptors) are kept, with at most max_bytes of index files mapped.
+    """
+    def __init__(self, max_open=256, max_bytes=4 << 30):
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def __get_version(files):
+        return tuple(op.getmtime(f) if op.exists(f) else None for f in files)
+
+    def get(self, key, files, factory, index_files):
+        """ Return the reader registered under key, or create it with factory.
+            The reader is re-created when the mtime of one of files changes,
+            and accounted for the size of its index_files.
+        """
+        version = self.__get_version(files)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[2]
+
+        # open outside of the lock, which may build a missing index
+        reader = factory()
+        version = self.__get_version(files)
+        size = sum(op.getsize(f) for f in index_files if op.isfile(f))
+        with self._lock:
+            self.__remove(key)
+            self._entries[key] = (version, size, reader)
+            self._num_bytes += size
+            while len(self._entries) > 1 and (len(self._entries) > self.max_open or
+                                              self._num_bytes > self.max_bytes):
+                self.__remove(next(iter(self._entries)))
+        return reader
+
+    def __remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            # other requests may still read from the reader, so it is only
+            # dropped and its files are closed once the last of them is done
+            logging.debug('dropping reader: {}'.format(key))
+            self._num_bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self.__remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ReaderRegistry()
+        return _registry
+
+
+def get_tsv_file(tsv_file):
+    lineidx_file = get_lineidx_file(tsv_file)
+    return get_registry().get(('tsv', op.abspath(tsv_file)), [tsv_file, lineidx_file],
+                              lambda: TSVFile(tsv_file), [lineidx_file])
+
+
+def get_inverted_index(inverted_file, min_inverted_list_length=0, max_inverted_rows=-1):
+    key = ('inverted', op.abspath(inverted_file), min_inverted_list_length, max_inverted_rows)
+    return get_registry().get(key, [inverted_file],
+        lambda: InvertedIndex(inverted_file, min_inverted_list_length=min_inverted_list_length,
+                              max_inverted_rows=max_inverted_rows),
+        [inverted_file])
+
+
+def get_conf_index(conf_file):
+    return get_registry().get(('conf', op.abspath(conf_file)), [conf_file],
+                              lambda: ConfIndex(conf_file), [conf_file])
+
+
+def get_key_index(key_file):
+    return get_registry().get(('key', op.abspath(key_file)), [key_file],
+                              lambda: KeyIndex(key_file), [key_file])
@@ -0,0 +1,147 @@
+import os
+import os.path as op
+import json
+import base64
+import logging
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.file_io import ensure_directory
+
+
+# The formats of the generated annotations, as listed in the README: json
+# boxes, tag lists and json captions.
+LABEL_FORMATS = ('json', 'tags', 'captions')
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'ze', 'po', 'da', 'fe', 'gu', 'hi', 'ju', 'be']
+
+
+def make_vocabulary(num_labels, rng):
+    """ Return num_labels distinct pseudo words.
+    """
+    words = set()
+    while len(words) < num_labels:
+        words.add(''.join(rng.choice(SYLLABLES, size=rng.randint(2, 5))))
+    return sorted(words)
+
+
+def make_image(height, width, rng):
+    """ Return a random image of smooth gradients with some noise, which is
+        compressed like a photo rather than like noise.
+    """
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    a, b, c = rng.rand(3, 1, 1, 3).astype(np.float32)
+    img = 255 * (a * y + b * x + c * (1 - x) * y) / 2
+    img += rng.normal(0, 8, (height, width, 3)).astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def encode_image(img, quality=90):
+    return base64.b64encode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+
+
+def make_annotation(label_format, labels, height, width, rng, max_boxes=5, with_conf=False):
+    """ Return a random annotation of an image as a string, with up to
+        max_boxes boxes (or tags, or captions) whose labels are drawn from
+        labels, weighted by their rank so that the label counts are skewed.
+    """
+    weights = 1.0 / np.arange(1, len(labels) + 1)
+    classes = rng.choice(labels, size=rng.randint(0, max_boxes + 1), p=weights / weights.sum()).tolist()
+    confs = np.round(rng.rand(len(classes)), 3).tolist()
+    if label_format == 'tags':
+        if len(classes) == 0:
+            classes, confs = [labels[0]], [1.0]
+        if with_conf:
+            return ';'.join('{}:{}'.format(l, c) for l, c in zip(classes, confs))
+        return ';'.join(classes)
+    if label_format == 'captions':
+        captions = [' '.join(rng.choice(labels, size=rng.randint(4, 12)).tolist()).capitalize() + '.'
+                    for _ in range(rng.randint(1, max_boxes + 1))]
+        return json.dumps([{'caption': c} for c in captions])
+    objects = []
+    for l, c in zip(classes, confs):
+        x1, x2 = sorted(rng.randint(0, width, size=2).tolist())
+        y1, y2 = sorted(rng.randint(0, height, size=2).tolist())
+        rect = {'class': l, 'rect': [x1, y1, x2 + 1, y2 + 1]}
+        if with_conf:
+            rect['conf'] = c
+        objects.append(rect)
+    return json.dumps(objects)
+
+
+def make_synthetic_dataset(data_dir, num_rows=10000, min_side=256, max_side=640, num_labels=100,
+                           label_format='json', max_boxes=5, num_images=0, prediction=False, seed=0):
+    """ Write a dataset of num_rows random images of sides in [min_side,
+        max_side] as data_dir/train.tsv, with annotations of num_labels labels
+        in label_format. If num_images is positive, the rows reuse a pool of
+        num_images images, which is faster to generate than an image per row.
+        With prediction, the boxes of a prediction file with confidences are
+        written as data_dir/prediction.tsv, with the labels as
+        data_dir/train.label.tsv and a prediction.yaml subset of both.
+    """
+    assert label_format in LABEL_FORMATS
+    ensure_directory(data_dir)
+    rng = np.random.RandomState(seed)
+    labels = make_vocabulary(num_labels, rng)
+    pool = []
+    for _ in range(num_images):
+        h, w = rng.randint(min_side, max_side + 1, size=2).tolist()
+        pool.append((h, w, encode_image(make_image(h, w, rng))))
+
+    tsv_file = op.join(data_dir, 'train.tsv')
+    label_file = op.join(data_dir, 'train.label.tsv')
+    prediction_file = op.join(data_dir, 'prediction.tsv')
+    logging.info('generating {} rows of synthetic data: {}'.format(num_rows, tsv_file))
+    with open(tsv_file + '.tmp', 'wb') as fp, \
+            open(label_file + '.tmp' if prediction else os.devnull, 'wb') as label_fp, \
+            open(prediction_file + '.tmp' if prediction else os.devnull, 'wb') as pred_fp:
+        for i in tqdm(range(num_rows)):
+            if len(pool) > 0:
+                h, w, encoded = pool[rng.randint(len(pool))]
+            else:
+                h, w = rng.randint(min_side, max_side + 1, size=2).tolist()
+                encoded = encode_image(make_image(h, w, rng))
+            key = 'images/{:08d}.jpg'.format(i)
+            label = make_annotation(label_format, labels, h, w, rng, max_boxes=max_boxes)
+            fp.write('{}\t{}\t'.format(key, label).encode() + encoded + b'\n')
+            if prediction:
+                label_fp.write('{}\t{}\n'.format(key, label).encode())
+                pred = make_annotation('tags' if label_format == 'tags' else 'json', labels, h, w, rng,
+                                       max_boxes=max_boxes, with_conf=True)
+                pred_fp.write('{}\t{}\n'.format(key, pred).encode())
+    os.replace(tsv_file + '.tmp', tsv_file)
+    if prediction:
+        os.replace(label_file + '.tmp', label_file)
+        os.replace(prediction_file + '.tmp', prediction_file)
+        with open(op.join(data_dir, 'prediction.yaml'), 'w') as fp:
+            fp.write('img: train.tsv\nlabel: train.label.tsv\nprediction: prediction.tsv\n')
+    return tsv_file
+
+
+if __name__ == "__main__":
+    import logger
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic tsv dataset, e.g. for benchmarks')
+    parser.add_argument('data_dir', action="store")
+    parser.add_argument('--num_rows', type=int, default=10000)
+    parser.add_argument('--min_side', type=int, default=256)
+    parser.add_argument('--max_side', type=int, default=640)
+    parser.add_argument('--num_labels', type=int, default=100)
+    parser.add_argument('--label_format', choices=LABEL_FORMATS, default='json')
+    parser.add_argument('--max_boxes', type=int, default=5)
+    parser.add_argument('--num_images', type=int, default=0,
+                        help='the size of a pool of images reused by the rows, 0 for an image per row')
+    parser.add_argument('--prediction', action='store_true', help='also generate a prediction file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logger.init_logging()
+    make_synthetic_dataset(args.data_dir, num_rows=args.num_rows, min_side=args.min_side, max_side=args.max_side,
+                           num_labels=args.num_labels, label_format=args.label_format, max_boxes=args.max_boxes,
+                           num_images=args.num_images, prediction=args.prediction, seed=args.seed)
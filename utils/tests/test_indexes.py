@@ -0,0 +1,135 @@
+import os.path as op
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from utils.inverted_index import InvertedIndex, write_inverted_index, convert_inverted_index
+from utils.conf_index import ConfIndex, write_conf_index
+from utils.key_index import KeyIndex, write_key_index
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+class TestInvertedIndex(TempDirTestCase):
+    def setUp(self):
+        super(TestInvertedIndex, self).setUp()
+        self.inverted = {'a': [0, 3, 7, 100000], 'b': [1, 2], 'c': [5], 'd': [2, 4, 6]}
+        self.inverted_file = op.join(self.temp_dir, 'train.label.inverted.bin')
+        write_inverted_index(self.inverted_file, self.inverted)
+
+    def test_round_trip(self):
+        index = InvertedIndex(self.inverted_file)
+        self.assertEqual(index.keys(), ['a', 'd', 'b', 'c'])
+        self.assertEqual({l: rows.tolist() for l, rows in index.items()}, self.inverted)
+        self.assertEqual(index.label_counts(), [('a', 4), ('d', 3), ('b', 2), ('c', 1)])
+        self.assertIn('c', index)
+        self.assertNotIn('e', index)
+
+    def test_filters(self):
+        index = InvertedIndex(self.inverted_file, min_inverted_list_length=2, max_inverted_rows=2)
+        self.assertEqual(index.keys(), ['a', 'd'])
+        self.assertEqual(len(index), 2)
+
+    def test_pickle(self):
+        index = InvertedIndex(self.inverted_file, min_inverted_list_length=2)
+        copy = pickle.loads(pickle.dumps(index))
+        self.assertEqual(copy.keys(), ['a', 'd', 'b'])
+        self.assertEqual(copy['a'].tolist(), self.inverted['a'])
+
+    def test_convert_legacy(self):
+        legacy_file = op.join(self.temp_dir, 'legacy.inverted.tsv')
+        with open(legacy_file, 'w') as fp:
+            for label, rows in self.inverted.items():
+                fp.write('{}\t{}\n'.format(label, ' '.join(map(str, rows))))
+        converted_file = op.join(self.temp_dir, 'converted.inverted.bin')
+        convert_inverted_index(legacy_file, converted_file)
+        index = InvertedIndex(converted_file)
+        self.assertEqual({l: rows.tolist() for l, rows in index.items()}, self.inverted)
+
+
+class TestConfIndex(TempDirTestCase):
+    def test_rows_in_range(self):
+        rng = np.random.RandomState(0)
+        # (row, label, conf) of the boxes of 50 rows
+        boxes = [(r, l, round(float(c), 3)) for r in range(50) for l, c in
+                 zip(rng.choice(['a', 'b', 'c'], 3), rng.rand(3)) if rng.rand() < 0.7]
+        label_confs = {}
+        for label in [None, 'a', 'b', 'c']:
+            confs = {}
+            for r, l, c in boxes:
+                if label is None or l == label:
+                    confs.setdefault(r, []).append(c)
+            rows = sorted(confs)
+            label_confs[label] = (rows, [max(confs[r]) for r in rows], [min(confs[r]) for r in rows])
+        conf_file = op.join(self.temp_dir, 'prediction.conf.bin')
+        write_conf_index(conf_file, label_confs, num_rows=50)
+
+        index = ConfIndex(conf_file)
+        self.assertEqual(index.num_rows(), 50)
+        for label in [None, 'a', 'b', 'c']:
+            rows, max_confs, min_confs = label_confs[label]
+            for min_conf, max_conf in [(0, float('inf')), (0.5, float('inf')), (0.3, 0.6), (0.9, 1), (2, 3)]:
+                # a row is in range if one of its boxes is above min_conf and one is below max_conf
+                expected = [r for r, hi, lo in zip(rows, max_confs, min_confs)
+                            if np.float32(hi) >= np.float32(min_conf) and np.float32(lo) <= np.float32(max_conf)]
+                self.assertEqual(index.rows_in_range(label, min_conf, max_conf).tolist(), expected)
+        self.assertEqual(index.rows_in_range('z', 0).tolist(), [])
+
+    def test_threshold_is_compared_as_stored(self):
+        conf_file = op.join(self.temp_dir, 'prediction.conf.bin')
+        write_conf_index(conf_file, {None: ([0, 1], [0.9, 0.5], [0.9, 0.5])}, num_rows=2)
+        self.assertEqual(ConfIndex(conf_file).rows_in_range(None, 0.9).tolist(), [0])
+
+    def test_pickle(self):
+        conf_file = op.join(self.temp_dir, 'prediction.conf.bin')
+        write_conf_index(conf_file, {None: ([0, 3], [0.9, 0.5], [0.1, 0.5])}, num_rows=4)
+        copy = pickle.loads(pickle.dumps(ConfIndex(conf_file)))
+        self.assertEqual(copy.rows_in_range(None, 0.6).tolist(), [0])
+
+
+class TestKeyIndex(TempDirTestCase):
+    def setUp(self):
+        super(TestKeyIndex, self).setUp()
+        self.keys = ['images/cat_001.jpg', 'images/dog_002.jpg', 'a', 'images/cat_003.jpg',
+                     'x', 'images/cat_001.jpg', 'other/dog.png', 'ab', '猫.jpg']
+        self.key_file = op.join(self.temp_dir, 'train.label.keys.bin')
+        write_key_index(self.key_file, [k.encode('utf-8') for k in self.keys])
+
+    def expected(self, match):
+        return [i for i, k in enumerate(self.keys) if match(k)]
+
+    def test_get_key(self):
+        index = KeyIndex(self.key_file)
+        self.assertEqual(len(index), len(self.keys))
+        self.assertEqual([index.get_key(i) for i in range(len(self.keys))], self.keys)
+
+    def test_exact(self):
+        index = KeyIndex(self.key_file)
+        for key in ['images/cat_001.jpg', 'a', 'x', 'images', 'zzz', '']:
+            self.assertEqual(index.exact(key).tolist(), self.expected(lambda k: k == key), key)
+
+    def test_prefix(self):
+        index = KeyIndex(self.key_file)
+        for prefix in ['images/cat', 'images/', 'a', 'other/dog.png', 'q', '', '猫']:
+            self.assertEqual(index.prefix(prefix).tolist(), self.expected(lambda k: k.startswith(prefix)), prefix)
+
+    def test_contains(self):
+        index = KeyIndex(self.key_file)
+        for sub in ['cat', 'dog', '_00', '.jpg', 'a', 'b', 'x', 'ab', '', 'zzz', 'cat_001.jpg', '猫']:
+            self.assertEqual(index.contains(sub).tolist(), self.expected(lambda k: sub in k), sub)
+
+    def test_pickle(self):
+        copy = pickle.loads(pickle.dumps(KeyIndex(self.key_file)))
+        self.assertEqual(copy.prefix('images/cat').tolist(), [0, 3, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import numpy as np
+
+from utils.label_query import parse_label_query, run_label_query, LabelQueryError
+from utils.label_query import intersect_sorted, difference_sorted
+
+
+NUM_ROWS = 10
+INVERTED = {
+    'cat': np.array([0, 1, 2, 3]),
+    'dog': np.array([2, 3, 4, 5]),
+    'car': np.array([3, 5, 7]),
+    'traffic light': np.array([8, 9]),
+}
+
+
+def query(q):
+    return run_label_query(q, INVERTED, NUM_ROWS).tolist()
+
+
+class TestLabelQuery(unittest.TestCase):
+    def test_and_binds_tighter_than_or(self):
+        self.assertEqual(query('cat OR dog AND car'), [0, 1, 2, 3, 5])
+        self.assertEqual(query('(cat OR dog) AND car'), [3, 5])
+
+    def test_implicit_and_and_binary_not(self):
+        self.assertEqual(query('cat dog'), [2, 3])
+        self.assertEqual(query('cat NOT dog'), [0, 1])
+        self.assertEqual(query('cat AND NOT dog'), [0, 1])
+
+    def test_unary_not(self):
+        self.assertEqual(query('NOT cat'), [4, 5, 6, 7, 8, 9])
+        self.assertEqual(query('NOT NOT cat'), [0, 1, 2, 3])
+        self.assertEqual(query('NOT (cat OR dog OR car)'), [6, 8, 9])
+
+    def test_keywords_are_case_insensitive(self):
+        self.assertEqual(query('cat and dog or car'), [2, 3, 5, 7])
+
+    def test_quoted_label(self):
+        self.assertEqual(query('"traffic light" OR car'), [3, 5, 7, 8, 9])
+        self.assertEqual(parse_label_query('"AND"'), ('label', 'AND'))
+
+    def test_parse_tree(self):
+        self.assertEqual(parse_label_query('a OR b c'),
+                         ('or', [('label', 'a'), ('and', [('label', 'b'), ('label', 'c')])]))
+
+    def test_errors(self):
+        for q in ['', '   ', '(cat', 'cat OR', ')', 'cat )', 'NOT', '"cat']:
+            with self.assertRaises(LabelQueryError, msg=q):
+                query(q)
+
+    def test_unknown_label(self):
+        with self.assertRaises(LabelQueryError):
+            query('cat OR horse')
+
+    def test_error_is_a_value_error(self):
+        self.assertTrue(issubclass(LabelQueryError, ValueError))
+
+
+class TestSortedSets(unittest.TestCase):
+    def test_intersect_matches_numpy(self):
+        rng = np.random.RandomState(0)
+        for n, m in [(0, 10), (5, 10), (10, 1000), (1000, 3)]:
+            a = np.unique(rng.randint(0, 2000, n))
+            b = np.unique(rng.randint(0, 2000, m))
+            self.assertEqual(intersect_sorted(a, b).tolist(), np.intersect1d(a, b).tolist())
+
+    def test_difference_matches_numpy(self):
+        rng = np.random.RandomState(1)
+        for n, m in [(0, 10), (10, 0), (50, 10), (10, 500)]:
+            a = np.unique(rng.randint(0, 200, n))
+            b = np.unique(rng.randint(0, 200, m))
+            self.assertEqual(difference_sorted(a, b).tolist(), np.setdiff1d(a, b).tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from utils.tsv_file import TSVFile
+from utils.synthetic_data import make_synthetic_dataset
+from utils.inverted_index import InvertedIndex
+from utils.conf_index import ConfIndex
+from utils.hw_index import load_hw_index
+from utils.key_index import KeyIndex
+from utils.label_stats import load_label_stats
+from utils.image_io import img_from_base64
+
+
+def make_dataset(data_dir, num_rows=300):
+    make_synthetic_dataset(data_dir, num_rows=num_rows, min_side=8, max_side=48, num_labels=20,
+                           num_images=10, prediction=True, seed=0)
+    # the label file is extracted from the tsv by the build, the prediction is kept
+    os.remove(op.join(data_dir, 'train.label.tsv'))
+    os.remove(op.join(data_dir, 'prediction.yaml'))
+    return op.join(data_dir, 'train.tsv'), op.join(data_dir, 'prediction.tsv')
+
+
+def read_lines(tsv_file):
+    with open(tsv_file, 'rb') as fp:
+        return fp.readlines()
+
+
+def write_lines(tsv_file, lines, mode='wb'):
+    with open(tsv_file, mode) as fp:
+        fp.writelines(lines)
+
+
+def age_files(data_dir, seconds=100):
+    # make the files written next older than the metainfo, whatever the resolution of the mtimes
+    for f in os.listdir(data_dir):
+        mtime = op.getmtime(op.join(data_dir, f)) - seconds
+        os.utime(op.join(data_dir, f), (mtime, mtime))
+
+
+def load_metainfo(data_dir, prediction=True):
+    """ Load the metainfo built for data_dir/train.tsv as plain python values.
+    """
+    tsv_file = op.join(data_dir, 'train.tsv')
+    label_file = op.join(data_dir, 'train.label.tsv')
+    keys = KeyIndex(op.join(data_dir, 'train.label.keys.bin'))
+    with open(op.join(data_dir, 'train.labelmap.txt'), 'r') as fp:
+        labelmap = fp.read().split()
+    metainfo = {
+        'label': read_lines(label_file),
+        # the order of the labelmap is the order the labels were first seen in
+        'labelmap': sorted(labelmap),
+        'inverted': {k: v.tolist() for k, v in InvertedIndex(op.join(data_dir, 'train.label.inverted.bin')).items()},
+        'stats': load_label_stats(op.join(data_dir, 'train.label.stats.json')),
+        'hw': np.asarray(load_hw_index(op.join(data_dir, 'train.hw.bin'))).tolist(),
+        'keys': [keys.get_key(i) for i in range(len(keys))],
+        'num_rows': [TSVFile(f).num_rows() for f in [tsv_file, label_file]],
+    }
+    if prediction:
+        conf = ConfIndex(op.join(data_dir, 'prediction.conf.bin'))
+        metainfo['conf'] = {k: conf.rows_in_range(k, 0).tolist() for k in [None] + labelmap}
+        metainfo['conf_num_rows'] = conf.num_rows()
+        metainfo['conf_stats'] = load_label_stats(op.join(data_dir, 'prediction.conf.stats.json'))
+    return metainfo
+
+
+class TestMetainfo(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tsv_file, self.prediction_file = make_dataset(op.join(self.temp_dir, 'full'))
+        self.lines = read_lines(self.tsv_file)
+        self.prediction_lines = read_lines(self.prediction_file)
+        TSVFile.ensure_metainfo(self.tsv_file, prediction_file=self.prediction_file, num_workers=1)
+        self.full = load_metainfo(op.dirname(self.tsv_file))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_copy(self, name, num_rows=None, num_prediction_rows=None):
+        data_dir = op.join(self.temp_dir, name)
+        os.makedirs(data_dir)
+        tsv_file = op.join(data_dir, 'train.tsv')
+        prediction_file = op.join(data_dir, 'prediction.tsv')
+        write_lines(tsv_file, self.lines[:num_rows])
+        write_lines(prediction_file, self.prediction_lines[:num_prediction_rows])
+        return tsv_file, prediction_file
+
+    def test_full_build(self):
+        self.assertTrue(TSVFile.is_metainfo_ready(self.tsv_file, prediction_file=self.prediction_file))
+        self.assertEqual(self.full['num_rows'], [len(self.lines)] * 2)
+        self.assertEqual(self.full['keys'], [l.split(b'\t')[0].decode() for l in self.lines])
+        tsv = TSVFile(self.tsv_file)
+        for idx in [0, len(self.lines) - 1]:
+            h, w = img_from_base64(tsv.seek(idx)[-1]).shape[:2]
+            self.assertEqual(self.full['hw'][idx], [h, w])
+        self.assertEqual(self.full['conf_num_rows'], len(self.prediction_lines))
+
+    def test_sharded_build_matches_single_shard(self):
+        tsv_file, prediction_file = self.make_copy('sharded')
+        # shards of a few rows, scanned by a pool of processes
+        TSVFile.ensure_metainfo(tsv_file, prediction_file=prediction_file, shard_size=4096, num_workers=2)
+        self.assertTrue(TSVFile.is_metainfo_ready(tsv_file, prediction_file=prediction_file))
+        self.assertEqual(load_metainfo(op.dirname(tsv_file)), self.full)
+
+    def test_append_matches_full_build(self):
+        tsv_file, prediction_file = self.make_copy('appended', num_rows=200, num_prediction_rows=120)
+        TSVFile.ensure_metainfo(tsv_file, prediction_file=prediction_file, num_workers=1)
+        age_files(op.dirname(tsv_file))
+        write_lines(tsv_file, self.lines[200:], mode='ab')
+        write_lines(prediction_file, self.prediction_lines[120:], mode='ab')
+        self.assertFalse(TSVFile.is_metainfo_ready(tsv_file, prediction_file=prediction_file))
+        TSVFile.ensure_metainfo(tsv_file, prediction_file=prediction_file, num_workers=1)
+        self.assertTrue(TSVFile.is_metainfo_ready(tsv_file, prediction_file=prediction_file))
+        self.assertEqual(load_metainfo(op.dirname(tsv_file)), self.full)
+
+    def test_truncation_rebuilds(self):
+        tsv_file, prediction_file = self.make_copy('truncated')
+        TSVFile.ensure_metainfo(tsv_file, prediction_file=prediction_file, num_workers=1)
+        age_files(op.dirname(tsv_file))
+        write_lines(prediction_file, self.prediction_lines[:100])
+        self.assertFalse(TSVFile.is_metainfo_ready(tsv_file, prediction_file=prediction_file))
+        TSVFile.ensure_metainfo(tsv_file, prediction_file=prediction_file, num_workers=1)
+        self.assertEqual(TSVFile(prediction_file).num_rows(), 100)
+        self.assertEqual(ConfIndex(op.join(op.dirname(tsv_file), 'prediction.conf.bin')).num_rows(), 100)
+        self.assertEqual(load_label_stats(op.join(op.dirname(tsv_file), 'prediction.conf.stats.json'))
+                         ['num_prediction_rows'], 100)
+
+    def test_modification_rebuilds(self):
+        tsv_file, prediction_file = self.make_copy('modified', num_rows=200)
+        TSVFile.ensure_metainfo(tsv_file, prediction_file=prediction_file, num_workers=1)
+        age_files(op.dirname(tsv_file))
+        # the same number of rows, but different ones, the existing label file is kept
+        write_lines(tsv_file, self.lines[100:])
+        TSVFile.ensure_metainfo(tsv_file, prediction_file=prediction_file, num_workers=1)
+        self.assertTrue(TSVFile.is_metainfo_ready(tsv_file, prediction_file=prediction_file))
+        self.assertEqual(TSVFile(tsv_file).seek(0)[0], self.full['keys'][100])
+        self.assertEqual(np.asarray(load_hw_index(op.join(op.dirname(tsv_file), 'train.hw.bin'))).tolist(),
+                         self.full['hw'][100:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from utils.tsv_file import TSVFile
+from utils.file_io import generate_lineidx, load_lineidx, read_lineidx_header, update_lineidx
+from utils.file_io import get_lineidx_file, get_legacy_lineidx_file
+from utils.bgzf import compress_tsv
+
+
+def make_rows(num_rows, seed=0):
+    # rows of random lengths, so that some of them span the chunks and blocks
+    rng = np.random.RandomState(seed)
+    return [['key{}'.format(i), 'label{}'.format(i % 7), 'x' * rng.randint(0, 300)] for i in range(num_rows)]
+
+
+def write_tsv(tsv_file, rows, mode='w'):
+    with open(tsv_file, mode) as fp:
+        for row in rows:
+            fp.write('\t'.join(row) + '\n')
+
+
+class TestLineidx(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tsv_file = op.join(self.temp_dir, 'train.tsv')
+        self.rows = make_rows(1000)
+        write_tsv(self.tsv_file, self.rows)
+        with open(self.tsv_file, 'rb') as fp:
+            data = fp.read()
+        self.offsets = [0] + [i + 1 for i, c in enumerate(data[:-1]) if c == ord('\n')]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_parallel_chunks(self):
+        # chunks smaller than a row and not aligned to the rows
+        for chunk_size, num_workers in [(64 << 20, 1), (4096, 1), (1000, 3), (97, 2)]:
+            idx_file = op.join(self.temp_dir, 'train.{}.lineidx.bin'.format(chunk_size))
+            generate_lineidx(self.tsv_file, idx_file, chunk_size=chunk_size, num_workers=num_workers)
+            self.assertEqual(load_lineidx(idx_file).tolist(), self.offsets)
+            self.assertEqual(read_lineidx_header(idx_file), (len(self.rows), op.getsize(self.tsv_file)))
+
+    def test_legacy_conversion(self):
+        with open(get_legacy_lineidx_file(self.tsv_file), 'w') as fp:
+            fp.write(''.join('{}\n'.format(o) for o in self.offsets))
+        tsv = TSVFile(self.tsv_file)
+        self.assertEqual(tsv.num_rows(), len(self.rows))
+        self.assertTrue(op.isfile(get_lineidx_file(self.tsv_file)))
+        self.assertEqual(load_lineidx(get_lineidx_file(self.tsv_file)).tolist(), self.offsets)
+
+    def test_update_after_append(self):
+        generate_lineidx(self.tsv_file)
+        appended = make_rows(200, seed=1)
+        write_tsv(self.tsv_file, appended, mode='a')
+        self.assertEqual(update_lineidx(self.tsv_file, chunk_size=1000, num_workers=2), len(self.rows))
+        updated = load_lineidx(get_lineidx_file(self.tsv_file)).tolist()
+        full_file = op.join(self.temp_dir, 'full.lineidx.bin')
+        generate_lineidx(self.tsv_file, full_file)
+        self.assertEqual(updated, load_lineidx(full_file).tolist())
+        self.assertEqual(read_lineidx_header(get_lineidx_file(self.tsv_file)), read_lineidx_header(full_file))
+
+    def test_update_after_truncation(self):
+        generate_lineidx(self.tsv_file)
+        write_tsv(self.tsv_file, self.rows[:10])
+        self.assertIsNone(update_lineidx(self.tsv_file))
+        self.assertEqual(read_lineidx_header(get_lineidx_file(self.tsv_file))[0], len(self.rows))
+
+    def test_update_after_modification(self):
+        generate_lineidx(self.tsv_file)
+        # the same size, but the last row is rewritten
+        with open(self.tsv_file, 'r+b') as fp:
+            fp.seek(-2, os.SEEK_END)
+            fp.write(b'y')
+        self.assertIsNone(update_lineidx(self.tsv_file))
+
+
+class TestTSVFile(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.tsv_file = op.join(self.temp_dir, 'train.tsv')
+        # larger than a BGZF block
+        self.rows = make_rows(2000)
+        write_tsv(self.tsv_file, self.rows)
+        self.bgzf_file = op.join(self.temp_dir, 'train.gz.tsv')
+        compress_tsv(self.tsv_file, self.bgzf_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_seek(self):
+        tsv = TSVFile(self.tsv_file)
+        self.assertEqual(tsv.num_rows(), len(self.rows))
+        for idx in [0, 1, 999, len(self.rows) - 1, -1]:
+            row = tsv.seek(idx)
+            self.assertEqual(list(row), self.rows[idx])
+            self.assertEqual(row[1], self.rows[idx][1])
+            self.assertEqual(row.get_bytes(0).tobytes(), self.rows[idx][0].encode())
+        with self.assertRaises(IndexError):
+            tsv.seek(len(self.rows))
+
+    def test_seek_many(self):
+        tsv = TSVFile(self.tsv_file)
+        indices = [5, 3, 1999, 4, 3, 0, -2]
+        self.assertEqual(tsv.seek_many(indices), [self.rows[i] for i in indices])
+        self.assertEqual(tsv.seek_many(indices, columns=[1], max_gap=0), [[self.rows[i][1]] for i in indices])
+        as_bytes = tsv.seek_many(indices, columns=[0], as_bytes=True)
+        self.assertEqual([[c.tobytes() for c in row] for row in as_bytes],
+                         [[self.rows[i][0].encode()] for i in indices])
+        self.assertEqual(tsv.seek_many([]), [])
+        with self.assertRaises(IndexError):
+            tsv.seek_many([0, len(self.rows)])
+
+    def test_empty_tsv(self):
+        empty_file = op.join(self.temp_dir, 'empty.tsv')
+        open(empty_file, 'w').close()
+        tsv = TSVFile(empty_file)
+        self.assertEqual(tsv.num_rows(), 0)
+        with self.assertRaises(IndexError):
+            tsv.seek(0)
+        with self.assertRaises(IndexError):
+            tsv.seek_many([0])
+
+    def test_bgzf_seek_matches_plain(self):
+        plain = TSVFile(self.tsv_file)
+        bgzf = TSVFile(self.bgzf_file)
+        self.assertEqual(bgzf.num_rows(), plain.num_rows())
+        for idx in list(range(0, len(self.rows), 97)) + [len(self.rows) - 1]:
+            self.assertEqual(list(bgzf.seek(idx)), list(plain.seek(idx)))
+
+    def test_bgzf_seek_many_matches_plain(self):
+        plain = TSVFile(self.tsv_file)
+        bgzf = TSVFile(self.bgzf_file)
+        indices = np.random.RandomState(0).randint(0, len(self.rows), 100).tolist() + [len(self.rows) - 1]
+        self.assertEqual(bgzf.seek_many(indices), plain.seek_many(indices))
+        self.assertEqual(bgzf.seek_many(indices, columns=[2]), plain.seek_many(indices, columns=[2]))
+
+    def test_bgzf_parallel_lineidx(self):
+        single_file = op.join(self.temp_dir, 'single.lineidx.bin')
+        generate_lineidx(self.bgzf_file, single_file, num_workers=1)
+        parallel_file = op.join(self.temp_dir, 'parallel.lineidx.bin')
+        generate_lineidx(self.bgzf_file, parallel_file, chunk_size=10000, num_workers=2)
+        self.assertEqual(load_lineidx(parallel_file).tolist(), load_lineidx(single_file).tolist())
+        self.assertEqual(len(load_lineidx(parallel_file)), len(self.rows))
+
+    def test_rows(self):
+        tsv = TSVFile(self.tsv_file)
+        self.assertEqual([list(r) for r in tsv.rows([2, 0])], [self.rows[2], self.rows[0]])
+
+    def test_reader_decompresses_bgzf(self):
+        self.assertEqual(list(TSVFile.reader(self.bgzf_file)), list(TSVFile.reader(self.tsv_file)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import os.path as op
+import struct
+import hashlib
+import logging
+import threading
+import multiprocessing
+import cv2
+from tqdm import tqdm
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+from utils.file_io import ensure_directory
+from utils.image_io import img_from_base64, img_from_bytes, img_size_from_base64, img_size_from_bytes
+from utils.image_io import get_reduce_factor, read_image_column, IMAGE_COLUMN
+from utils.tsv_file import TSVFile
+
+
+# a cached thumbnail is the size of the original image (width, height)
+# followed by the jpeg encoded thumbnail
+THUMBNAIL_HEADER = struct.Struct('<II')
+
+
+def get_thumbnail_key(encoded, max_side):
+    """ Address a thumbnail by the content of its source image and its size.
+    """
+    return '{}-{}'.format(hashlib.sha1(encoded).hexdigest(), max_side)
+
+
+def make_thumbnail(img, max_side, quality=90):
+    """ Downscale an image so that its longer side is at most max_side and encode it as jpeg.
+    """
+    h, w = img.shape[:2]
+    scale = max_side / max(h, w)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                         interpolation=cv2.INTER_AREA)
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+class ThumbnailCache(object):
+    """ A content-addressed on-disk cache of thumbnails.
+        Reading a thumbnail touches its file, and once the cache grows over
+        max_bytes, the least recently used thumbnails are removed until it is
+        below 90% of max_bytes. Several processes can share a cache folder.
+    """
+    def __init__(self, cache_dir, max_bytes=8 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._num_bytes = None
+        self._lock = threading.Lock()
+
+    def __path(self, key):
+        return op.join(self.cache_dir, key[:2], key + '.thumb')
+
+    def get(self, key):
+        """ Return (jpeg bytes, (width, height) of the original image) or None.
+        """
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data[THUMBNAIL_HEADER.size:], THUMBNAIL_HEADER.unpack(data[:THUMBNAIL_HEADER.size])
+
+    def put(self, key, data, size):
+        path = self.__path(key)
+        ensure_directory(op.dirname(path))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(THUMBNAIL_HEADER.pack(*size))
+            fp.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._num_bytes is None:
+                self._num_bytes = sum(x[2] for x in self.__list_entries())
+            else:
+                self._num_bytes += THUMBNAIL_HEADER.size + len(data)
+            if self._num_bytes > self.max_bytes:
+                self.__evict(int(0.9 * self.max_bytes))
+
+    def __list_entries(self):
+        entries = []
+        for d in os.scandir(self.cache_dir):
+            if not d.is_dir():
+                continue
+            for f in os.scandir(d.path):
+                if f.name.endswith('.thumb'):
+                    try:
+                        st = f.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, f.path, st.st_size))
+        return entries
+
+    def __evict(self, target_bytes):
+        entries = sorted(self.__list_entries())
+        total = sum(x[2] for x in entries)
+        logging.info('evicting thumbnails from {} bytes to {} bytes'.format(total, target_bytes))
+        for _, path, size in entries:
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._num_bytes = total
+
+
+def get_thumbnail(cache, encoded, is_base64, max_side):
+    """ Return the thumbnail of an encoded image and the size of the original
+        image, from the cache or by decoding, resizing and caching it.
+        The size is read from the header of the image when possible, which
+        is then decoded at the lowest resolution still larger than max_side.
+        Return None if the image cannot be decoded.
+    """
+    key = get_thumbnail_key(encoded, max_side)
+    result = cache.get(key)
+    if result is None:
+        size = img_size_from_base64(encoded) if is_base64 else img_size_from_bytes(encoded)
+        reduce_factor = 1 if size is None else get_reduce_factor(size, max_side)
+        img = (img_from_base64 if is_base64 else img_from_bytes)(encoded, reduce_factor=reduce_factor)
+        if img is None:
+            return None
+        if size is None:
+            size = (img.shape[1], img.shape[0])
+        data = make_thumbnail(img, max_side)
+        cache.put(key, data, size)
+        result = data, size
+    return result
+
+
+def _precompute_range(args):
+    tsv_file, cache_dir, max_bytes, max_side, start, end = args
+    tsv = TSVFile(tsv_file)
+    cache = ThumbnailCache(cache_dir, max_bytes)
+    for idx in range(start, end):
+        column = read_image_column(tsv.seek(idx).get_bytes(IMAGE_COLUMN))
+        if column is not None:
+            get_thumbnail(cache, column[0], column[1], max_side)
+    return end - start
+
+
+def precompute_thumbnails(tsv_file, cache_dir, max_side, max_bytes=8 << 30, num_workers=None, rows_per_task=1000):
+    """ Fill the thumbnail cache with the images of a tsv using a pool of processes.
+    """
+    num_rows = TSVFile(tsv_file).num_rows()
+    tasks = [(tsv_file, cache_dir, max_bytes, max_side, start, min(start + rows_per_task, num_rows))
+             for start in range(0, num_rows, rows_per_task)]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    logging.info('precomputing thumbnails of {} images with {} workers'.format(num_rows, num_workers))
+    with multiprocessing.Pool(num_workers) as pool, tqdm(total=num_rows) as t:
+        for n in pool.imap_unordered(_precompute_range, tasks):
+            t.update(n)
+
+
+if __name__ == "__main__":
+    import logger
+    import argparse
+    from utils.tsv_dataset import TSVSubset
+
+    parser = argparse.ArgumentParser(description='Precompute the thumbnails of a subset')
+    parser.add_argument('data_dir', action="store")
+    parser.add_argument('subset', action="store")
+    parser.add_argument('--version', type=int, default=0)
+    parser.add_argument('--max_side', type=int, default=512)
+    parser.add_argument('--max_bytes', type=int, default=8 << 30)
+    parser.add_argument('--cache_dir', default=None,
+                        help='defaults to the .thumbnails folder next to data_dir')
+    parser.add_argument('--num_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    logger.init_logging()
+    data_dir = op.abspath(args.data_dir)
+    cache_dir = args.cache_dir or op.join(op.dirname(data_dir), '.thumbnails')
+    s = TSVSubset.from_name(data_dir, args.subset, version=args.version)
+    s.write_composite_files()
+    precompute_thumbnails(s.tsv_file, cache_dir, args.max_side, max_bytes=args.max_bytes,
+                          num_workers=args.num_workers)
@@ -1,4 +1,5 @@
 import cv2
+import re
 import json
 from PIL import Image
 import os
@@ -11,7 +12,12 @@ sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
 from utils.tsv_file import TSVFile
 from utils.file_io import load_linelist_file, load_from_yaml_file
 from utils.file_io import find_file_path_in_yaml
-from utils.image_io import img_from_base64
+from utils.image_io import img_from_base64, IMAGE_COLUMN
+from utils.inverted_index import InvertedIndex, get_inverted_file
+from utils.hw_index import get_hw_index_file, is_hw_index_file, load_hw_index
+from utils.label_stats import get_label_stats_file, get_conf_stats_file, load_label_stats
+from utils.composite_tsv import get_composite_file, write_composite_file, is_composite_file_outdated
+from utils.composite_tsv import find_shard_files, is_shard_pattern
 
 
 class TSVDataset(object):
@@ -21,7 +27,9 @@ class TSVDataset(object):
             img_file: Image file with image key and base64 encoded image str.
             label_file: An optional label file with image key and label information. 
                 A label_file is required for training and optional for testing.
-            hw_file: An optional file with image key and image height/width info.
+            hw_file: An optional file with image key and image height/width info,
+                or a binary hw index. The binary hw index next to img_file is
+                used if it exists and no hw_file is given.
             linelist_file: An optional file with a list of line indexes to load samples.
                 It is useful to select a subset of samples or duplicate samples. 
         """
@@ -34,7 +42,14 @@ class TSVDataset(object):
 
         self.img_tsv = TSVFile(img_file)
         self.label_tsv = None if label_file is None else TSVFile(label_file)
-        self.hw_tsv = None if hw_file is None else TSVFile(hw_file)
+        if hw_file is None and op.isfile(get_hw_index_file(img_file)):
+            hw_file = get_hw_index_file(img_file)
+        self.hw_index = None
+        self.hw_tsv = None
+        if hw_file is not None and is_hw_index_file(hw_file):
+            self.hw_index = load_hw_index(hw_file)
+        elif hw_file is not None:
+            self.hw_tsv = TSVFile(hw_file)
         self.line_list = load_linelist_file(linelist_file)
 
     def __len__(self):
@@ -56,8 +71,7 @@ class TSVDataset(object):
     def get_image(self, idx): 
         line_no = self.get_line_no(idx)
         row = self.img_tsv.seek(line_no)
-        # use -1 to support old format with multiple columns.
-        cv2_im = img_from_base64(row[-1])
+        cv2_im = img_from_base64(row.get_bytes(IMAGE_COLUMN))
         cv2_im = cv2.cvtColor(cv2_im, cv2.COLOR_BGR2RGB)
         # convert to PIL Image as required by transforms
         img = Image.fromarray(cv2_im)
@@ -83,6 +97,10 @@ class TSVDataset(object):
         return image, target
 
     def get_img_info(self, idx):
+        if self.hw_index is not None:
+            h, w = self.hw_index[self.get_line_no(idx)]
+            if h >= 0:
+                return {"height": int(h), "width": int(w)}
         if self.hw_tsv is not None:
             line_no = self.get_line_no(idx)
             row = self.hw_tsv.seek(line_no)
@@ -105,19 +123,38 @@ class TSVDataset(object):
         else:
             return self.img_tsv.seek(line_no)[0]
 
+    def get_img_keys(self, idxs):
+        line_nos = [self.get_line_no(idx) for idx in idxs]
+        tsv = self.hw_tsv or self.label_tsv or self.img_tsv
+        return [row[0] for row in tsv.seek_many(line_nos, columns=[0])]
+
     @staticmethod
     def load_inverted_index(inverted_file, min_inverted_list_length=0, max_inverted_rows=-1):
-        def gen_rows():
-            num_rows = 0
-            for row in TSVFile.reader(inverted_file):
-                inv_list = row[1].split(' ')
-                if len(inv_list) < min_inverted_list_length:
-                    continue
-                num_rows += 1
-                yield row[0], list(map(int, inv_list))
-                if max_inverted_rows >= 0 and num_rows >= max_inverted_rows:
-                    break
-        return {x[0]: x[1] for x in gen_rows()}
+        return InvertedIndex(inverted_file, min_inverted_list_length=min_inverted_list_length,
+                             max_inverted_rows=max_inverted_rows)
+
+
+def find_tsv_path_in_yaml(fname, root, yaml_file, key):
+    """ Return the path of a tsv of a yaml entry, which declares the shards of
+        a composite tsv by a glob pattern or a list of files. The composite tsv
+        is next to the yaml, and may not be saved yet.
+    """
+    if is_shard_pattern(fname):
+        return get_composite_file(yaml_file, key)
+    return find_file_path_in_yaml(fname, root)
+
+
+def find_composite_shards_in_yaml(cfg, root, yaml_file, keys=('img', 'label', 'prediction')):
+    """ Return a dict from the composite tsv of each of the keys of a yaml
+        declaring shards to the list of its shards.
+    """
+    return {get_composite_file(yaml_file, k): find_shard_files(cfg[k], root)
+            for k in keys if is_shard_pattern(cfg.get(k, None))}
+
+
+def write_composite_files(composite_shards):
+    for composite_file, shards in composite_shards.items():
+        write_composite_file(composite_file, shards)
 
 
 class TSVYamlDataset(TSVDataset):
@@ -126,9 +163,10 @@ class TSVYamlDataset(TSVDataset):
     def __init__(self, yaml_file):
         self.cfg = load_from_yaml_file(yaml_file)
         self.root = op.dirname(yaml_file)
-        img_file = find_file_path_in_yaml(self.cfg['img'], self.root)
-        label_file = find_file_path_in_yaml(self.cfg.get('label', None),
-                                            self.root)
+        write_composite_files(find_composite_shards_in_yaml(self.cfg, self.root, yaml_file, keys=('img', 'label')))
+        img_file = find_tsv_path_in_yaml(self.cfg['img'], self.root, yaml_file, 'img')
+        label_file = find_tsv_path_in_yaml(self.cfg.get('label', None),
+                                           self.root, yaml_file, 'label')
         hw_file = find_file_path_in_yaml(self.cfg.get('hw', None), self.root)
         linelist_file = find_file_path_in_yaml(self.cfg.get('linelist', None),
                                                self.root)
@@ -137,26 +175,41 @@ class TSVYamlDataset(TSVDataset):
             img_file, label_file, hw_file, linelist_file)
 
 
+def get_label_version_file(tsv_file, version):
+    return op.splitext(tsv_file)[0] + '.label.v{}.tsv'.format(version)
+
+
 class TSVSubset(object):
     def __init__(self, name, tsv_file, label_file=None, prediction_file=None, labelmap_file=None, 
-                 hw_file=None, min_inverted_list_length=0, max_inverted_rows=-1, version=0):
+                 hw_file=None, min_inverted_list_length=0, max_inverted_rows=-1, version=0,
+                 composite_shards=None):
         self.name = name
         self.tsv_file = tsv_file
         self.label_file = label_file if label_file is not None else op.splitext(tsv_file)[0] + '.label.tsv'
         self.prediction_file = prediction_file  # prediction file could be optional as None
         self.labelmap_file = labelmap_file if labelmap_file is not None else op.splitext(self.label_file)[0] + '.labelmap.txt'
-        self.hw_file = hw_file if hw_file is not None else op.splitext(tsv_file)[0] + '.hw.tsv'
-        self.inverted_file = op.splitext(self.label_file)[0] + '.inverted.tsv'
+        self.hw_file = hw_file if hw_file is not None else get_hw_index_file(tsv_file)
+        self.inverted_file = get_inverted_file(self.label_file)
+        self.stats_file = get_label_stats_file(self.label_file)
+        self.conf_stats_file = None if prediction_file is None else get_conf_stats_file(prediction_file)
         self.min_inverted_list_length = min_inverted_list_length
         self.max_inverted_rows = max_inverted_rows
         self.version = version
+        # the composite tsv files of the subset and their shards, saved when its metainfo is built
+        self.composite_shards = composite_shards or {}
+
+    def is_composite_outdated(self):
+        return any(is_composite_file_outdated(f, shards) for f, shards in self.composite_shards.items())
+
+    def write_composite_files(self):
+        write_composite_files(self.composite_shards)
 
     @classmethod
     def from_singlefile(cls, name, tsv_file, version=0):
         if version == 0:
             return cls(name, tsv_file, version=version)
         else:
-            label_file = op.splitext(tsv_file)[0] + '.label.v{}.tsv'.format(version)
+            label_file = get_label_version_file(tsv_file, version)
             if op.isfile(label_file):
                 return cls(name, tsv_file, label_file, version=version)
 
@@ -167,12 +220,13 @@ class TSVSubset(object):
             return None
         root = op.dirname(yaml_file)
         subset = cls(name,
-            tsv_file=find_file_path_in_yaml(cfg['img'], root),
-            label_file=find_file_path_in_yaml(cfg.get('label', None), root),
-            prediction_file=find_file_path_in_yaml(cfg.get('prediction', None), root),
+            tsv_file=find_tsv_path_in_yaml(cfg['img'], root, yaml_file, 'img'),
+            label_file=find_tsv_path_in_yaml(cfg.get('label', None), root, yaml_file, 'label'),
+            prediction_file=find_tsv_path_in_yaml(cfg.get('prediction', None), root, yaml_file, 'prediction'),
             labelmap_file=find_file_path_in_yaml(cfg.get('labelmap', None), root),
             min_inverted_list_length=cfg.get('min_inverted_list_length', 0),
-            max_inverted_rows=cfg.get('max_inverted_rows', -1)
+            max_inverted_rows=cfg.get('max_inverted_rows', -1),
+            composite_shards=find_composite_shards_in_yaml(cfg, root, yaml_file),
             # hw_file=find_file_path_in_yaml(cfg.get('hw', None), root)
         )
         return subset
@@ -186,35 +240,51 @@ class TSVSubset(object):
         return subset
 
 
-def get_all_data_info(data_dir):
+def get_all_subsets(data_dir):
     subsets = []
     for yaml in [fn for fn in os.listdir(data_dir) if fn.endswith('.yaml')]:
         s = TSVSubset.from_yaml(yaml, op.join(data_dir, yaml))
         if s is not None:
             subsets.append(s)
     subsets = sorted(subsets, key=lambda x: x.name)
+    file_names = os.listdir(data_dir)
     for tsv in ['train', 'trainval', 'val', 'test']:
         tsv_file = op.join(data_dir, tsv) + '.tsv'
         if op.isfile(tsv_file):
             subsets.append(TSVSubset.from_singlefile(tsv, tsv_file, version=0))
-        # check other label versions
-        for ver in range(1, 1000000):
-            s = TSVSubset.from_singlefile(tsv, tsv_file, version=ver)
-            if s is None:
-                break
-            subsets.append(s)
+        # find the other label versions in the listing instead of probing each version
+        pattern = re.compile(re.escape(tsv) + r'\.label\.v([1-9][0-9]*)\.tsv$')
+        versions = sorted(int(m.group(1)) for m in map(pattern.match, file_names) if m is not None)
+        for ver in versions:
+            subsets.append(TSVSubset(tsv, tsv_file, get_label_version_file(tsv_file, ver), version=ver))
+    return [s for s in subsets if op.isfile(s.tsv_file) or s.tsv_file in s.composite_shards]
+
+
+def get_subset_info(s):
+    """ Return the (name, version, label counts, statistics) of a subset from
+        its label statistics file, and the confidence statistics of its
+        prediction file if any, with the labels filtered as its inverted
+        index would filter them, and the label counts as a list of
+        (index, label, number of rows, number of boxes) in ascending order.
+    """
+    stats = load_label_stats(s.stats_file)
+    if s.conf_stats_file is not None:
+        stats.update(load_label_stats(s.conf_stats_file))
+    labels = [x for x in stats['labels'] if x[1] >= s.min_inverted_list_length]
+    if s.max_inverted_rows >= 0:
+        labels = labels[:s.max_inverted_rows]
+    label_count = sorted(labels, key=lambda x: x[1])
+    return (s.name, s.version, [(i, l, c, b) for i, (l, c, b) in enumerate(label_count)], stats)
+
+
+def get_all_data_info(data_dir):
+    subsets = get_all_subsets(data_dir)
 
     subsets_labels = []
     for s in subsets:
-        if not op.isfile(s.tsv_file):
-            continue
+        s.write_composite_files()
         TSVFile.ensure_metainfo(s.tsv_file, label_file=s.label_file, prediction_file=s.prediction_file, labelmap_file=s.labelmap_file, hw_file=s.hw_file)
-        inverted = TSVDataset.load_inverted_index(s.inverted_file, 
-                min_inverted_list_length=s.min_inverted_list_length, 
-                max_inverted_rows=s.max_inverted_rows)
-        label_count = [(k, len(v)) for k, v in inverted.items()]
-        label_count = sorted(label_count, key=lambda x: x[1])
-        subsets_labels.append((s.name, s.version, [(i, l, c) for i, (l, c) in enumerate(label_count)]))
+        subsets_labels.append(get_subset_info(s))
     
     name_subset_labels = [(op.split(data_dir)[1], subsets_labels)]
     return name_subset_labels
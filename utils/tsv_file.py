@@ -1,35 +1,237 @@
 import os
 import os.path as op
 import json
+import mmap
+import shutil
 import logging
+import numpy as np
 from tqdm import tqdm
+import threading
 import multiprocessing
-from pathos.multiprocessing import ProcessingPool as Pool
+from collections import OrderedDict
 
 # add parent path to make this script alone runnable
 import sys
 sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
 
-from utils.file_io import ensure_directory, generate_lineidx
-from utils.image_io import img_from_base64
+from utils.file_io import ensure_directory, write_to_file, generate_lineidx, LineidxWriter
+from utils.file_io import get_lineidx_file, get_legacy_lineidx_file, read_lineidx_header
+from utils.file_io import load_lineidx, load_legacy_lineidx, convert_lineidx
+from utils.file_io import update_lineidx, append_lineidx, get_tail_checksum
+from utils.image_io import img_from_base64, img_from_bytes, img_size_from_base64, img_size_from_bytes
+from utils.image_io import get_image_source, IMAGE_COLUMN
+from utils.inverted_index import get_inverted_file, get_legacy_inverted_file
+from utils.inverted_index import write_inverted_index, convert_inverted_index, InvertedIndex
+from utils.conf_index import get_conf_index_file, write_conf_index, ConfIndex
+from utils.hw_index import get_hw_index_file, is_hw_index_file, write_hw_index, load_hw_index
+from utils.key_index import get_key_index_file, write_key_index
+from utils.bgzf import is_bgzf_file, open_tsv, BGZFReader
+from utils.label_stats import BOX_SIZE_BINS, get_label_stats_file, get_conf_stats_file, get_box_sizes
+from utils.label_stats import get_histogram_counts, make_label_stats, merge_label_stats, make_conf_stats
+from utils.label_stats import write_label_stats, load_label_stats
+from utils.composite_tsv import is_composite_file, read_composite_file, write_composite_file
+from utils.composite_tsv import get_shard_files, get_tsv_mtime
+
+
+class TSVRow(object):
+    """ A lazy view of one row of a memory-mapped tsv file.
+        Column boundaries are located on demand, so reading the first columns
+        does not touch a long image column. Indexing returns stripped str
+        columns as a list of columns would, and get_bytes returns a zero-copy
+        memoryview of a column.
+    """
+    _whitespace = frozenset(b' \t\n\r\x0b\x0c')
+
+    def __init__(self, buf, view, start, end, sep=b'\t'):
+        self._buf = buf
+        self._view = view
+        self._end = end
+        self._sep = sep
+        self._starts = [start]
+        self._complete = False
+
+    def __locate(self, col):
+        # find the start of the columns up to col, or all of them if col is None
+        while not self._complete and (col is None or len(self._starts) <= col + 1):
+            pos = self._buf.find(self._sep, self._starts[-1], self._end)
+            if pos < 0:
+                self._complete = True
+            else:
+                self._starts.append(pos + 1)
+
+    def __span(self, col):
+        if col < 0:
+            self.__locate(None)
+            col += len(self._starts)
+            if col < 0:
+                raise IndexError('column index out of range')
+        else:
+            self.__locate(col)
+            if col >= len(self._starts):
+                raise IndexError('column index out of range')
+        start = self._starts[col]
+        end = self._starts[col + 1] - 1 if col + 1 < len(self._starts) else self._end
+        while start < end and self._buf[start] in self._whitespace:
+            start += 1
+        while end > start and self._buf[end - 1] in self._whitespace:
+            end -= 1
+        return start, end
+
+    def __len__(self):
+        self.__locate(None)
+        return len(self._starts)
+
+    def __getitem__(self, col):
+        if isinstance(col, slice):
+            return [self[i] for i in range(*col.indices(len(self)))]
+        start, end = self.__span(col)
+        return self._buf[start:end].decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return 'TSVRow({})'.format([self[i][:32] for i in range(len(self))])
+
+    def get_bytes(self, col):
+        start, end = self.__span(col)
+        return self._view[start:end]
+
+    def get_prefix(self, col, size):
+        """ Return a zero-copy memoryview of at most the first size bytes of
+            a column, without searching for the end of a longer column.
+        """
+        if col < 0:
+            return self.get_bytes(col)[:size]
+        self.__locate(col - 1)
+        if col >= len(self._starts):
+            raise IndexError('column index out of range')
+        start = self._starts[col]
+        end = min(self._end, start + size)
+        pos = self._buf.find(self._sep, start, end)
+        if pos >= 0:
+            end = pos
+        while start < end and self._buf[start] in self._whitespace:
+            start += 1
+        if end - start < size:
+            while end > start and self._buf[end - 1] in self._whitespace:
+                end -= 1
+        return self._view[start:end]
 
 
 class TSVFile(object):
-    def __init__(self, tsv_file):
+    def __new__(cls, *args, **kwargs):
+        # a composite tsv is opened as a CompositeTSVFile, so that any reader
+        # of a tsv reads the rows of its shards
+        if cls is TSVFile and len(args) > 0 and is_composite_file(args[0]):
+            return super(TSVFile, cls).__new__(CompositeTSVFile)
+        return super(TSVFile, cls).__new__(cls)
+
+    def __init__(self, tsv_file, generate_lineidx=True):
         self.tsv_file = tsv_file
-        self.lineidx = op.splitext(tsv_file)[0] + '.lineidx' 
+        self.lineidx = get_lineidx_file(tsv_file)
+        self.legacy_lineidx = get_legacy_lineidx_file(tsv_file)
+        self.generate_lineidx = generate_lineidx
         self._fp = None
+        self._mm = None
+        self._view = None
+        self._bgzf = None
         self._lineidx = None
         self.__ensure_lineidx_loaded()
-    
+
+    def __getstate__(self):
+        # the memory-mapped lineidx and tsv are re-created lazily instead of
+        # being copied when a TSVFile is pickled, e.g. by the cache.
+        state = self.__dict__.copy()
+        state['_fp'] = None
+        state['_mm'] = None
+        state['_view'] = None
+        state['_bgzf'] = None
+        state['_lineidx'] = None
+        return state
+
+    def close(self):
+        # drop the handles instead of closing them, so that they are closed
+        # once no row view or pending read uses them any more
+        self._fp = None
+        self._mm = None
+        self._view = None
+        self._bgzf = None
+        self._lineidx = None
+
     def num_rows(self):
+        self.__ensure_lineidx_loaded()
         return len(self._lineidx) 
 
+    def get_offset(self, idx):
+        """ Return the byte offset of the idx-th row from the lineidx without reading the row.
+        """
+        self.__ensure_lineidx_loaded()
+        return int(self._lineidx[idx])
+
     def seek(self, idx):
+        """ Return a TSVRow view of the idx-th row without copying its content.
+        """
+        self.__ensure_lineidx_loaded()
+        if idx < 0:
+            idx += len(self._lineidx)
+        start = int(self._lineidx[idx])
+        # as in seek_many, the tsv is only opened once the row is known to exist
         self.__ensure_tsv_opened()
-        pos = self._lineidx[idx]
-        self._fp.seek(pos)
-        return [s.strip() for s in self._fp.readline().split('\t')]
+        if self._bgzf is not None:
+            buf = self._bgzf.read(start, int(self._lineidx[idx + 1]) if idx + 1 < len(self._lineidx) else None)
+            return TSVRow(buf, memoryview(buf), 0, len(buf))
+        end = int(self._lineidx[idx + 1]) if idx + 1 < len(self._lineidx) else len(self._mm)
+        return TSVRow(self._mm, self._view, start, end)
+
+    def seek_many(self, indices, columns=None, max_gap=65536, as_bytes=False):
+        """ Read many rows at once and return them in the order of indices.
+            Rows are read in file order, and rows that are at most max_gap bytes
+            apart are coalesced into one sequential read. If columns is given,
+            each row is a list of only those columns, as memoryviews instead of
+            str if as_bytes is True. The rows of a BGZF compressed tsv are read
+            one by one in file order, sharing the cache of decompressed blocks.
+        """
+        self.__ensure_lineidx_loaded()
+        num_rows = len(self._lineidx)
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        if len(indices) == 0:
+            return []
+        indices = np.where(indices < 0, indices + num_rows, indices)
+        if indices.min() < 0 or indices.max() >= num_rows:
+            raise IndexError('row index out of range')
+        # an empty tsv cannot be memory-mapped, so it is opened once a row is read
+        self.__ensure_tsv_opened()
+        starts = self._lineidx[indices].astype(np.int64)
+        next_starts = self._lineidx[np.minimum(indices + 1, num_rows - 1)].astype(np.int64)
+        ends = np.where(indices + 1 < num_rows, next_starts, -1 if self._bgzf is not None else len(self._mm))
+        order = np.argsort(starts, kind='stable').tolist()
+        starts, ends = starts.tolist(), ends.tolist()
+
+        def get_columns(row):
+            get = row.get_bytes if as_bytes else row.__getitem__
+            return [get(c) for c in (range(len(row)) if columns is None else columns)]
+
+        result = [None] * len(order)
+        if self._bgzf is not None:
+            for k in order:
+                buf = self._bgzf.read(starts[k], None if ends[k] < 0 else ends[k])
+                result[k] = get_columns(TSVRow(buf, memoryview(buf), 0, len(buf)))
+            return result
+        i = 0
+        while i < len(order):
+            run_start, run_end = starts[order[i]], ends[order[i]]
+            j = i + 1
+            while j < len(order) and starts[order[j]] - run_end <= max_gap:
+                run_end = max(run_end, ends[order[j]])
+                j += 1
+            buf = self.__read(run_start, run_end - run_start)
+            view = memoryview(buf)
+            for k in order[i:j]:
+                result[k] = get_columns(TSVRow(buf, view, starts[k] - run_start, ends[k] - run_start))
+            i = j
+        return result
 
     def rows(self, filter_idx=None):
         if filter_idx is None:
@@ -41,7 +243,15 @@ class TSVFile(object):
         logger = logging.getLogger(__name__)
         if self._lineidx is None:
             if not op.isfile(self.lineidx):
-                if self.generate_lineidx:
+                if op.isfile(self.legacy_lineidx):
+                    try:
+                        convert_lineidx(self.legacy_lineidx, self.lineidx, op.getsize(self.tsv_file))
+                    except OSError:
+                        # e.g. a read-only data folder, keep the legacy index in memory
+                        logger.warning("Failed to convert {}, loading it in memory".format(self.legacy_lineidx))
+                        self._lineidx = load_legacy_lineidx(self.legacy_lineidx)
+                        return
+                elif self.generate_lineidx:
                     logger.warning("Generating lineidx file because it does not exist. " \
                         "Note this might cause problem in distributed training." \
                         "It is better to check lineidx files before training.")
@@ -49,18 +259,23 @@ class TSVFile(object):
                 else:
                     raise ValueError("{} file does not exist".format(self.lineidx)) 
 
-            with open(self.lineidx, 'r') as fp:
-                self._lineidx = [int(i.strip()) for i in fp.readlines()]
+            self._lineidx = load_lineidx(self.lineidx)
 
-    def __ensure_tsv_opened(self):
-        if self._fp is None:
-            self._fp = open(self.tsv_file, 'r')
+    def __read(self, offset, size):
+        if hasattr(os, 'pread'):
+            return os.pread(self._fp.fileno(), size, offset)
+        self._fp.seek(offset)
+        return self._fp.read(size)
 
-    @staticmethod
-    def __guess_col_image(tsv_file):
-        # peek one line to find the longest column as col_image
-        cols = next(TSVFile.reader(tsv_file))
-        return max(enumerate(cols), key=lambda x: len(x[1]))[0]
+    def __ensure_tsv_opened(self):
+        if self._fp is None and self._bgzf is None:
+            if is_bgzf_file(self.tsv_file):
+                # a compressed tsv is read by blocks instead of being memory-mapped
+                self._bgzf = BGZFReader(self.tsv_file)
+                return
+            self._fp = open(self.tsv_file, 'rb')
+            self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mm)
 
     @staticmethod
     def __is_label_json_format(label_file):
@@ -91,9 +306,10 @@ class TSVFile(object):
 
     @staticmethod
     def reader(tsv_file_name, sep='\t'):
-        with open(tsv_file_name, 'r') as fp:
-            for _, line in enumerate(fp):
-                yield [x.strip() for x in line.split(sep)]
+        for shard in get_shard_files(tsv_file_name):
+            with open_tsv(shard, 'r') as fp:
+                for _, line in enumerate(fp):
+                    yield [x.strip() for x in line.split(sep)]
 
     @staticmethod
     def writer(tsv_file_name, values, sep='\t'):
@@ -116,13 +332,12 @@ class TSVFile(object):
     @staticmethod
     def writer_with_lineidx(tsv_file_name, values, sep='\t'):
         ensure_directory(op.dirname(tsv_file_name))
-        tsv_lineidx_file = op.splitext(tsv_file_name)[0] + '.lineidx'
         idx = 0
         tsv_file_name_tmp = tsv_file_name + '.tmp'
-        tsv_lineidx_file_tmp = tsv_lineidx_file + '.tmp'
         import sys
         is_py2 = sys.version_info.major == 2
-        with open(tsv_file_name_tmp, 'wb') as fp, open(tsv_lineidx_file_tmp, 'w') as fpidx:
+        fpidx = LineidxWriter(get_lineidx_file(tsv_file_name))
+        with open(tsv_file_name_tmp, 'wb') as fp:
             assert values is not None
             for value in values:
                 assert value
@@ -132,157 +347,901 @@ class TSVFile(object):
                     v = sep.join(map(lambda v: v.decode() if type(v) == bytes else str(v), value)) + '\n'
                     v = v.encode()
                 fp.write(v)
-                fpidx.write(str(idx) + '\n')
+                fpidx.append(idx)
                 idx = idx + len(v)
         os.rename(tsv_file_name_tmp, tsv_file_name)
-        os.rename(tsv_lineidx_file_tmp, tsv_lineidx_file)
+        # close the lineidx after the tsv is in place so that it is not older than the tsv
+        fpidx.close(idx, get_tail_checksum(tsv_file_name, idx))
 
     @staticmethod
-    def __ensure_lineidx(tsv_file):
-        assert op.isfile(tsv_file)
-        lineidx_file = op.splitext(tsv_file)[0] + '.lineidx'
-        if not op.isfile(lineidx_file) or op.getmtime(lineidx_file) < op.getmtime(tsv_file):
-            logging.info('generating lineidx file: {}'.format(lineidx_file))
-            generate_lineidx(tsv_file, lineidx_file, replace_existing=True)
+    def __is_lineidx_outdated(tsv_file):
+        if is_composite_file(tsv_file):
+            return any(TSVFile.__is_lineidx_outdated(f) for f in read_composite_file(tsv_file))
+        lineidx_file = get_lineidx_file(tsv_file)
+        return not op.isfile(lineidx_file) or op.getmtime(lineidx_file) < op.getmtime(tsv_file)
 
     @staticmethod
-    def __ensure_separate_label(full_tsv, label_file):
-        if op.isfile(label_file) or op.islink(label_file):
+    def __ensure_lineidx(tsv_file, num_workers=None):
+        assert op.isfile(tsv_file)
+        if is_composite_file(tsv_file):
+            # a composite tsv is indexed by the lineidx of its shards
+            for f in read_composite_file(tsv_file):
+                TSVFile.__ensure_lineidx(f, num_workers=num_workers)
             return
+        lineidx_file = get_lineidx_file(tsv_file)
+        if TSVFile.__is_lineidx_outdated(tsv_file):
+            if update_lineidx(tsv_file, lineidx_file, num_workers=num_workers) is not None:
+                return
+            legacy_lineidx_file = get_legacy_lineidx_file(tsv_file)
+            if op.isfile(legacy_lineidx_file) and op.getmtime(legacy_lineidx_file) >= op.getmtime(tsv_file):
+                convert_lineidx(legacy_lineidx_file, lineidx_file, op.getsize(tsv_file))
+            else:
+                logging.info('generating lineidx file: {}'.format(lineidx_file))
+                generate_lineidx(tsv_file, lineidx_file, replace_existing=True, num_workers=num_workers)
 
-        num_rows = TSVFile(full_tsv).num_rows()
-        logging.info('generating label file: {}'.format(label_file))
-        def gen_rows():
-            for row in tqdm(TSVFile.reader(full_tsv), total=num_rows):
-                yield row[0:2]
-        TSVFile.writer(label_file, gen_rows())
+    @staticmethod
+    def __append_lineidx(tsv_file):
+        # the number of rows before the rows appended to the tsv since its
+        # lineidx was generated, which are appended to the lineidx, or None
+        if not op.isfile(tsv_file) or is_composite_file(tsv_file) or not TSVFile.__is_lineidx_outdated(tsv_file):
+            return None
+        return update_lineidx(tsv_file)
+
+    @staticmethod
+    def ensure_label_metainfo(tsv_file, label_file=None, labelmap_file=None, shard_size=256 << 20,
+                              num_workers=None):
+        """ Ensure the label file, labelmap and inverted label file of a tsv,
+            and the lineidx of the tsv and of the label file.
+        """
+        label_file, labelmap_file, inverted_file = TSVFile.__get_metainfo_files(
+            tsv_file, label_file, labelmap_file)
+        TSVFile.__build_label_metainfo(tsv_file, label_file, labelmap_file, inverted_file,
+            shard_size=shard_size, num_workers=num_workers)
+        TSVFile.__ensure_lineidx(tsv_file, num_workers=num_workers)
+        TSVFile.__ensure_lineidx(label_file, num_workers=num_workers)
+
+    @staticmethod
+    def get_objects(annotation):
+        """ Return the objects of an annotation string with a positive class.
+        """
+        rects = TSVFile.parse_annotation(annotation)['objects']
+        return [rect for rect in rects if 'class' in rect and not rect['class'].startswith('-')]
 
     @staticmethod
-    def __ensure_labelmap(label_file, labelmap_file):
-        """ A label file always has two columns: key, label
+    def __build_label_metainfo(tsv_file, label_file, labelmap_file, inverted_file,
+                               shard_size=256 << 20, num_workers=None):
+        """ Generate the missing label file, labelmap, inverted label file and
+            label statistics in one sequential pass, parsing each annotation only once.
+            If the label file does not exist, it is extracted from the first two
+            columns of the tsv together with its lineidx, otherwise the label file
+            is read directly. The lineidx of the scanned file is built on the way.
+
+            The scanned file is split into byte-range shards of shard_size which
+            are processed by a pool of num_workers processes. Each finished shard
+            is saved in a checkpoint folder, so that an interrupted build resumes
+            from the finished shards, and all shards are merged at the end.
         """
-        if op.isfile(labelmap_file) or op.islink(labelmap_file):
+        write_label = not (op.isfile(label_file) or op.islink(label_file))
+        need_labelmap = not (op.isfile(labelmap_file) or op.islink(labelmap_file))
+        need_inverted = not (op.isfile(inverted_file) or op.islink(inverted_file))
+        legacy_inverted_file = get_legacy_inverted_file(label_file)
+        if need_inverted and not write_label and op.isfile(legacy_inverted_file):
+            convert_inverted_index(legacy_inverted_file, inverted_file)
+            need_inverted = False
+        need_stats = write_label or TSVFile.__is_label_stats_outdated(label_file, inverted_file)
+        if not (write_label or need_labelmap or need_inverted or need_stats):
             return
 
-        logging.info('generating labelmap file: {}'.format(labelmap_file))
+        source_file = tsv_file if write_label else label_file
+        logging.info('generating label metainfo from: {}'.format(source_file))
+        fsize = op.getsize(source_file)
+        parse_labels = need_labelmap or need_inverted or need_stats
+        shard_dir = get_shard_dir(source_file)
+        starts = list(range(0, fsize, shard_size))
+        if is_bgzf_file(source_file):
+            # a compressed file is split at block boundaries
+            reader = BGZFReader(source_file)
+            starts = sorted(set(x for x in reader.align_to_blocks(starts) if x < fsize))
+            reader.close()
+        shards = [(source_file, start, end,
+                   op.join(shard_dir, 'shard-{:05d}'.format(i)), write_label, parse_labels)
+                  for i, (start, end) in enumerate(zip(starts, starts[1:] + [fsize]))]
+        manifest = {'source_file': op.abspath(source_file), 'size': fsize,
+                    'mtime': op.getmtime(source_file), 'shard_size': shard_size,
+                    'write_label': write_label, 'parse_labels': parse_labels}
+        TSVFile.__ensure_shard_dir(shard_dir, manifest)
 
-        labelmap = []
-        num_rows = TSVFile(label_file).num_rows()
-        for cols in tqdm(TSVFile.reader(label_file), total=num_rows):
-            rects = TSVFile.parse_annotation(cols[1])['objects']
-            labels = [rect['class'] for rect in rects if 'class' in rect]
-            labels = set(filter(lambda x: not x.startswith('-'), labels))
-            labelmap.extend(labels)
-
-        if len(labelmap) == 0:
-            logging.warning('there are no labels!')
-        labelmap = sorted(list(set(labelmap)))
-        logging.info('find {} labels'.format(len(labelmap)))
-        TSVFile.writer(labelmap_file, map(lambda x: [x,], labelmap))
+        todo = [x for x in shards if not op.isfile(x[3] + '.npz')]
+        if len(todo) < len(shards):
+            logging.info('resuming from {} finished shards out of {}'.format(len(shards) - len(todo), len(shards)))
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        num_workers = min(num_workers, len(todo))
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                for _ in tqdm(pool.imap_unordered(build_label_shard, todo), total=len(todo)):
+                    pass
+        else:
+            for x in tqdm(todo):
+                build_label_shard(x)
+
+        TSVFile.__merge_label_shards([x[3] for x in shards], source_file,
+            label_file if write_label else None,
+            labelmap_file if need_labelmap else None,
+            inverted_file if need_inverted else None,
+            get_label_stats_file(label_file) if need_stats else None)
+        shutil.rmtree(shard_dir)
 
     @staticmethod
-    def __ensure_hw_file(tsv_file, hw_file):
-        if op.isfile(hw_file) or op.islink(hw_file):
-            return
+    def __is_composite_label(tsv_file, label_file):
+        # the label metainfo of a composite tsv is built by shards unless a
+        # single label file is given
+        return is_composite_file(tsv_file) and (is_composite_file(label_file) or
+                                                not (op.isfile(label_file) or op.islink(label_file)))
 
-        logging.info('generating hw file: {}'.format(hw_file))
-        col_image = TSVFile.__guess_col_image(tsv_file)
-        num_images = TSVFile(tsv_file).num_rows()
-
-        num_worker = multiprocessing.cpu_count() * 2
-        num_tasks = num_worker * 5
-        num_image_per_task = (num_images + num_tasks - 1) // num_tasks
-        multi_thread = True if num_images > 5 else False
-        if not multi_thread:
-            rows = TSVFile.reader(tsv_file)
-            def gen_rows():
-                for row in tqdm(rows, total=num_images):
-                    yield row[0], ' '.join(map(str, img_from_base64(row[col_image]).shape[:2]))
-            TSVFile.writer(hw_file, gen_rows())
+    @staticmethod
+    def __get_composite_label_shards(tsv_file, label_file):
+        shards = read_composite_file(tsv_file)
+        # the label file extracted from the shards follows the shards of the tsv
+        derived = op.abspath(label_file) == op.abspath(TSVFile.__get_metainfo_files(tsv_file)[0])
+        if is_composite_file(label_file) and not derived:
+            label_shards = read_composite_file(label_file)
+            if len(label_shards) != len(shards):
+                raise ValueError('{} and {} have different numbers of shards'.format(tsv_file, label_file))
         else:
-            logging.info('multiprocessing with {} workers and {} tasks, with each task processing {} images'
-                .format(num_worker, num_tasks, num_image_per_task))
-            with Pool(num_worker) as pool:
-                def get_hw(task_id):
-                    idx_start = task_id * num_image_per_task
-                    idx_end = min(idx_start + num_image_per_task, num_images)
-                    rows = TSVFile(tsv_file).rows(filter_idx=range(idx_start, idx_end))
-                    return [(row[0], ' '.join(map(str, img_from_base64(row[col_image]).shape[:2])))
-                        for row in rows]
-                all_result = list(tqdm(pool.imap(get_hw, range(num_tasks)), total=num_tasks))
-            x = []
-            for r in all_result:
-                x.extend(r)
-            TSVFile.writer(hw_file, x)
+            label_shards = [TSVFile.__get_metainfo_files(f)[0] for f in shards]
+        return list(zip(shards, label_shards))
+
+    @staticmethod
+    def __is_label_metainfo_ready(tsv_file, label_file):
+        files = TSVFile.__get_metainfo_files(tsv_file, label_file)
+        return all(op.isfile(f) or op.islink(f) for f in files) and \
+            not any(TSVFile.__is_lineidx_outdated(f) for f in [tsv_file, files[0]]) and \
+            not TSVFile.__is_label_stats_outdated(files[0], files[2])
 
     @staticmethod
-    def __ensure_inverted_label_file(label_file, inverted_file):
-        if op.isfile(inverted_file) or op.islink(inverted_file):
+    def __is_composite_label_outdated(tsv_file, label_file, inverted_file):
+        if not TSVFile.__is_composite_label(tsv_file, label_file):
+            return False
+        if not op.isfile(inverted_file):
+            return True
+        mtime = op.getmtime(inverted_file)
+        if op.getmtime(tsv_file) > mtime:
+            return True
+        for f, l in TSVFile.__get_composite_label_shards(tsv_file, label_file):
+            shard_inverted_file = TSVFile.__get_metainfo_files(f, l)[2]
+            if not op.isfile(shard_inverted_file) or op.getmtime(shard_inverted_file) > mtime:
+                return True
+        return False
+
+    @staticmethod
+    def __build_composite_label_metainfo(tsv_file, label_file, labelmap_file, inverted_file,
+                                         shard_size=256 << 20, num_workers=None):
+        """ Build the label metainfo of each shard of a composite tsv, in a pool
+            of num_workers processes with one shard per task, and merge them into
+            a composite label file of the label files of the shards, and the
+            labelmap, inverted label file and label statistics of the composite tsv.
+        """
+        shards = TSVFile.__get_composite_label_shards(tsv_file, label_file)
+        todo = [(f, l, shard_size) for f, l in shards if not TSVFile.__is_label_metainfo_ready(f, l)]
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        if len(todo) > 0:
+            logging.info('generating label metainfo of {} shards of: {}'.format(len(todo), tsv_file))
+        if min(num_workers, len(todo)) > 1:
+            # a worker of the pool builds its shard in one process
+            with multiprocessing.Pool(min(num_workers, len(todo))) as pool:
+                for _ in tqdm(pool.imap_unordered(ensure_shard_label_metainfo, [x + (1,) for x in todo]),
+                              total=len(todo)):
+                    pass
+        else:
+            for x in todo:
+                ensure_shard_label_metainfo(x + (num_workers,))
+
+        write_composite_file(label_file, [l for _, l in shards])
+        need_labelmap = not (op.isfile(labelmap_file) or op.islink(labelmap_file))
+        if not (need_labelmap or TSVFile.__is_composite_label_outdated(tsv_file, label_file, inverted_file) or
+                TSVFile.__is_label_stats_outdated(label_file, inverted_file)):
             return
 
-        logging.info('generating inverted label file: {}'.format(inverted_file))
+        logging.info('merging the label metainfo of the shards of: {}'.format(tsv_file))
+        inverted = {}
+        shard_stats = []
+        num_rows = 0
+        for f, l in shards:
+            shard_stats.append(load_label_stats(get_label_stats_file(l)))
+            for label, rows in InvertedIndex(TSVFile.__get_metainfo_files(f, l)[2]).items():
+                if label not in inverted:
+                    inverted[label] = [rows + num_rows]
+                else:
+                    inverted[label].append(rows + num_rows)
+            num_rows += read_lineidx_header(get_lineidx_file(l))[0]
+        if need_labelmap:
+            if len(inverted) == 0:
+                logging.warning('there are no labels!')
+            TSVFile.writer(labelmap_file, map(lambda x: [x,], sorted(inverted.keys())))
+        write_inverted_index(inverted_file, {l: np.concatenate(p) for l, p in inverted.items()})
+        write_label_stats(get_label_stats_file(label_file),
+                          merge_label_stats(shard_stats, _get_label_counts(inverted)))
+
+    @staticmethod
+    def __append_label_metainfo(tsv_file, label_file, labelmap_file, inverted_file, appended):
+        """ Append the labels of the rows appended to the label file to the
+            labelmap, the inverted label file and the label statistics if
+            they have the rows before the append, given the number of rows
+            before the append of each appended file. If the tsv was appended to
+            and the label file has the rows of the tsv before the append, it is
+            extracted from the tsv, so the label rows of the new rows of the tsv
+            are extracted and appended to the label file and its lineidx first.
+            Any other change is left to a full rebuild.
+        """
+        if not all(op.isfile(f) for f in [label_file, labelmap_file, inverted_file]):
+            return
+        if label_file in appended:
+            source_file, write_label, num_rows = label_file, False, appended[label_file]
+        elif tsv_file in appended and not TSVFile.__is_lineidx_outdated(label_file) and \
+                read_lineidx_header(get_lineidx_file(label_file))[0] == appended[tsv_file]:
+            source_file, write_label, num_rows = tsv_file, True, appended[tsv_file]
+        else:
+            return
+        lineidx = load_lineidx(get_lineidx_file(source_file))
+        if num_rows >= len(lineidx):
+            return
+
+        logging.info('appending the label metainfo of {} rows of: {}'.format(len(lineidx) - num_rows, source_file))
+        shard_prefix = op.splitext(source_file)[0] + '.metainfo.append'
+        build_label_shard((source_file, int(lineidx[num_rows]), op.getsize(source_file), shard_prefix,
+                           write_label, True))
+        with np.load(shard_prefix + '.npz') as shard:
+            if write_label:
+                label_size = op.getsize(label_file)
+                with open(label_file, 'ab') as fp, open(shard_prefix + '.label.tsv', 'rb') as label_fp:
+                    shutil.copyfileobj(label_fp, fp, 16 << 20)
+                label_end = label_size + int(shard['label_size'])
+                append_lineidx(get_lineidx_file(label_file), shard['label_offsets'] + np.uint64(label_size),
+                               label_end, get_tail_checksum(label_file, label_end))
+                os.remove(shard_prefix + '.label.tsv')
+                appended[label_file] = num_rows
+            labels = json.loads(str(shard['labels']))
+            postings = np.split(shard['postings'] + num_rows, np.cumsum(shard['counts'])[:-1])
+            appended_stats = _get_shard_label_stats(shard, labels)
+        os.remove(shard_prefix + '.npz')
+
+        inverted = {l: [p] for l, p in InvertedIndex(inverted_file).items()}
+        for l, p in zip(labels, postings):
+            if l not in inverted:
+                inverted[l] = [p]
+            else:
+                inverted[l].append(p)
+        write_inverted_index(inverted_file, {l: np.concatenate(p) for l, p in inverted.items()})
+
+        # statistics of other rows are left outdated, to be rebuilt by a full scan
+        stats_file = get_label_stats_file(label_file)
+        try:
+            stats = load_label_stats(stats_file)
+        except (OSError, ValueError):
+            stats = None
+        if stats is not None and stats['num_rows'] == num_rows:
+            write_label_stats(stats_file, merge_label_stats([stats, appended_stats], _get_label_counts(inverted)))
+
+        # new labels are appended, so that the index of the known labels is kept
+        known = set(l[0] for l in TSVFile.reader(labelmap_file))
+        new_labels = [l for l in labels if l not in known]
+        if len(new_labels) > 0:
+            logging.info('appending {} labels to: {}'.format(len(new_labels), labelmap_file))
+            with open(labelmap_file, 'rb+') as fp:
+                fp.seek(0, os.SEEK_END)
+                if fp.tell() > 0:
+                    fp.seek(-1, os.SEEK_END)
+                    if fp.read(1) != b'\n':
+                        fp.write(b'\n')
+                fp.write(''.join(l + '\n' for l in new_labels).encode())
+
+    @staticmethod
+    def __ensure_shard_dir(shard_dir, manifest):
+        # drop the checkpoints of a previous build of a different file or layout
+        manifest_file = op.join(shard_dir, 'manifest.json')
+        if op.isdir(shard_dir):
+            try:
+                with open(manifest_file, 'r') as fp:
+                    if json.load(fp) == manifest:
+                        return
+            except (OSError, ValueError):
+                pass
+            logging.info('removing outdated shards: {}'.format(shard_dir))
+            shutil.rmtree(shard_dir)
+        ensure_directory(shard_dir)
+        write_to_file(json.dumps(manifest), manifest_file)
+
+    @staticmethod
+    def __merge_label_shards(shard_prefixes, source_file, label_file, labelmap_file, inverted_file, stats_file):
+        """ Concatenate the shards into the lineidx of the scanned file and the
+            label file with its lineidx, and merge their inverted indexes and
+            label statistics.
+        """
+        source_lineidx = None
+        if TSVFile.__is_lineidx_outdated(source_file):
+            source_lineidx = LineidxWriter(get_lineidx_file(source_file))
+        if label_file is not None:
+            ensure_directory(op.dirname(label_file))
+            label_fp = open(label_file + '.tmp', 'wb')
+            label_lineidx = LineidxWriter(get_lineidx_file(label_file))
 
         inverted = {}
-        total = 0
+        shard_stats = []
+        num_rows, label_pos = 0, 0
+        for prefix in shard_prefixes:
+            with np.load(prefix + '.npz') as shard:
+                offsets = shard['offsets']
+                if source_lineidx is not None:
+                    source_lineidx.extend(offsets)
+                if label_file is not None:
+                    label_lineidx.extend(shard['label_offsets'] + np.uint64(label_pos))
+                    with open(prefix + '.label.tsv', 'rb') as fp:
+                        shutil.copyfileobj(fp, label_fp, 16 << 20)
+                    label_pos += int(shard['label_size'])
+                # labels are listed by first occurrence, so that the merged
+                # dict keeps the same order as a sequential scan
+                labels = json.loads(str(shard['labels']))
+                postings = np.split(shard['postings'] + num_rows, np.cumsum(shard['counts'])[:-1])
+                for l, p in zip(labels, postings):
+                    if l not in inverted:
+                        inverted[l] = [p]
+                    else:
+                        inverted[l].append(p)
+                if stats_file is not None:
+                    shard_stats.append(_get_shard_label_stats(shard, labels))
+            num_rows += len(offsets)
+
+        if label_file is not None:
+            label_fp.close()
+            os.rename(label_file + '.tmp', label_file)
+            label_lineidx.close(label_pos, get_tail_checksum(label_file, label_pos))
+        if source_lineidx is not None:
+            fsize = op.getsize(source_file)
+            source_lineidx.close(fsize, get_tail_checksum(source_file, fsize))
+
+        if labelmap_file is not None:
+            if len(inverted) == 0:
+                logging.warning('there are no labels!')
+            labelmap = sorted(inverted.keys())
+            logging.info('find {} labels'.format(len(labelmap)))
+            TSVFile.writer(labelmap_file, map(lambda x: [x,], labelmap))
+
+        if inverted_file is not None:
+            write_inverted_index(inverted_file, {l: np.concatenate(p) for l, p in inverted.items()})
+
+        # written last, so that the statistics are not older than the label files
+        if stats_file is not None:
+            write_label_stats(stats_file, merge_label_stats(shard_stats, _get_label_counts(inverted)))
+
+    @staticmethod
+    def __is_hw_index_outdated(tsv_file):
+        hw_file = get_hw_index_file(tsv_file)
+        return not op.isfile(hw_file) or op.getmtime(hw_file) < get_tsv_mtime(tsv_file)
+
+    @staticmethod
+    def __ensure_hw_index(tsv_file, num_workers=None, rows_per_task=1000, appended_rows=None):
+        """ Save the height and width of each image of a tsv as a binary hw
+            index. The sizes are parsed from the headers of the images, which
+            only needs a prefix of each image column, and the rows are split
+            into ranges read by a pool of processes. If rows were appended to
+            the tsv after its first appended_rows rows, which the hw index
+            has, only the sizes of the new images are read.
+        """
+        if not TSVFile.__is_hw_index_outdated(tsv_file):
+            return
+
+        hw_file = get_hw_index_file(tsv_file)
+        hw = []
+        if appended_rows is not None and op.isfile(hw_file) and is_hw_index_file(hw_file):
+            old_hw = load_hw_index(hw_file)
+            if len(old_hw) == appended_rows:
+                hw.append(np.array(old_hw))
+        first_row = len(hw[0]) if hw else 0
+        logging.info('{} hw index file: {}'.format('appending to' if first_row > 0 else 'generating', hw_file))
+        tsv = TSVFile(tsv_file)
+        num_rows = tsv.num_rows()
+        tasks = [(tsv_file, IMAGE_COLUMN, start, min(start + rows_per_task, num_rows))
+                 for start in range(first_row, num_rows, rows_per_task)]
+        # a tsv opened by an earlier build, in this process or inherited by
+        # the forked workers, may have fewer rows
+        _worker_tsv_files.pop(tsv_file, None)
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        num_workers = min(num_workers, len(tasks))
+
+        with tqdm(total=num_rows - first_row) as t:
+            if num_workers > 1:
+                with multiprocessing.Pool(num_workers) as pool:
+                    for r in pool.imap(read_image_hw_range, tasks):
+                        hw.append(r)
+                        t.update(len(r))
+            else:
+                for task in tasks:
+                    hw.append(read_image_hw_range(task))
+                    t.update(len(hw[-1]))
+        hw = np.concatenate(hw) if hw else np.zeros((0, 2), dtype='<i4')
+        write_hw_index(hw_file, hw, op.getsize(tsv_file))
+
+    @staticmethod
+    def __is_conf_index_outdated(prediction_file):
+        mtime = get_tsv_mtime(prediction_file)
+        return any(not op.isfile(f) or op.getmtime(f) < mtime
+                   for f in [get_conf_index_file(prediction_file), get_conf_stats_file(prediction_file)])
+
+    @staticmethod
+    def __ensure_conf_index(prediction_file, appended_rows=None):
+        """ Index the max and min box confidences of each label in each row of
+            a prediction file, so that rows can be filtered by confidence
+            without parsing the predictions, and save the statistics of the
+            confidences. If rows were appended to the prediction file after
+            its first appended_rows rows, which the confidence index and its
+            statistics have, only the new rows are parsed.
+        """
+        if not TSVFile.__is_conf_index_outdated(prediction_file):
+            return
+
+        conf_file = get_conf_index_file(prediction_file)
+        stats_file = get_conf_stats_file(prediction_file)
+        label_confs = {}
+        first_row = 0
+        base = None
+        if appended_rows is not None and op.isfile(conf_file) and op.isfile(stats_file):
+            conf = ConfIndex(conf_file)
+            base = load_label_stats(stats_file)
+            if conf.num_rows() == appended_rows and base.get('num_prediction_rows') == appended_rows:
+                label_confs = {l: tuple(x.tolist() for x in arrays) for l, arrays in conf.items()}
+                first_row = appended_rows
+            else:
+                base = None
+        logging.info('{} confidence index file: {}'.format('appending to' if first_row > 0 else 'generating',
+                                                           conf_file))
+        tsv = TSVFile(prediction_file)
+        num_rows = tsv.num_rows()
+        rows = TSVFile.reader(prediction_file) if first_row == 0 else tsv.rows(range(first_row, num_rows))
+        confs = []
+        for i, cols in tqdm(enumerate(rows, first_row), total=num_rows - first_row):
+            row_confs = {}
+            for rect in TSVFile.get_objects(cols[1]):
+                conf = rect.get('conf', 1)
+                confs.append(conf)
+                # None collects the boxes of any label
+                for l in [rect['class'], None]:
+                    lo, hi = row_confs.get(l, (conf, conf))
+                    row_confs[l] = (min(lo, conf), max(hi, conf))
+            for l, (lo, hi) in row_confs.items():
+                if l not in label_confs:
+                    label_confs[l] = ([], [], [])
+                label_confs[l][0].append(i)
+                label_confs[l][1].append(hi)
+                label_confs[l][2].append(lo)
+        write_conf_index(conf_file, label_confs, num_rows)
+        write_label_stats(stats_file, make_conf_stats(num_rows, confs, base=base))
+
+    @staticmethod
+    def __is_key_index_outdated(label_file):
+        key_file = get_key_index_file(label_file)
+        return not op.isfile(key_file) or op.getmtime(key_file) < get_tsv_mtime(label_file)
+
+    @staticmethod
+    def __ensure_key_index(label_file):
+        """ Index the image keys of a label file, so that rows can be found
+            by their key without reading the label file.
+        """
+        if not TSVFile.__is_key_index_outdated(label_file):
+            return
+
+        key_file = get_key_index_file(label_file)
+        logging.info('generating key index file: {}'.format(key_file))
+        keys = []
         num_rows = TSVFile(label_file).num_rows()
-        for i, cols in tqdm(enumerate(TSVFile.reader(label_file)), total=num_rows):
-            rects = TSVFile.parse_annotation(cols[1])['objects']
-            labels = [rect['class'] for rect in rects if 'class' in rect]
-            labels = set(filter(lambda x: not x.startswith('-'), labels))
+        with tqdm(total=num_rows) as t:
+            for shard in get_shard_files(label_file):
+                num_keys = len(keys)
+                with open_tsv(shard, 'rb') as fp:
+                    for line in fp:
+                        keys.append(_split_key_label(line)[0])
+                t.update(len(keys) - num_keys)
+        write_key_index(key_file, keys)
 
-            for l in labels:
-                if l not in inverted:
-                    inverted[l] = [i]
-                else:
-                    inverted[l].append(i)
-            total += 1
-        
-        def gen_inverted_rows(inv):
-            # sort inverted list by the length of each list
-            for x in sorted(inv.items(), key=lambda x: len(x[1]), reverse=True):
-                yield x[0], ' '.join(map(str, x[1]))
-        TSVFile.writer(inverted_file, gen_inverted_rows(inverted))
+    @staticmethod
+    def __is_label_stats_outdated(label_file, inverted_file):
+        stats_file = get_label_stats_file(label_file)
+        if not op.isfile(stats_file):
+            return True
+        mtime = op.getmtime(stats_file)
+        return any(get_tsv_mtime(f) > mtime for f in [label_file, inverted_file] if op.isfile(f))
 
     @staticmethod
-    def ensure_metainfo(tsv_file, label_file=None, prediction_file=None, labelmap_file=None, hw_file=None):
+    def __get_metainfo_files(tsv_file, label_file=None, labelmap_file=None):
+        if label_file is None:
+            label_file = op.splitext(tsv_file)[0] + '.label.tsv'
+        if labelmap_file is None:
+            labelmap_file = op.splitext(tsv_file)[0] + '.labelmap.txt'
+        inverted_file = get_inverted_file(label_file)
+        return label_file, labelmap_file, inverted_file
+
+    @staticmethod
+    def __uses_hw_index(tsv_file, hw_file):
+        return hw_file is None or op.abspath(hw_file) == op.abspath(get_hw_index_file(tsv_file))
+
+    @staticmethod
+    def is_metainfo_ready(tsv_file, label_file=None, prediction_file=None, labelmap_file=None, hw_file=None):
+        """ Check without building anything whether ensure_metainfo has nothing to do.
+        """
+        label_file, labelmap_file, inverted_file = TSVFile.__get_metainfo_files(
+            tsv_file, label_file, labelmap_file)
+        for f in [label_file, labelmap_file, inverted_file]:
+            if not (op.isfile(f) or op.islink(f)):
+                return False
+        if prediction_file is not None and TSVFile.__is_conf_index_outdated(prediction_file):
+            return False
+        if TSVFile.__uses_hw_index(tsv_file, hw_file) and TSVFile.__is_hw_index_outdated(tsv_file):
+            return False
+        if TSVFile.__is_key_index_outdated(label_file):
+            return False
+        if TSVFile.__is_label_stats_outdated(label_file, inverted_file):
+            return False
+        if TSVFile.__is_composite_label_outdated(tsv_file, label_file, inverted_file):
+            return False
+        return not any(TSVFile.__is_lineidx_outdated(f) for f in [tsv_file, label_file, prediction_file]
+                       if f is not None)
+
+    @staticmethod
+    def get_metainfo_progress(tsv_file, label_file=None):
+        """ Return the fraction of finished shards of an ongoing label metainfo
+            build, or None if no sharded build is in progress.
+        """
+        label_file, _, _ = TSVFile.__get_metainfo_files(tsv_file, label_file)
+        if TSVFile.__is_composite_label(tsv_file, label_file):
+            shards = TSVFile.__get_composite_label_shards(tsv_file, label_file)
+            num_done = len([x for x in shards if TSVFile.__is_label_metainfo_ready(*x)])
+            return num_done / len(shards) if len(shards) > 0 else None
+        source_file = label_file if op.isfile(label_file) else tsv_file
+        shard_dir = get_shard_dir(source_file)
+        try:
+            with open(op.join(shard_dir, 'manifest.json'), 'r') as fp:
+                manifest = json.load(fp)
+            num_done = len([f for f in os.listdir(shard_dir) if f.endswith('.npz')])
+        except (OSError, ValueError):
+            return None
+        num_shards = max(1, (manifest['size'] + manifest['shard_size'] - 1) // manifest['shard_size'])
+        return min(1.0, num_done / num_shards)
+
+    @staticmethod
+    def ensure_metainfo(tsv_file, label_file=None, prediction_file=None, labelmap_file=None, hw_file=None,
+                        shard_size=256 << 20, num_workers=None):
         """ Check and ensure meta info for visualization
             The meta info includes: 
             1. lineidx for the input tsv
-            2. a separate label file and a lineidx file
+            2. a separate label file and its lineidx and image key index files
             3. labelmap file
-            4. hw file
+            4. binary hw index with the height and width of each image, unless hw_file is another file
             5. inverted label file
-            6. optional prediction file and its lineidx file
+            6. label statistics with the label and box counts and the box size histogram
+            7. optional prediction file and its lineidx, confidence index and confidence histogram files
+            The label metainfo of a composite tsv is built for each of its shards and merged.
+            The rows appended to the tsv, label or prediction file since they were indexed
+            are appended to the metainfo, which is rebuilt if a file was otherwise modified.
         """
         assert op.isfile(tsv_file)
 
+        label_file, labelmap_file, inverted_file = TSVFile.__get_metainfo_files(
+            tsv_file, label_file, labelmap_file)
+
+        # index only the rows appended to the files since they were indexed,
+        # and append them to the metainfo built from them
+        appended = {}
+        for f in [tsv_file, label_file, prediction_file]:
+            if f is not None and f not in appended:
+                num_rows = TSVFile.__append_lineidx(f)
+                if num_rows is not None:
+                    appended[f] = num_rows
+        TSVFile.__append_label_metainfo(tsv_file, label_file, labelmap_file, inverted_file, appended)
+
+        # generate the label file, labelmap, inverted label file and label
+        # statistics with the lineidx of the scanned file in one pass if any
+        # of them is missing, or for each shard of a composite tsv
+        if TSVFile.__is_composite_label(tsv_file, label_file):
+            TSVFile.__build_composite_label_metainfo(tsv_file, label_file, labelmap_file, inverted_file,
+                shard_size=shard_size, num_workers=num_workers)
+        else:
+            TSVFile.__build_label_metainfo(tsv_file, label_file, labelmap_file, inverted_file,
+                shard_size=shard_size, num_workers=num_workers)
+
         # check and generate lineidx if needed
         TSVFile.__ensure_lineidx(tsv_file)
-
-        # check and generate label file and lineidx if needed
-        if label_file is None:
-            label_file = op.splitext(tsv_file)[0] + '.label.tsv'
-        TSVFile.__ensure_separate_label(tsv_file, label_file)
         TSVFile.__ensure_lineidx(label_file)
+        TSVFile.__ensure_key_index(label_file)
 
-        # generate lineidx for prediction file if needed
+        # generate lineidx and confidence index for prediction file if needed
         if prediction_file is not None:
             TSVFile.__ensure_lineidx(prediction_file)
+            TSVFile.__ensure_conf_index(prediction_file, appended_rows=appended.get(prediction_file))
 
-        # check and generate labelmap if needed
-        if labelmap_file is None:
-            labelmap_file = op.splitext(tsv_file)[0] + '.labelmap.txt'
-        TSVFile.__ensure_labelmap(label_file, labelmap_file)
-
-        # check and generate hw file if needed
-        #### not used and comment fow now.
-        # if hw_file is None:
-        #     hw_file = op.splitext(tsv_file)[0] + '.hw.tsv'
-        # TSVFile.__ensure_hw_file(tsv_file, hw_file)
-            
-        # check and generate inverted label file if needed
-        inverted_file = op.splitext(label_file)[0] + '.inverted.tsv'
-        TSVFile.__ensure_inverted_label_file(label_file, inverted_file)
+        # generate the binary hw index unless another hw file is given
+        if TSVFile.__uses_hw_index(tsv_file, hw_file):
+            TSVFile.__ensure_hw_index(tsv_file, num_workers=num_workers, appended_rows=appended.get(tsv_file))
+
+
+class CompositeTSVFile(TSVFile):
+    """ The shards listed by a composite tsv presented as one tsv.
+        A row is located by a binary search of the cumulative numbers of rows
+        of the shards, read from the headers of their lineidx. The shards are
+        opened on demand, and the least recently used ones are dropped so that
+        at most max_open_files file descriptors (each open shard holding up to
+        FILES_PER_SHARD of them) are used.
+    """
+    FILES_PER_SHARD = 3
+
+    def __init__(self, tsv_file, generate_lineidx=True, max_open_files=192):
+        self.tsv_file = tsv_file
+        self.generate_lineidx = generate_lineidx
+        self.shard_files = read_composite_file(tsv_file)
+        self.max_open_shards = max(1, max_open_files // self.FILES_PER_SHARD)
+        self._shards = OrderedDict()
+        self._lock = threading.Lock()
+        self._cum_rows = np.cumsum([0] + [self.__get_shard_rows(f) for f in self.shard_files], dtype=np.int64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = OrderedDict()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __get_shard_rows(self, shard_file):
+        lineidx_file = get_lineidx_file(shard_file)
+        if op.isfile(lineidx_file):
+            return read_lineidx_header(lineidx_file)[0]
+        # generate or convert the lineidx as a TSVFile would
+        return TSVFile(shard_file, self.generate_lineidx).num_rows()
+
+    def __get_shard(self, i):
+        with self._lock:
+            shard = self._shards.get(i)
+            if shard is not None:
+                self._shards.move_to_end(i)
+                return shard
+        shard = TSVFile(self.shard_files[i], self.generate_lineidx)
+        with self._lock:
+            self._shards[i] = shard
+            self._shards.move_to_end(i)
+            # a dropped shard is closed once no row view or pending read uses it
+            while len(self._shards) > self.max_open_shards:
+                self._shards.popitem(last=False)
+        return shard
+
+    def __locate(self, indices):
+        # the shard of each row and the row in the shard
+        shards = np.searchsorted(self._cum_rows, indices, side='right') - 1
+        return shards, indices - self._cum_rows[shards]
+
+    def close(self):
+        with self._lock:
+            self._shards.clear()
+
+    def num_rows(self):
+        return int(self._cum_rows[-1])
+
+    def get_offset(self, idx):
+        """ Return the offset of the idx-th row in its shard, after the offsets
+            of the rows of the previous shards.
+        """
+        if idx < 0:
+            idx += self.num_rows()
+        shards, rows = self.__locate(np.asarray([idx], dtype=np.int64))
+        return (int(shards[0]) << 64) | self.__get_shard(int(shards[0])).get_offset(int(rows[0]))
+
+    def seek(self, idx):
+        num_rows = self.num_rows()
+        if idx < 0:
+            idx += num_rows
+        if idx < 0 or idx >= num_rows:
+            raise IndexError('row index out of range')
+        shards, rows = self.__locate(np.asarray([idx], dtype=np.int64))
+        return self.__get_shard(int(shards[0])).seek(int(rows[0]))
+
+    def seek_many(self, indices, columns=None, max_gap=65536, as_bytes=False):
+        """ Read many rows at once and return them in the order of indices.
+            The rows are grouped by shard, and the rows of each shard are read
+            by the seek_many of the shard.
+        """
+        num_rows = self.num_rows()
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        if len(indices) == 0:
+            return []
+        indices = np.where(indices < 0, indices + num_rows, indices)
+        if indices.min() < 0 or indices.max() >= num_rows:
+            raise IndexError('row index out of range')
+        shards, rows = self.__locate(indices)
+        order = np.argsort(shards, kind='stable')
+        bounds = np.flatnonzero(np.diff(shards[order])) + 1
+        result = [None] * len(indices)
+        for group in np.split(order, bounds):
+            shard_rows = self.__get_shard(int(shards[group[0]])).seek_many(
+                rows[group], columns=columns, max_gap=max_gap, as_bytes=as_bytes)
+            for k, row in zip(group.tolist(), shard_rows):
+                result[k] = row
+        return result
+
+
+def get_image_hw(col_image):
+    """ Return the (height, width) of a base64 encoded image from its header,
+        or by decoding it if the header cannot be parsed.
+    """
+    size = img_size_from_base64(col_image)
+    if size is None:
+        return img_from_base64(col_image).shape[:2]
+    return size[1], size[0]
+
+
+def get_row_image_hw(row, col_image, prefix_size=65536):
+    """ Return the (height, width) of the image in a column of a TSVRow, which
+        is base64 encoded or the path of an image file, from the first
+        prefix_size bytes of its column or file when they hold its header.
+        Return (-1, -1) for a url or an image which cannot be decoded.
+    """
+    prefix = row.get_prefix(col_image, prefix_size)
+    kind, source = get_image_source(prefix)
+    if kind == 'url':
+        return -1, -1
+    if kind == 'file':
+        with open(source, 'rb') as fp:
+            head = fp.read(prefix_size)
+            size = img_size_from_bytes(head)
+            if size is not None:
+                return size[1], size[0]
+            img = img_from_bytes(head + fp.read())
+        return (-1, -1) if img is None else img.shape[:2]
+    size = img_size_from_base64(prefix)
+    if size is not None:
+        return size[1], size[0]
+    img = img_from_base64(row.get_bytes(col_image))
+    return (-1, -1) if img is None else img.shape[:2]
+
+
+# the tsv files opened by a worker process, whose lineidx is memory-mapped
+# once per process and shared with the other workers through the page cache
+_worker_tsv_files = {}
+
+
+def read_image_hw_range(args):
+    """ Return the (height, width) of the images of the rows [start, end) of a
+        tsv as an (end - start, 2) int32 array.
+    """
+    tsv_file, col_image, start, end = args
+    tsv = _worker_tsv_files.get(tsv_file)
+    if tsv is None:
+        tsv = _worker_tsv_files[tsv_file] = TSVFile(tsv_file)
+    hw = np.empty((end - start, 2), dtype='<i4')
+    for i, idx in enumerate(range(start, end)):
+        try:
+            hw[i] = get_row_image_hw(tsv.seek(idx), col_image)
+        except Exception as e:
+            # a broken image only loses its size instead of failing the metainfo
+            logging.debug('failed to read the size of image {} of {}: {}'.format(idx, tsv_file, e))
+            hw[i] = -1, -1
+    return hw
+
+
+def ensure_shard_label_metainfo(args):
+    """ Ensure the label metainfo of one shard of a composite tsv, with a pool
+        of num_workers processes unless it runs in a worker of a pool.
+    """
+    tsv_file, label_file, shard_size, num_workers = args
+    TSVFile.ensure_label_metainfo(tsv_file, label_file, shard_size=shard_size, num_workers=num_workers)
+
+
+def get_shard_dir(tsv_file):
+    return op.splitext(tsv_file)[0] + '.metainfo.shards'
+
+
+def _split_key_label(line):
+    # slice the first two columns without splitting the (long) image column
+    first = line.find(b'\t')
+    if first < 0:
+        return line.strip(), None
+    second = line.find(b'\t', first + 1)
+    label = line[first + 1:] if second < 0 else line[first + 1:second]
+    return line[:first].strip(), label.strip()
+
+
+def _iter_rows(source_file, start, end):
+    """ Yield the (offset, line) of the rows of a tsv starting in the byte
+        range [start, end), or following a newline in the blocks starting in
+        it for a BGZF file, whose offsets are virtual offsets.
+    """
+    if is_bgzf_file(source_file):
+        reader = BGZFReader(source_file)
+        try:
+            for row in reader.iter_rows(start, end):
+                yield row
+        finally:
+            reader.close()
+        return
+    with open(source_file, 'rb') as fp:
+        pos = start
+        if start > 0:
+            # skip to the first row starting at or after start
+            fp.seek(start - 1)
+            pos = start - 1 + len(fp.readline())
+        while pos < end:
+            line = fp.readline()
+            if not line:
+                break
+            yield pos, line
+            pos += len(line)
+
+
+def _get_label_counts(inverted):
+    # the (label, number of rows) of a dict of label to lists of row arrays,
+    # in the order of the labels of the inverted file written from it
+    return sorted(((l, int(sum(len(x) for x in p))) for l, p in inverted.items()),
+                  key=lambda x: (-x[1], x[0]))
+
+
+def _get_shard_label_stats(shard, labels):
+    # the label statistics of the rows of a shard saved by build_label_shard
+    return make_label_stats(len(shard['offsets']), list(zip(labels, shard['counts'].tolist())),
+                            dict(zip(labels, shard['box_counts'].tolist())), shard['box_size_counts'].tolist())
+
+
+def build_label_shard(args):
+    """ Scan the rows of a tsv starting in the byte range [start, end) and save
+        their offsets, the extracted label rows, the inverted index (with row
+        ids relative to the shard), the number of boxes of each label and the
+        histogram of the box sizes under shard_prefix. The .npz file is
+        written last and marks the shard as finished.
+    """
+    source_file, start, end, shard_prefix, write_label, parse_labels = args
+    offsets, label_offsets, inverted = [], [], {}
+    box_counts, box_sizes = {}, []
+    label_pos = 0
+    if write_label:
+        label_fp = open(shard_prefix + '.label.tsv.tmp', 'wb')
+    for pos, line in _iter_rows(source_file, start, end):
+        i = len(offsets)
+        offsets.append(pos)
+
+        key, label = _split_key_label(line)
+        if write_label:
+            v = key + b'\n' if label is None else key + b'\t' + label + b'\n'
+            label_fp.write(v)
+            label_offsets.append(label_pos)
+            label_pos += len(v)
+        if label is not None and parse_labels:
+            objects = TSVFile.get_objects(label.decode())
+            for o in objects:
+                box_counts[o['class']] = box_counts.get(o['class'], 0) + 1
+            box_sizes.append(get_box_sizes(objects))
+            # each label of the row once, in the order of the boxes
+            for l in dict.fromkeys(o['class'] for o in objects):
+                if l not in inverted:
+                    inverted[l] = [i]
+                else:
+                    inverted[l].append(i)
+
+    if write_label:
+        label_fp.close()
+        os.replace(shard_prefix + '.label.tsv.tmp', shard_prefix + '.label.tsv')
+    labels = list(inverted.keys())
+    with open(shard_prefix + '.npz.tmp', 'wb') as fp:
+        np.savez(fp,
+                 offsets=np.asarray(offsets, dtype='<u8'),
+                 label_offsets=np.asarray(label_offsets, dtype='<u8'),
+                 label_size=np.asarray(label_pos, dtype=np.int64),
+                 labels=np.asarray(json.dumps(labels)),
+                 counts=np.asarray([len(inverted[l]) for l in labels], dtype=np.int64),
+                 postings=np.asarray([i for l in labels for i in inverted[l]], dtype=np.int64),
+                 box_counts=np.asarray([box_counts.get(l, 0) for l in labels], dtype=np.int64),
+                 box_size_counts=np.asarray(get_histogram_counts(
+                     np.concatenate(box_sizes) if box_sizes else np.zeros(0), BOX_SIZE_BINS), dtype=np.int64))
+    os.replace(shard_prefix + '.npz.tmp', shard_prefix + '.npz')
 
 
 if __name__ == "__main__":
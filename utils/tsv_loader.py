@@ -0,0 +1,163 @@
+import logging
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from PIL import Image
+import os.path as op
+
+# add parent path to make this script alone runnable
+import sys
+sys.path.append(op.dirname(op.dirname(op.realpath(__file__))))
+
+
+# the modes of the images which are shared as uint8 arrays, which a PIL
+# image of the same mode is created from
+SHARED_IMAGE_MODES = ('L', 'RGB', 'RGBA')
+
+# the dataset of a worker process, set once by the initializer of the pool
+_worker_dataset = None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def decode_image_batch(idxs):
+    """ Load the images of samples of the dataset of the worker with its
+        get_image, in the order of their rows in the tsv, and copy them into
+        one new shared memory block. Return the name of the block and the
+        (shape, offset) of each image in the order of idxs.
+    """
+    dataset = _worker_dataset
+    offsets = [dataset.img_tsv.get_offset(dataset.get_line_no(idx)) for idx in idxs]
+    arrays = [None] * len(idxs)
+    for k in np.argsort(offsets, kind='stable').tolist():
+        img = dataset.get_image(idxs[k])
+        if not isinstance(img, Image.Image) or img.mode not in SHARED_IMAGE_MODES:
+            raise ValueError('get_image of sample {} returned {}, only PIL images of mode {} can be '
+                             'loaded in workers'.format(idxs[k], getattr(img, 'mode', type(img)),
+                                                        ', '.join(SHARED_IMAGE_MODES)))
+        arrays[k] = np.asarray(img)
+
+    layout, size = [], 0
+    for arr in arrays:
+        layout.append((arr.shape, size))
+        size += arr.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+    try:
+        for arr, item in zip(arrays, layout):
+            np.ndarray(item[0], dtype=np.uint8, buffer=shm.buf, offset=item[1])[...] = arr
+    finally:
+        shm.close()
+    return shm.name, layout
+
+
+class TSVPrefetchLoader(object):
+    """ Iterate over the samples of a TSVDataset in batches, decoding the
+        images in a pool of processes ahead of the consumer.
+        Each worker has a copy of the dataset and loads the images of a batch
+        with its get_image in line offset order, and the decoded images come
+        back through shared memory instead of being pickled, so get_image
+        must return PIL images of one of SHARED_IMAGE_MODES. At most
+        prefetch_depth batches are decoded ahead.
+        Each sample is the (img, target, idx) of dataset[idx]: annotations,
+        targets and transforms run in the calling process with the methods of
+        the dataset. If in_offset_order is True, the samples are visited in
+        the order of their rows in the tsv instead of the order of indices.
+    """
+    def __init__(self, dataset, batch_size=32, num_workers=None, prefetch_depth=2, indices=None,
+                 in_offset_order=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count()
+        self.prefetch_depth = max(1, prefetch_depth)
+        self.indices = list(range(len(dataset))) if indices is None else list(indices)
+        if in_offset_order:
+            offsets = [dataset.img_tsv.get_offset(dataset.get_line_no(i)) for i in self.indices]
+            self.indices = [self.indices[i] for i in np.argsort(offsets, kind='stable')]
+        self._pool = None
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def __submit(self, batch):
+        return batch, self._pool.apply_async(decode_image_batch, (batch,))
+
+    def __collect(self, batch, job):
+        shm_name, layout = job.get()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            samples = []
+            for idx, item in zip(batch, layout):
+                # copy the array out of the shared memory, which a PIL image may share
+                img = Image.fromarray(np.ndarray(item[0], dtype=np.uint8, buffer=shm.buf, offset=item[1]).copy())
+                annotations = self.dataset.get_annotations(idx)
+                target = self.dataset.get_target_from_annotations(annotations, img.size, idx)
+                img, target = self.dataset.apply_transforms(img, target)
+                samples.append((img, target, idx))
+            return samples
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def __iter__(self):
+        if self._pool is None:
+            logging.info('decoding images with {} workers'.format(self.num_workers))
+            # the workers share the resource tracker of this process, so that a
+            # block created by a worker is only unlinked by the consumer
+            resource_tracker.ensure_running()
+            self._pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker,
+                                              initargs=(self.dataset,))
+        batches = [self.indices[i:i + self.batch_size] for i in range(0, len(self.indices), self.batch_size)]
+        pending = deque()
+        next_batch = 0
+        try:
+            while next_batch < len(batches) or len(pending) > 0:
+                while next_batch < len(batches) and len(pending) < self.prefetch_depth:
+                    pending.append(self.__submit(batches[next_batch]))
+                    next_batch += 1
+                yield self.__collect(*pending.popleft())
+        finally:
+            # release the shared memory of the batches decoded but not consumed
+            for _, job in pending:
+                try:
+                    shm = shared_memory.SharedMemory(name=job.get()[0])
+                    shm.close()
+                    shm.unlink()
+                except Exception:
+                    pass
+
+
+if __name__ == "__main__":
+    import time
+    import logger
+    import argparse
+    from utils.tsv_dataset import TSVYamlDataset
+
+    parser = argparse.ArgumentParser(description='Measure the decoding speed of a yaml dataset')
+    parser.add_argument('yaml_file', action="store")
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--prefetch_depth', type=int, default=2)
+    args = parser.parse_args()
+
+    logger.init_logging()
+    dataset = TSVYamlDataset(args.yaml_file)
+    start = time.time()
+    with TSVPrefetchLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                           prefetch_depth=args.prefetch_depth) as loader:
+        num_samples = sum(len(batch) for batch in loader)
+    logging.info('{} samples in {:.2f}s'.format(num_samples, time.time() - start))